@@ -45,23 +45,58 @@ void convertCoordinatesOfPairwiseAlignment(struct PairwiseAlignment *pairwiseAli
 
 /*
  * Routine reads in chunk up a set of sequences into overlapping sequence files.
+ *
+ * The stats of each chunk are written to a manifest in the chunks dir, a line per
+ * chunk of: chunk file name, length, unmasked bases (upper case other than N), Ns
+ * and Gs or Cs.
  */
 
 static int64_t chunkRemaining;
 static FILE *chunkFileHandle = NULL;
+static FILE *chunkManifestHandle = NULL;
 static const char *chunksDir = NULL;
 static int64_t chunkNo = 0;
 static char *tempChunkFile = NULL;
 static int64_t chunkSize;
 static int64_t chunkOverlapSize;
+static int64_t chunkLength, chunkUnmaskedBases, chunkNs, chunkGCs;
+
+static void countChunkBases(const char *sequence, int64_t length) {
+    for (int64_t i = 0; i < length; i++) {
+        char c = sequence[i];
+        if (c == 'N' || c == 'n') {
+            chunkNs++;
+        } else if (c >= 'A' && c <= 'Z') {
+            chunkUnmaskedBases++;
+        }
+        if (c == 'G' || c == 'C' || c == 'g' || c == 'c') {
+            chunkGCs++;
+        }
+    }
+    chunkLength += length;
+}
 
-void finishChunkingSequences() {
+static void finishChunk() {
     if (chunkFileHandle != NULL) {
         fclose(chunkFileHandle);
         fprintf(stdout, "%s\n", tempChunkFile);
+        if (chunkManifestHandle != NULL) {
+            fprintf(chunkManifestHandle, "%" PRIi64 "\t%" PRIi64 "\t%" PRIi64 "\t%" PRIi64 "\t%" PRIi64 "\n",
+                    chunkNo - 1, chunkLength, chunkUnmaskedBases, chunkNs, chunkGCs);
+            fflush(chunkManifestHandle);
+        }
         free(tempChunkFile);
         tempChunkFile = NULL;
         chunkFileHandle = NULL;
+        chunkLength = chunkUnmaskedBases = chunkNs = chunkGCs = 0;
+    }
+}
+
+void finishChunkingSequences() {
+    finishChunk();
+    if (chunkManifestHandle != NULL) {
+        fclose(chunkManifestHandle);
+        chunkManifestHandle = NULL;
     }
 }
 
@@ -70,7 +105,7 @@ static void updateChunkRemaining(int64_t seqLength) {
     assert(seqLength >= 0);
     chunkRemaining -= seqLength;
     if (chunkRemaining <= 0) {
-        finishChunkingSequences();
+        finishChunk();
         chunkRemaining = chunkSize;
     }
 }
@@ -103,6 +138,7 @@ static int64_t processSubsequenceChunk(char *fastaHeader, int64_t start, char *s
     sequence[start + lengthOfSubsequence] = '\0';
     fastaWrite(&sequence[start], chunkHeader, chunkFileHandle);
     //fprintf(chunkFileHandle, "%s\n", &sequence[start]);
+    countChunkBases(&sequence[start], lengthOfSubsequence);
     free(chunkHeader);
     sequence[start + lengthOfSubsequence] = c;
 
@@ -139,6 +175,10 @@ void setupToChunkSequences(int64_t chunkSize2, int64_t overlapSize2, const char
     chunkNo = 0;
     chunkRemaining = chunkSize;
     chunkFileHandle = NULL;
+    chunkLength = chunkUnmaskedBases = chunkNs = chunkGCs = 0;
+    char *chunkManifestFile = stString_print("%s/%s", chunksDir, CHUNK_MANIFEST);
+    chunkManifestHandle = fopen(chunkManifestFile, "w");
+    free(chunkManifestFile);
 }
 
 /*
@@ -21,6 +21,9 @@ int64_t writeFlowerSequencesUnsafe(Flower *flower, void(*processSequence)(void *
 
 void convertCoordinatesOfPairwiseAlignment(struct PairwiseAlignment *pairwiseAlignment, int convertContig1, int convertContig2);
 
+// Name of the manifest of the stats of the chunks, in the chunks dir
+#define CHUNK_MANIFEST "manifest.tsv"
+
 void setupToChunkSequences(int64_t chunkSize2, int64_t overlapSize2, const char *chunksDir2);
 
 void processSequenceToChunk(void* destination, const char *fastaHeader, const char *sequence, int64_t length);
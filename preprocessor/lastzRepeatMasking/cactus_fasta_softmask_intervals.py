@@ -4,6 +4,7 @@ Given a list of intervals, mask those bases in the fasta sequence(s).
 """
 
 from sys import argv,stdin,exit
+from cactus.shared.intervals import mergeIntervals
 
 
 def usage(s=None):
@@ -114,7 +115,7 @@ def main():
 	f.close()
 
 	for chrom in chromToIntervals:
-		chromToIntervals[chrom] = merge_and_sort(chromToIntervals[chrom])
+		chromToIntervals[chrom] = mergeIntervals(chromToIntervals[chrom])
 
 	# process the sequences
 
@@ -179,26 +180,4 @@ def fasta_sequences(f):
 		yield (seqName,"".join(seqNucs))
 
 
-# merge_and_sort--
-#	Marge a set of intervals (union of sets) and sort them by increasing
-#	position
-
-def merge_and_sort(intervals):
-	intervals.sort()
-
-	start = None
-	for (s,e) in intervals:
-		if (start == None):
-			(start,end) = (s,e)
-		elif (s > end):
-			yield (start,end)
-			(start,end) = (s,e)
-			continue
-		elif (e > end):
-			end = e
-
-	if (start != None):
-		yield (start,end)
-
-
 if __name__ == "__main__": main()
@@ -53,4 +53,9 @@ setup(
                             'cactus-blast = cactus.blast.cactus_blast:main',
                             'cactus-refmap = cactus.refmap.cactus_refmap:main',
                             'cactus-graphmap = cactus.refmap.cactus_graphmap:main',
-                            'cactus-align = cactus.setup.cactus_align:main']},)
+                            'cactus-align = cactus.setup.cactus_align:main',
+                            'cactus-metrics = cactus.progressive.cactus_metrics:main',
+                            'cactus-fit-memory = cactus.progressive.cactus_metrics:main_fit_memory',
+                            'cactus-profile = cactus.progressive.cactus_profile:main',
+                            'cactus-trace = cactus.progressive.cactus_trace:main',
+                            'cactus-blast-cache = cactus.blast.blastCache:main']},)
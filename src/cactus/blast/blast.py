@@ -7,27 +7,39 @@
 sequences. Uses the toil framework to parallelise the blasts.
 """
 import os
+import gzip
+import hashlib
 import shutil
+import string
 from toil.lib.bioio import logger
 from toil.lib.bioio import system
 from toil.realtimeLogger import RealtimeLogger
 from toil.lib.threading import cpu_count
 
-from sonLib.bioio import catFiles, nameValue, popenCatch, getTempDirectory
+from sonLib.bioio import nameValue, getTempDirectory
 
 from cactus.shared.common import RoundedJob
+from cactus.shared.common import ContainerSession
 from cactus.shared.common import cactus_call
+from cactus.shared.common import cactus_call_async
 from cactus.shared.common import runLastz, runSelfLastz
 from cactus.shared.common import runCactusRealign, runCactusSelfRealign
-from cactus.shared.common import runGetChunks
-from cactus.shared.common import readGlobalFileWithoutCache
+from cactus.shared.common import runGetChunks, readChunkManifest
+from cactus.shared.common import concatenateGlobalFiles, groupForFanIn
+from cactus.shared.common import isGzipped
+from cactus.shared.common import compressStream, decompressStream
+from cactus.shared.common import catFiles
 from cactus.shared.common import ChildTreeJob
+from cactus.shared.intervals import readBed, subtractBedFiles
+from cactus.shared.localTurbo import useLocalTurbo, getPoolCores, runJobs, LocalFileID
+from cactus.blast.blastCache import getBlastCache, getBlastKey
+from cactus.blast.dedupAlignments import dedupAlignments
 from cactus.blast.upconvertCoordinates import upconvertCoords
 from cactus.blast.trimSequences import trimSequences
 
 class BlastOptions(object):
     def __init__(self, chunkSize=10000000, overlapSize=10000,
-                 lastzArguments="", compressFiles=True, realign=False, realignArguments="",
+                 lastzArguments="", compressFiles=False, realign=False, realignArguments="",
                  minimumSequenceLength=1, memory=None,
                  smallDisk = None,
                  largeDisk = None,
@@ -43,7 +55,24 @@ class BlastOptions(object):
                  # don't use realign.)
                  trimOutgroupFlanking=2000,
                  keepParalogs=False,
-                 gpuLastz=False):
+                 gpuLastz=False,
+                 # Bundling of blasts into multi-core jobs, off if
+                 # bundleSeconds is 0: the estimated seconds each
+                 # core of a bundle should take, and the cores
+                 bundleSeconds=0, bundleCores=4,
+                 # Rough speed of lastz, used to estimate how long
+                 # blasts take from the unmasked lengths of their chunks
+                 lastzBasesSquaredPerSecond=5e10,
+                 # Chunks with fewer unmasked bases than this are
+                 # merged together, or left out if they have none
+                 minimumChunkUnmaskedBases=1,
+                 # Results collated by each collation job, and whether
+                 # identical alignments are collated only once
+                 collateFanIn=1000, collateDedup=False,
+                 # Whether alignments identical to, or contained in,
+                 # another once their coordinates are converted (as
+                 # those in the overlaps of chunks are) are left out
+                 dedupOverlaps=False):
         """Class defining options for blast
         """
         self.chunkSize = chunkSize
@@ -66,19 +95,25 @@ class BlastOptions(object):
         self.trimOutgroupFlanking = trimOutgroupFlanking
         self.keepParalogs = keepParalogs
         self.gpuLastz = gpuLastz
+        self.bundleSeconds = bundleSeconds
+        self.bundleCores = bundleCores
+        self.lastzBasesSquaredPerSecond = lastzBasesSquaredPerSecond
+        self.minimumChunkUnmaskedBases = minimumChunkUnmaskedBases
+        self.collateFanIn = collateFanIn
+        self.collateDedup = collateDedup
+        self.dedupOverlaps = dedupOverlaps
 
 class BlastSequencesAllAgainstAll(RoundedJob):
     """Take a set of sequences, chunks them up and blasts them.
     """
     def __init__(self, sequenceFileIDs1, blastOptions):
         disk = 4*sum([seqFileID.size for seqFileID in sequenceFileIDs1])
-        cores = 1
+        cores = getPoolCores(sum([seqFileID.size for seqFileID in sequenceFileIDs1]), 1)
         memory = blastOptions.memory
 
         super(BlastSequencesAllAgainstAll, self).__init__(disk=disk, cores=cores, memory=memory, preemptable=True)
         self.sequenceFileIDs1 = sequenceFileIDs1
         self.blastOptions = blastOptions
-        self.blastOptions.compressFiles = False
         self.blastOptions.roundsOfCoordinateConversion = 1
 
     def run(self, fileStore):
@@ -86,13 +121,31 @@ class BlastSequencesAllAgainstAll(RoundedJob):
         if self.blastOptions.gpuLastz == True:
             # wga-gpu has a 6G limit. 
             self.blastOptions.chunkSize = 6000000000
+        chunksDir = getTempDirectory(rootDir=fileStore.getLocalTempDir())
         chunks = runGetChunks(sequenceFiles=sequenceFiles1,
-                              chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()),
+                              chunksDir=chunksDir,
                               chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
         if len(chunks) == 0:
             raise Exception("no chunks produced for files: {} ".format(sequenceFiles1))
         logger.info("Broken up the sequence files into individual 'chunk' files")
-        chunkIDs = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks]
+        numBlasts = len(chunks) * (len(chunks) + 1) // 2
+        chunks, chunksStats = pruneChunks(chunks, getChunksStats(chunks, chunksDir), self.blastOptions, chunksDir)
+        reportSavedBlasts(fileStore, numBlasts, len(chunks) * (len(chunks) + 1) // 2)
+        if len(chunks) == 0:
+            return fileStore.writeGlobalFile(fileStore.getLocalTempFile())
+        if useLocalTurbo(sum([seqFileID.size for seqFileID in self.sequenceFileIDs1])):
+            # Small enough to blast the chunks here, in the same order as
+            # MakeSelfBlasts and MakeOffDiagonalBlasts
+            chunkIDs = [LocalFileID(chunk) for chunk in chunks]
+            jobs = [RunSelfBlast(self.blastOptions, chunkID) for chunkID in chunkIDs]
+            jobs += [RunBlast(self.blastOptions, chunkIDs[i], chunkIDs[j])
+                     for i in range(len(chunkIDs)) for j in range(i+1, len(chunkIDs))]
+            return runBlastsLocally(fileStore, jobs, self.cores, self.memory)
+        chunkIDs = [writeBlastFile(fileStore, chunk, self.blastOptions, cleanup=True) for chunk in chunks]
+        if self.blastOptions.bundleSeconds > 0 and not self.blastOptions.gpuLastz:
+            blasts = [(i, None) for i in range(len(chunkIDs))]
+            blasts += [(i, j) for i in range(len(chunkIDs)) for j in range(i+1, len(chunkIDs))]
+            return addBlastBundles(self, self.blastOptions, chunkIDs, chunksStats, blasts)
 
         diagonalResultsID = self.addChild(MakeSelfBlasts(self.blastOptions, chunkIDs)).rv()
         offDiagonalResultsID = self.addChild(MakeOffDiagonalBlasts(self.blastOptions, chunkIDs)).rv()
@@ -109,8 +162,6 @@ class MakeSelfBlasts(ChildTreeJob):
 
     def run(self, fileStore):
         logger.info("Chunk IDs: %s" % self.chunkIDs)
-        #Avoid compression if just one chunk
-        self.blastOptions.compressFiles = self.blastOptions.compressFiles and len(self.chunkIDs) > 2
         resultsIDs = []
         for i in range(len(self.chunkIDs)):
             resultsIDs.append(self.addChild(RunSelfBlast(self.blastOptions, self.chunkIDs[i])).rv())
@@ -125,7 +176,6 @@ class MakeOffDiagonalBlasts(ChildTreeJob):
             super(MakeOffDiagonalBlasts, self).__init__(preemptable=True)
             self.chunkIDs = chunkIDs
             self.blastOptions = blastOptions
-            self.blastOptions.compressFiles = False
 
         def run(self, fileStore):
             resultsIDs = []
@@ -141,7 +191,7 @@ class BlastSequencesAgainstEachOther(ChildTreeJob):
     """
     def __init__(self, sequenceFileIDs1, sequenceFileIDs2, blastOptions):
         disk = 3*(sum([seqID.size for seqID in sequenceFileIDs1]) + sum([seqID.size for seqID in sequenceFileIDs2]))
-        cores = 1
+        cores = getPoolCores(sum([seqID.size for seqID in sequenceFileIDs1 + sequenceFileIDs2]), 1)
         memory = blastOptions.memory
 
         super(BlastSequencesAgainstEachOther, self).__init__(disk=disk, cores=cores, memory=memory, preemptable=True)
@@ -156,16 +206,30 @@ class BlastSequencesAgainstEachOther(ChildTreeJob):
         if self.blastOptions.gpuLastz == True:
             # wga-gpu has a 6G limit. 
             self.blastOptions.chunkSize = 6000000000
-        chunks1 = runGetChunks(sequenceFiles=sequenceFiles1, chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()), chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        chunks2 = runGetChunks(sequenceFiles=sequenceFiles2, chunksDir=getTempDirectory(rootDir=fileStore.getLocalTempDir()), chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
-        chunkIDs1 = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks1]
-        chunkIDs2 = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in chunks2]
+        chunksDir1 = getTempDirectory(rootDir=fileStore.getLocalTempDir())
+        chunksDir2 = getTempDirectory(rootDir=fileStore.getLocalTempDir())
+        chunks1 = runGetChunks(sequenceFiles=sequenceFiles1, chunksDir=chunksDir1, chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
+        chunks2 = runGetChunks(sequenceFiles=sequenceFiles2, chunksDir=chunksDir2, chunkSize=self.blastOptions.chunkSize, overlapSize=self.blastOptions.overlapSize)
+        numBlasts = len(chunks1) * len(chunks2)
+        chunks1, chunksStats1 = pruneChunks(chunks1, getChunksStats(chunks1, chunksDir1), self.blastOptions, chunksDir1)
+        chunks2, chunksStats2 = pruneChunks(chunks2, getChunksStats(chunks2, chunksDir2), self.blastOptions, chunksDir2)
+        reportSavedBlasts(fileStore, numBlasts, len(chunks1) * len(chunks2))
+        if len(chunks1) == 0 or len(chunks2) == 0:
+            return fileStore.writeGlobalFile(fileStore.getLocalTempFile())
+        if useLocalTurbo(sum([seqID.size for seqID in self.sequenceFileIDs1 + self.sequenceFileIDs2])):
+            jobs = [RunBlast(self.blastOptions, LocalFileID(chunk1), LocalFileID(chunk2))
+                    for chunk1 in chunks1 for chunk2 in chunks2]
+            return runBlastsLocally(fileStore, jobs, self.cores, self.memory)
+        chunkIDs1 = [writeBlastFile(fileStore, chunk, self.blastOptions, cleanup=True) for chunk in chunks1]
+        chunkIDs2 = [writeBlastFile(fileStore, chunk, self.blastOptions, cleanup=True) for chunk in chunks2]
+        if self.blastOptions.bundleSeconds > 0 and not self.blastOptions.gpuLastz:
+            blasts = [(i, len(chunkIDs1) + j) for i in range(len(chunkIDs1)) for j in range(len(chunkIDs2))]
+            return addBlastBundles(self, self.blastOptions, chunkIDs1 + chunkIDs2,
+                                   chunksStats1 + chunksStats2, blasts)
         resultsIDs = []
         #Make the list of blast jobs.
         for chunkID1 in chunkIDs1:
             for chunkID2 in chunkIDs2:
-                #TODO: Make the compression work
-                self.blastOptions.compressFiles = False
                 resultsIDs.append(self.addChild(RunBlast(self.blastOptions, chunkID1, chunkID2)).rv())
         logger.info("Made the list of blasts")
         #Set up the job to collate all the results
@@ -209,7 +273,14 @@ class BlastIngroupsAndOutgroups(RoundedJob):
             outgroupAlignmentsID = blastFirstOutgroupJob.rv(0)
             outgroupFragmentIDs = blastFirstOutgroupJob.rv(1)
             ingroupCoverageIDs = blastFirstOutgroupJob.rv(2)
-            alignmentsID = self.addFollowOn(CollateBlasts(blastOptions=self.blastOptions, resultsFileIDs=[ingroupAlignmentsID, outgroupAlignmentsID])).rv()
+            alignmentsID = self.addFollowOn(CollateBlasts(blastOptions=self.blastOptions, resultsFileIDs=[ingroupAlignmentsID, outgroupAlignmentsID],
+                                                          decompress=True, dedupOverlaps=self.blastOptions.dedupOverlaps)).rv()
+        elif self.blastOptions.compressFiles or self.blastOptions.dedupOverlaps:
+            # The alignments leave the blast phase unzipped
+            alignmentsID = self.addFollowOn(CollateBlasts(blastOptions=self.blastOptions, resultsFileIDs=[ingroupAlignmentsID],
+                                                          decompress=True, dedupOverlaps=self.blastOptions.dedupOverlaps)).rv()
+            outgroupFragmentIDs = []
+            ingroupCoverageIDs = []
         else:
             alignmentsID = ingroupAlignmentsID
             outgroupFragmentIDs = []
@@ -285,7 +356,7 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
         # outgroup fragments dir
 
         outgroupSequenceFiles = [fileStore.readGlobalFile(fileID) for fileID in self.outgroupSequenceIDs]
-        mostRecentResultsFile = fileStore.readGlobalFile(self.mostRecentResultsID)
+        mostRecentResultsFile = readBlastFile(fileStore, self.mostRecentResultsID)
         trimmedOutgroup = fileStore.getLocalTempFile()
         outgroupCoverage = fileStore.getLocalTempFile()
         calculateCoverage(outgroupSequenceFiles[0],
@@ -327,15 +398,12 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
                                     ingroupConvertedResultsFile,
                                     "1"])
         # Append the latest results to the accumulated outgroup coverage file
-        if self.outgroupResultsID:
-            outgroupResultsFile = fileStore.readGlobalFile(self.outgroupResultsID, mutable=True)
-        else:
-            outgroupResultsFile = fileStore.getLocalTempFile()
-        with open(ingroupConvertedResultsFile) as results:
-            with open(outgroupResultsFile, 'a') as output:
-                output.write(results.read())
-
-        self.outgroupResultsID = fileStore.writeGlobalFile(outgroupResultsFile)
+        if self.blastOptions.compressFiles:
+            ingroupConvertedResultsFile = compressFastaFile(ingroupConvertedResultsFile)
+        self.outgroupResultsID = concatenateGlobalFiles(fileStore,
+                                                        [self.outgroupResultsID] if self.outgroupResultsID else [],
+                                                        localFiles=[ingroupConvertedResultsFile])
+        outgroupResultsFile = readBlastFile(fileStore, self.outgroupResultsID)
 
         # Report coverage of the all outgroup alignments so far on the ingroups.
         ingroupCoverageFiles = []
@@ -386,24 +454,50 @@ class TrimAndRecurseOnOutgroups(RoundedJob):
             # Finally, put the ingroups and outgroups results together
             return (self.outgroupResultsID, self.outgroupFragmentIDs, self.ingroupCoverageIDs)
 
+# Rough factor by which gzip shrinks chunks and cigars, to size the jobs
+# on compressed files by
+COMPRESSION_RATIO = 4
+
 def compressFastaFile(fileName):
-    """Compress a fasta file.
+    """Gzip a fasta (or cigar) file, compressing blocks in parallel, keeping the
+    original. Returns the name of the compressed file.
     """
-    system("bzip2 --keep --fast %s" % fileName)
-    return fileName + ".bz2"
+    with open(fileName, 'rb') as inFile, open(fileName + ".gz", 'wb') as outFile:
+        compressStream(inFile, outFile)
+    return fileName + ".gz"
 
 def decompressFastaFile(fileName, tempFileName):
-    """Copies the file from the central dir to a temporary file, returning the temp file name.
+    """Gunzips the file to a temporary file, returning the temp file name.
     """
-    system("bunzip2 --stdout %s > %s" % (fileName, tempFileName))
+    with open(fileName, 'rb') as inFile, open(tempFileName, 'wb') as outFile:
+        decompressStream(inFile, outFile)
     return tempFileName
 
+def writeBlastFile(fileStore, fileName, blastOptions, cleanup=False):
+    """Write a chunk or blast results to the job store, gzipped if
+    compressFiles is set."""
+    if blastOptions.compressFiles:
+        fileName = compressFastaFile(fileName)
+    return fileStore.writeGlobalFile(fileName, cleanup=cleanup)
+
+def readBlastFile(fileStore, fileID):
+    """Read a chunk or blast results from the job store, gunzipping them if
+    they were gzipped."""
+    fileName = fileStore.readGlobalFile(fileID)
+    if isGzipped(fileName):
+        fileName = decompressFastaFile(fileName, fileStore.getLocalTempFile())
+    return fileName
+
+def getUncompressedSize(fileID, blastOptions):
+    """Estimate the size of a chunk or blast results once unzipped."""
+    return fileID.size * COMPRESSION_RATIO if blastOptions.compressFiles else fileID.size
+
 class RunSelfBlast(RoundedJob):
     """Runs blast as a job.
     """
     def __init__(self, blastOptions, seqFileID):
-        disk = 3*seqFileID.size
-        memory = 3*seqFileID.size
+        disk = 3*getUncompressedSize(seqFileID, blastOptions)
+        memory = 3*getUncompressedSize(seqFileID, blastOptions)
         if blastOptions.gpuLastz:
             # gpu jobs get the whole node
             cores = cpu_count()
@@ -414,34 +508,42 @@ class RunSelfBlast(RoundedJob):
         self.seqFileID = seqFileID
 
     def run(self, fileStore):
-        blastResultsFile = fileStore.getLocalTempFile()
-        seqFile = fileStore.readGlobalFile(self.seqFileID)
-        runSelfLastz(seqFile, blastResultsFile, lastzArguments=self.blastOptions.lastzArguments,
-                     gpuLastz = self.blastOptions.gpuLastz)
-        if self.blastOptions.realign:
-            realignResultsFile = fileStore.getLocalTempFile()
-            runCactusSelfRealign(seqFile, inputAlignmentsFile=blastResultsFile,
-                                 outputAlignmentsFile=realignResultsFile,
-                                 realignArguments=self.blastOptions.realignArguments)
-            blastResultsFile = realignResultsFile
-        resultsFile = fileStore.getLocalTempFile()
-        cactus_call(parameters=["cactus_blast_convertCoordinates",
-                                blastResultsFile,
-                                resultsFile,
-                                str(self.blastOptions.roundsOfCoordinateConversion)])
-        if self.blastOptions.compressFiles:
-            #TODO: This throws away the compressed file
-            seqFile = compressFastaFile(seqFile)
-        logger.info("Ran the self blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        with ContainerSession(fileStore.localTempDir, fileStore=fileStore):
+            seqFile = readBlastFile(fileStore, self.seqFileID)
+            cache = getBlastCache()
+            if cache is not None:
+                key = getBlastKey(self.blastOptions, seqFile)
+                resultsFile = fileStore.getLocalTempFile()
+                if cache.get(key, resultsFile):
+                    logger.info("Found the self blast in the cache")
+                    return writeBlastFile(fileStore, resultsFile, self.blastOptions)
+            blastResultsFile = fileStore.getLocalTempFile()
+            runSelfLastz(seqFile, blastResultsFile, lastzArguments=self.blastOptions.lastzArguments,
+                         gpuLastz = self.blastOptions.gpuLastz)
+            if self.blastOptions.realign:
+                realignResultsFile = fileStore.getLocalTempFile()
+                runCactusSelfRealign(seqFile, inputAlignmentsFile=blastResultsFile,
+                                     outputAlignmentsFile=realignResultsFile,
+                                     realignArguments=self.blastOptions.realignArguments)
+                blastResultsFile = realignResultsFile
+            resultsFile = fileStore.getLocalTempFile()
+            cactus_call(parameters=["cactus_blast_convertCoordinates",
+                                    blastResultsFile,
+                                    resultsFile,
+                                    str(self.blastOptions.roundsOfCoordinateConversion)])
+            if cache is not None:
+                cache.put(key, resultsFile)
+            logger.info("Ran the self blast okay")
+            return writeBlastFile(fileStore, resultsFile, self.blastOptions)
 
 class RunBlast(RoundedJob):
     """Runs blast as a job.
     """
     def __init__(self, blastOptions, seqFileID1, seqFileID2):
         if hasattr(seqFileID1, "size") and hasattr(seqFileID2, "size"):
-            disk = 2*(seqFileID1.size + seqFileID2.size)
-            memory = 2*(seqFileID1.size + seqFileID2.size)
+            size = getUncompressedSize(seqFileID1, blastOptions) + getUncompressedSize(seqFileID2, blastOptions)
+            disk = 2*size
+            memory = 2*size
         else:
             disk = None
             memory = None
@@ -456,60 +558,302 @@ class RunBlast(RoundedJob):
         self.seqFileID2 = seqFileID2
 
     def run(self, fileStore):
-        seqFile1 = fileStore.readGlobalFile(self.seqFileID1)
-        seqFile2 = fileStore.readGlobalFile(self.seqFileID2)
-        if self.blastOptions.compressFiles:
-            seqFile1 = decompressFastaFile(seqFile1, fileStore.getLocalTempFile())
-            seqFile2 = decompressFastaFile(seqFile2, fileStore.getLocalTempFile())
-        blastResultsFile = fileStore.getLocalTempFile()
-        runLastz(seqFile1, seqFile2, blastResultsFile, lastzArguments = self.blastOptions.lastzArguments,
-                 gpuLastz = self.blastOptions.gpuLastz)
-        if self.blastOptions.realign:
-            realignResultsFile = fileStore.getLocalTempFile()
-            runCactusRealign(seqFile1, seqFile2, inputAlignmentsFile=blastResultsFile,
-                             outputAlignmentsFile=realignResultsFile,
-                             realignArguments=self.blastOptions.realignArguments)
-            blastResultsFile = realignResultsFile
-
-        resultsFile = fileStore.getLocalTempFile()
-        cactus_call(parameters=["cactus_blast_convertCoordinates",
-                                blastResultsFile,
-                                resultsFile,
-                                str(self.blastOptions.roundsOfCoordinateConversion)])
-        logger.info("Ran the blast okay")
-        return fileStore.writeGlobalFile(resultsFile)
+        with ContainerSession(fileStore.localTempDir, fileStore=fileStore):
+            seqFile1 = readBlastFile(fileStore, self.seqFileID1)
+            seqFile2 = readBlastFile(fileStore, self.seqFileID2)
+            cache = getBlastCache()
+            if cache is not None:
+                key = getBlastKey(self.blastOptions, seqFile1, seqFile2)
+                resultsFile = fileStore.getLocalTempFile()
+                if cache.get(key, resultsFile):
+                    logger.info("Found the blast in the cache")
+                    return writeBlastFile(fileStore, resultsFile, self.blastOptions)
+            blastResultsFile = fileStore.getLocalTempFile()
+            runLastz(seqFile1, seqFile2, blastResultsFile, lastzArguments = self.blastOptions.lastzArguments,
+                     gpuLastz = self.blastOptions.gpuLastz)
+            if self.blastOptions.realign:
+                realignResultsFile = fileStore.getLocalTempFile()
+                runCactusRealign(seqFile1, seqFile2, inputAlignmentsFile=blastResultsFile,
+                                 outputAlignmentsFile=realignResultsFile,
+                                 realignArguments=self.blastOptions.realignArguments)
+                blastResultsFile = realignResultsFile
+
+            resultsFile = fileStore.getLocalTempFile()
+            cactus_call(parameters=["cactus_blast_convertCoordinates",
+                                    blastResultsFile,
+                                    resultsFile,
+                                    str(self.blastOptions.roundsOfCoordinateConversion)])
+            if cache is not None:
+                cache.put(key, resultsFile)
+            logger.info("Ran the blast okay")
+            return writeBlastFile(fileStore, resultsFile, self.blastOptions)
+
+def getChunkStats(chunkFile):
+    """Get the stats of a chunk, as in the manifest of runGetChunks: its
+    length, unmasked bases (upper case other than N), Ns and Gs or Cs."""
+    stats = {"length": 0, "unmasked": 0, "n": 0, "gc": 0}
+    with open(chunkFile, 'rb') as fileHandle:
+        for line in fileHandle:
+            if line.startswith(b'>'):
+                continue
+            line = line.rstrip()
+            stats["length"] += len(line)
+            stats["unmasked"] += len(line.translate(None, _maskedBases))
+            stats["n"] += line.count(b'N') + line.count(b'n')
+            stats["gc"] += len(line) - len(line.translate(None, b"GCgc"))
+    return stats
+
+_maskedBases = string.ascii_lowercase.encode() + b"N"
+
+def getChunksStats(chunks, chunksDir):
+    """Get the stats of chunks made by runGetChunks in chunksDir, from its
+    manifest, or from the chunks themselves if it didn't write one."""
+    manifest = readChunkManifest(chunksDir)
+    return [manifest.get(os.path.basename(chunk)) or getChunkStats(chunk) for chunk in chunks]
+
+def pruneChunks(chunks, chunksStats, blastOptions, chunksDir):
+    """Leave out the chunks without any unmasked bases, as lastz only seeds
+    alignments on unmasked bases, and merge those with fewer than
+    minimumChunkUnmaskedBases into chunks (in chunksDir) of up to chunkSize
+    bases, so that they take fewer blasts. Returns the chunks left, and
+    their stats."""
+    if blastOptions.minimumChunkUnmaskedBases <= 0 or blastOptions.gpuLastz or \
+       "unmask" in (blastOptions.lastzArguments or ""):
+        return chunks, chunksStats
+    keptChunks = []
+    keptStats = []
+    mergedChunks = []
+    dropped = 0
+    for chunk, stats in zip(chunks, chunksStats):
+        if stats["unmasked"] >= blastOptions.minimumChunkUnmaskedBases:
+            keptChunks.append(chunk)
+            keptStats.append(stats)
+        elif stats["unmasked"] == 0:
+            dropped += 1
+        else:
+            if len(mergedChunks) == 0 or mergedChunks[-1][1]["length"] + stats["length"] > blastOptions.chunkSize:
+                mergedChunks.append(([], {"length": 0, "unmasked": 0, "n": 0, "gc": 0}))
+            mergedChunks[-1][0].append(chunk)
+            for key in stats:
+                mergedChunks[-1][1][key] += stats[key]
+    for i, (toMerge, stats) in enumerate(mergedChunks):
+        mergedChunk = os.path.join(chunksDir, "merged%i" % i)
+        catFiles(toMerge, mergedChunk)
+        keptChunks.append(mergedChunk)
+        keptStats.append(stats)
+    logger.info("Left out %i chunks with no unmasked bases and merged %i into %i" %
+                (dropped, sum([len(toMerge) for toMerge, stats in mergedChunks]), len(mergedChunks)))
+    return keptChunks, keptStats
+
+def reportSavedBlasts(fileStore, numBlasts, numBlastsLeft):
+    if numBlastsLeft < numBlasts:
+        fileStore.logToMaster("Saved %i of %i blasts by leaving out or merging chunks with few unmasked bases" %
+                              (numBlasts - numBlastsLeft, numBlasts))
+
+def estimateBlastCost(chunkStats1, chunkStats2, basesSquaredPerSecond):
+    """Estimate the seconds that blasting two chunks, given their stats, takes
+    (or blasting the first against itself if chunkStats2 is None). Lastz only
+    seeds on unmasked bases, so it takes time in proportion to the product
+    of the unmasked lengths."""
+    unmasked1 = chunkStats1["unmasked"]
+    if chunkStats2 is None:
+        # Only one half of the matrix is aligned
+        return unmasked1 * unmasked1 / 2.0 / basesSquaredPerSecond
+    return unmasked1 * chunkStats2["unmasked"] / float(basesSquaredPerSecond)
+
+def bundleBlasts(costs, targetCost):
+    """Pack blasts with the given costs into bundles costing up to targetCost
+    (a blast costing more gets one of its own), by first fit decreasing.
+    Returns the bundles, as lists of indices into costs, costliest first."""
+    bundles = []
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        for bundle in bundles:
+            if bundle[0] + costs[i] <= targetCost:
+                bundle[0] += costs[i]
+                bundle[1].append(i)
+                break
+        else:
+            bundles.append([costs[i], [i]])
+    bundles.sort(key=lambda bundle: -bundle[0])
+    return [indices for cost, indices in bundles]
+
+def addBlastBundles(job, blastOptions, chunkIDs, chunkStats, blasts):
+    """Add the blasts, as (chunk index, chunk index) pairs, with None as the
+    second for a self blast, to the job as RunBlastBundle children, and a
+    follow-on to collate their results, returning its promise. Each bundle
+    should take bundleSeconds on bundleCores. The costliest bundles are
+    added first, so that Toil issues them first and they don't hold up the
+    end of the blast phase."""
+    costs = [estimateBlastCost(chunkStats[i], chunkStats[j] if j is not None else None,
+                               blastOptions.lastzBasesSquaredPerSecond) for i, j in blasts]
+    resultsIDs = []
+    for bundle in bundleBlasts(costs, blastOptions.bundleSeconds * blastOptions.bundleCores):
+        pairs = [(chunkIDs[blasts[k][0]], chunkIDs[blasts[k][1]] if blasts[k][1] is not None else None)
+                 for k in bundle]
+        resultsIDs.append(job.addChild(RunBlastBundle(blastOptions, pairs)).rv())
+    logger.info("Bundled %i blasts into %i jobs" % (len(blasts), len(resultsIDs)))
+    return job.addFollowOn(CollateBlasts(blastOptions, resultsIDs)).rv()
+
+class RunBlastBundle(RoundedJob):
+    """Runs a bundle of blasts, as pairs of chunk IDs (with None as the second
+    for a self blast), bundleCores at a time, returning their collated
+    results.
+    """
+    def __init__(self, blastOptions, pairs):
+        seqFileIDs = set([seqFileID for pair in pairs for seqFileID in pair if seqFileID is not None])
+        sizes = dict([(seqFileID, getUncompressedSize(seqFileID, blastOptions)) for seqFileID in seqFileIDs])
+        disk = 3*sum(sizes.values())
+        # Enough memory for the biggest blasts to run at once
+        memories = sorted([3*sizes[seqFileID1] if seqFileID2 is None else 2*(sizes[seqFileID1] + sizes[seqFileID2])
+                           for seqFileID1, seqFileID2 in pairs], reverse=True)
+        memory = sum(memories[:blastOptions.bundleCores])
+        super(RunBlastBundle, self).__init__(memory=memory, disk=disk, cores=blastOptions.bundleCores,
+                                             preemptable=True)
+        self.blastOptions = blastOptions
+        self.pairs = pairs
+
+    def run(self, fileStore):
+        seqFiles = {}
+        for pair in self.pairs:
+            for seqFileID in pair:
+                if seqFileID is not None and seqFileID not in seqFiles:
+                    seqFiles[seqFileID] = LocalFileID(readBlastFile(fileStore, seqFileID))
+        jobs = [RunSelfBlast(self.blastOptions, seqFiles[seqFileID1]) if seqFileID2 is None else
+                RunBlast(self.blastOptions, seqFiles[seqFileID1], seqFiles[seqFileID2])
+                for seqFileID1, seqFileID2 in self.pairs]
+        return runBlastsLocally(fileStore, jobs, self.cores, self.memory)
+
+def runBlastsLocally(fileStore, jobs, cores, memory):
+    """Run blast jobs in the local pool, rather than as jobs of their own,
+    with the given cores and memory, returning the ID of their collated
+    results."""
+    resultsFiles = runJobs(jobs, fileStore, cores, memory)
+    collatedResultsFile = fileStore.getLocalTempFile()
+    catFiles(resultsFiles, collatedResultsFile)
+    logger.info("Ran %i blasts in the local pool" % len(jobs))
+    return fileStore.writeGlobalFile(collatedResultsFile)
 
 class CollateBlasts(RoundedJob):
-    def __init__(self, blastOptions, resultsFileIDs):
+    def __init__(self, blastOptions, resultsFileIDs, decompress=False, dedupOverlaps=False):
         super(CollateBlasts, self).__init__(preemptable=True)
         self.blastOptions = blastOptions
         self.resultsFileIDs = resultsFileIDs
+        self.decompress = decompress
+        self.dedupOverlaps = dedupOverlaps
 
     def run(self, fileStore):
-        return self.addFollowOn(CollateBlasts2(self.blastOptions, self.resultsFileIDs)).rv()
+        return self.addFollowOn(CollateBlasts2(self.blastOptions, self.resultsFileIDs, self.decompress,
+                                               self.dedupOverlaps)).rv()
 
 class CollateBlasts2(ChildTreeJob):
-    """Collates all the blasts into a single alignments file.
+    """Collates all the blasts into a single alignments file. Gzipped results
+    are collated into a gzipped file (as gzip files can be concatenated),
+    unless decompress is set, in which case they are gunzipped as they are
+    collated.
+
+    More than collateFanIn results are collated as a tree: children collate
+    groups of at most collateFanIn results, and a follow-on collates their
+    collations, so no one job has to stream all of them.
+
+    If dedupOverlaps is set, the collated alignments are then deduplicated
+    by DedupOverlapAlignments.
     """
-    def __init__(self, blastOptions, resultsFileIDs):
-        disk = 8*sum([alignmentID.size for alignmentID in resultsFileIDs])
+    def __init__(self, blastOptions, resultsFileIDs, decompress=False, dedupOverlaps=False):
+        assert blastOptions.collateFanIn > 1
+        if len(resultsFileIDs) > blastOptions.collateFanIn:
+            # Only adds the children
+            disk = None
+        else:
+            disk = 8*sum([getUncompressedSize(alignmentID, blastOptions) if decompress else alignmentID.size
+                          for alignmentID in resultsFileIDs])
         memory = blastOptions.memory
         super(CollateBlasts2, self).__init__(memory=memory, disk=disk, preemptable=True)
+        self.blastOptions = blastOptions
         self.resultsFileIDs = resultsFileIDs
+        self.decompress = decompress
+        self.dedupOverlaps = dedupOverlaps
         # it's slow to run fileStore.deleteGlobalFile, so we do it in parallel batches
         self.delete_batch_size = 1000
 
     def run(self, fileStore):
+        fanIn = self.blastOptions.collateFanIn
+        if len(self.resultsFileIDs) > fanIn:
+            partIDs = [self.addChild(CollateBlasts2(self.blastOptions, group)).rv()
+                       for group in groupForFanIn(self.resultsFileIDs, fanIn)]
+            logger.info("Collating %i results in %i groups" % (len(self.resultsFileIDs), len(partIDs)))
+            return self.addFollowOn(CollateBlasts(self.blastOptions, partIDs, decompress=self.decompress,
+                                                  dedupOverlaps=self.dedupOverlaps)).rv()
         logger.info("Results IDs: %s" % self.resultsFileIDs)
-        resultsFiles = [readGlobalFileWithoutCache(fileStore, fileID) for fileID in self.resultsFileIDs]
-        collatedResultsFile = fileStore.getLocalTempFile()
-        catFiles(resultsFiles, collatedResultsFile)
-        logger.info("Collated the alignments to the file: %s",  collatedResultsFile)
-        collatedResultsID = fileStore.writeGlobalFile(collatedResultsFile)
+        collatedResultsID = collateResultsFiles(fileStore, self.resultsFileIDs, self.blastOptions,
+                                                decompress=self.decompress)
+        logger.info("Collated the alignments to the file: %s",  collatedResultsID)
         for i in range(0, len(self.resultsFileIDs), self.delete_batch_size):
             self.addChild(DeleteFileIDs(self.resultsFileIDs[i:i+self.delete_batch_size]))        
+        if self.dedupOverlaps:
+            return self.addFollowOn(DedupOverlapAlignments(self.blastOptions, collatedResultsID)).rv()
         return collatedResultsID
 
+def collateResultsFiles(fileStore, resultsFileIDs, blastOptions, decompress=False):
+    """Collate blast results in the job store into one file in the job store,
+    streaming them, and return its ID. If collateDedup is set, alignments
+    that are identical to one already collated (as the same alignment found
+    in the overlap of two chunks is) are left out. This keeps a hash of each
+    alignment in memory.
+    """
+    if not blastOptions.collateDedup:
+        return concatenateGlobalFiles(fileStore, resultsFileIDs, decompress=decompress)
+    compress = blastOptions.compressFiles and not decompress
+    seen = set()
+    numAlignments = 0
+    with fileStore.writeGlobalFileStream() as (outStream, outID):
+        outFile = gzip.GzipFile(fileobj=outStream, mode='wb', compresslevel=1) if compress else outStream
+        for fileID in resultsFileIDs:
+            # Read straight from the job store, as concatenateGlobalFiles
+            # does, rather than through the cache
+            path = fileStore.getLocalTempFileName()
+            fileStore.jobStore.readFile(fileID, path, symlink=True)
+            with (gzip.open(path, 'rb') if isGzipped(path) else open(path, 'rb')) as inFile:
+                for line in inFile:
+                    numAlignments += 1
+                    digest = hashlib.blake2b(line, digest_size=16).digest()
+                    if digest not in seen:
+                        seen.add(digest)
+                        outFile.write(line)
+            os.remove(path)
+        if compress:
+            outFile.close()
+    if len(seen) < numAlignments:
+        fileStore.logToMaster("Left out %i duplicate alignments of %i while collating blast results" %
+                              (numAlignments - len(seen), numAlignments))
+    return outID
+
+class DedupOverlapAlignments(RoundedJob):
+    """Leaves out the alignments identical to, or contained in, another once
+    their coordinates are converted, as those found by more than one pair
+    of chunks in their overlaps are, and reports how many alignments, and
+    bytes of input to cactus_caf, this saves.
+    """
+    def __init__(self, blastOptions, alignmentsID):
+        # The alignments are collated unzipped
+        disk = 4*alignmentsID.size
+        super(DedupOverlapAlignments, self).__init__(memory=blastOptions.memory, disk=disk, preemptable=True)
+        self.blastOptions = blastOptions
+        self.alignmentsID = alignmentsID
+
+    def run(self, fileStore):
+        alignmentsFile = readBlastFile(fileStore, self.alignmentsID)
+        dedupedFile = fileStore.getLocalTempFile()
+        with ContainerSession(fileStore.localTempDir, fileStore=fileStore):
+            stats = dedupAlignments(alignmentsFile, dedupedFile, fileStore.getLocalTempDir())
+        fileStore.logToMaster("Left out %i of %i alignments repeated in chunk overlaps (%.1f%%), "
+                              "shrinking the alignments input to cactus_caf from %i to %i bytes (%.1f%%)" % (
+                                  stats["alignments"] - stats["alignmentsKept"], stats["alignments"],
+                                  100.0 * (stats["alignments"] - stats["alignmentsKept"]) / max(1, stats["alignments"]),
+                                  stats["bytes"], stats["bytesKept"],
+                                  100.0 * (stats["bytes"] - stats["bytesKept"]) / max(1, stats["bytes"])))
+        fileStore.deleteGlobalFile(self.alignmentsID)
+        return fileStore.writeGlobalFile(dedupedFile)
+
 class DeleteFileIDs(RoundedJob):
     """Deletes some files from the file store
     """
@@ -536,12 +880,13 @@ def percentCoverage(sequenceFile, coverageFile):
     sequenceLen = sequenceLength(sequenceFile)
     if sequenceLen == 0:
         return 0
-    coverage = popenCatch("awk '{ total += $3 - $2 } END { print total }' %s" % coverageFile)
-    if coverage.strip() == '': # No coverage lines
-        return 0
+    with open(coverageFile) as bedFile:
+        coverage = sum(end - start for contig, start, end, fields in readBed(bedFile))
     return 100*float(coverage)/sequenceLen
 
-def calculateCoverage(sequenceFile, cigarFile, outputFile, fromGenome=None, depthById=False, work_dir=None):
+def calculateCoverage(sequenceFile, cigarFile, outputFile, fromGenome=None, depthById=False, work_dir=None, job=None):
+    """If job is given, the coverage is computed with cactus_call_async and a
+    Future for it is returned."""
     logger.info("Calculating coverage of cigar file %s on %s, writing to %s" % (
         cigarFile, sequenceFile, outputFile))
     args = [sequenceFile, cigarFile]
@@ -552,17 +897,13 @@ def calculateCoverage(sequenceFile, cigarFile, outputFile, fromGenome=None, dept
         args += ["--from", fromGenome]
     if depthById:
         args += ["--depthById"]
-    cactus_call(outfile=outputFile, work_dir=work_dir,
-                parameters=["cactus_coverage"] + args)
+    callArgs = dict(outfile=outputFile, work_dir=work_dir,
+                    parameters=["cactus_coverage"] + args)
+    if job is not None:
+        return cactus_call_async(job=job, **callArgs)
+    cactus_call(**callArgs)
 
 def subtractBed(bed1, bed2, destBed):
     """Subtract two non-bed12 beds"""
-    # tmp. don't really want to use bedtools
-    if os.path.getsize(bed1) == 0 or os.path.getsize(bed2) == 0:
-        # bedtools will complain on zero-size beds
-        os.rename(bed1, destBed)
-    else:
-        cactus_call(outfile=destBed,
-                    parameters=["subtract",
-                                "-a", bed1,
-                                "-b", bed2])
+    with open(bed1) as bedFile1, open(bed2) as bedFile2, open(destBed, 'w') as outFile:
+        subtractBedFiles(bedFile1, bedFile2, outFile)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Cache of the results of blasts of pairs of chunks, across runs.
+
+If CACTUS_BLAST_CACHE is set to a directory (shared by the workers, eg on
+a shared filesystem) RunBlast and RunSelfBlast look their results up there
+before running lastz, and add them after. The results are keyed by a hash of
+the contents of the chunks (which include the names and offsets of their
+sequences), the lastz and realign arguments, the rounds of coordinate
+conversion and the version of cactus (its docker image), so only blasts
+whose inputs and tools are the same are reused: those of a restarted run,
+of cactus-blast rerun after a change to the config elsewhere, or of the
+genomes that didn't change in a realigned subtree.
+
+The cache is kept under CACTUS_BLAST_CACHE_MAX_SIZE bytes (10GB by default)
+by removing the entries that were least recently used. Finding those means
+listing the whole cache, so rather than after every blast it is done after
+each 1% or so of the maximum size has been added (at random, as the jobs
+adding results don't know about each other), and the cache can be a little
+over the maximum in between. Each lookup is logged in the cache, and the
+hits and misses can be summarized with cactus-blast-cache. The log is
+rotated when it is evicted from, so only the latest lookups are kept.
+"""
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from cactus.shared.common import getDockerImage
+
+DEFAULT_MAX_SIZE = 10000000000
+
+# Log of the lookups, in the cache dir, and the log before it
+STATS_FILE = "stats.tsv"
+OLD_STATS_FILE = "stats.tsv.1"
+
+def getCacheDir():
+    return os.environ.get("CACTUS_BLAST_CACHE") or None
+
+def getMaxSize():
+    return int(os.environ.get("CACTUS_BLAST_CACHE_MAX_SIZE", DEFAULT_MAX_SIZE))
+
+def getBlastCache():
+    """Get the cache set up by CACTUS_BLAST_CACHE, or None if there isn't one."""
+    cacheDir = getCacheDir()
+    return BlastCache(cacheDir, getMaxSize()) if cacheDir is not None else None
+
+def hashFile(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def getBlastKey(blastOptions, seqFile1, seqFile2=None):
+    """Get the key of the blast of two chunks, or of a chunk against itself
+    if seqFile2 is None, with the given options."""
+    key = [hashFile(seqFile1), hashFile(seqFile2) if seqFile2 is not None else None,
+           blastOptions.lastzArguments, blastOptions.gpuLastz,
+           blastOptions.realignArguments if blastOptions.realign else None,
+           getattr(blastOptions, "roundsOfCoordinateConversion", None),
+           getDockerImage()]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+class BlastCache(object):
+    """Directory of blast results, by key. Entries are written atomically,
+    so any number of jobs can share it."""
+    # Fraction of the maximum size added, on average, between evictions
+    evictFraction = 0.01
+    # Size of the log of lookups (about 100 bytes each) at which it is rotated
+    maxStatsSize = 10000000
+
+    def __init__(self, cacheDir, maxSize=DEFAULT_MAX_SIZE):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def _log(self, outcome, key, size):
+        # Lines this short are appended atomically
+        with open(os.path.join(self.cacheDir, STATS_FILE), 'a') as statsFile:
+            statsFile.write("%f\t%s\t%s\t%i\n" % (time.time(), outcome, key, size))
+
+    def get(self, key, outPath):
+        """Copy the results of the given key to outPath, returning True, or
+        return False if they aren't in the cache."""
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, outPath)
+            # Mark it as recently used
+            os.utime(path)
+        except (IOError, OSError):
+            # Not there, or evicted while we were copying it
+            self._log("miss", key, 0)
+            return False
+        self._log("hit", key, os.path.getsize(outPath))
+        return True
+
+    def put(self, key, resultsFile):
+        """Add the results of the given key, then, now and again, evict
+        entries if the cache is too big."""
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, tempPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        os.close(handle)
+        shutil.copyfile(resultsFile, tempPath)
+        os.replace(tempPath, path)
+        # Evict after each evictFraction of maxSize added, on average
+        size = os.path.getsize(path)
+        if random.random() * self.evictFraction * self.maxSize < size:
+            self.evict()
+
+    def getEntries(self):
+        """Get the (last used time, size, path) of each entry."""
+        entries = []
+        for subDir in os.listdir(self.cacheDir):
+            subDirPath = os.path.join(self.cacheDir, subDir)
+            if not os.path.isdir(subDirPath):
+                continue
+            for name in os.listdir(subDirPath):
+                if name.startswith("."):
+                    # Still being written
+                    continue
+                try:
+                    stat = os.stat(os.path.join(subDirPath, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(subDirPath, name)))
+        return entries
+
+    def evict(self, maxSize=None):
+        """Remove the least recently used entries until the cache is no bigger
+        than maxSize (by default, the cache's). Returns how many were removed."""
+        maxSize = maxSize if maxSize is not None else self.maxSize
+        entries = sorted(self.getEntries())
+        size = sum([entrySize for mtime, entrySize, path in entries])
+        removed = 0
+        for mtime, entrySize, path in entries:
+            if size <= maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another job evicted it
+                pass
+            size -= entrySize
+            removed += 1
+        self.rotateStats()
+        return removed
+
+    def rotateStats(self):
+        """Replace the previous log of lookups with the current one, if it
+        has reached maxStatsSize, so the logs take at most about twice that."""
+        statsPath = os.path.join(self.cacheDir, STATS_FILE)
+        try:
+            if os.path.getsize(statsPath) >= self.maxStatsSize:
+                # Lookups logged from now on start a new log
+                os.replace(statsPath, os.path.join(self.cacheDir, OLD_STATS_FILE))
+        except OSError:
+            # No lookups yet, or another job rotated it
+            pass
+
+    def getStats(self):
+        """Get the hits and misses logged in the current and previous logs,
+        the bytes of results the hits saved computing, and the entries and
+        bytes in the cache."""
+        stats = {"hits": 0, "misses": 0, "hitBytes": 0}
+        for statsFileName in [OLD_STATS_FILE, STATS_FILE]:
+            statsPath = os.path.join(self.cacheDir, statsFileName)
+            if not os.path.exists(statsPath):
+                continue
+            with open(statsPath) as statsFile:
+                for line in statsFile:
+                    fields = line.split()
+                    if len(fields) != 4:
+                        continue
+                    if fields[1] == "hit":
+                        stats["hits"] += 1
+                        stats["hitBytes"] += int(fields[3])
+                    else:
+                        stats["misses"] += 1
+        entries = self.getEntries()
+        stats["entries"] = len(entries)
+        stats["size"] = sum([entrySize for mtime, entrySize, path in entries])
+        return stats
+
+def main():
+    parser = ArgumentParser(description="Summarize, or shrink, a cache of blast results (CACTUS_BLAST_CACHE)")
+    parser.add_argument("cacheDir", help="Cache directory")
+    parser.add_argument("--maxSize", type=int, default=None,
+                        help="Remove the least recently used results until the cache is no bigger than this (bytes)")
+    options = parser.parse_args()
+
+    cache = BlastCache(options.cacheDir)
+    if options.maxSize is not None:
+        print("Removed %i results" % cache.evict(options.maxSize))
+    stats = cache.getStats()
+    lookups = stats["hits"] + stats["misses"]
+    print("Lookups\t%i" % lookups)
+    print("Hits\t%i\t(%.1f%%)" % (stats["hits"], 100.0 * stats["hits"] / lookups if lookups > 0 else 0.0))
+    print("Misses\t%i" % stats["misses"])
+    print("Hit bytes\t%i" % stats["hitBytes"])
+    print("Entries\t%i" % stats["entries"])
+    print("Size\t%i" % stats["size"])
+
+if __name__ == '__main__':
+    main()
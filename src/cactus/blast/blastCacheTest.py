@@ -0,0 +1,109 @@
+"""Tests the cache of blast results
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from cactus.blast.blast import BlastOptions
+from cactus.blast.blastCache import BlastCache, getBlastKey
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tempDir, "cache")
+        os.mkdir(self.cacheDir)
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def makeFile(self, name, contents):
+        path = os.path.join(self.tempDir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def testGetBlastKey(self):
+        chunk1 = self.makeFile("chunk1.fa", ">a|0\nACGTACGT\n")
+        chunk2 = self.makeFile("chunk2.fa", ">b|0\nTTGGCCAA\n")
+        chunk1Copy = self.makeFile("other.fa", ">a|0\nACGTACGT\n")
+        options = BlastOptions(lastzArguments="--step=2")
+        options.roundsOfCoordinateConversion = 2
+        key = getBlastKey(options, chunk1, chunk2)
+        # Keyed by what's in the chunks, not where they are
+        self.assertEqual(key, getBlastKey(options, chunk1Copy, chunk2))
+        self.assertNotEqual(key, getBlastKey(options, chunk2, chunk1))
+        self.assertNotEqual(key, getBlastKey(options, chunk1))
+        otherOptions = BlastOptions(lastzArguments="--step=3")
+        otherOptions.roundsOfCoordinateConversion = 2
+        self.assertNotEqual(key, getBlastKey(otherOptions, chunk1, chunk2))
+        options.roundsOfCoordinateConversion = 1
+        self.assertNotEqual(key, getBlastKey(options, chunk1, chunk2))
+
+    def testGetAndPut(self):
+        cache = BlastCache(self.cacheDir)
+        outPath = os.path.join(self.tempDir, "out.cigar")
+        self.assertFalse(cache.get("ab12", outPath))
+        cache.put("ab12", self.makeFile("results.cigar", "cigar: a 0 8 + b 0 8 + 10 M 8\n"))
+        self.assertTrue(cache.get("ab12", outPath))
+        with open(outPath) as f:
+            self.assertEqual(f.read(), "cigar: a 0 8 + b 0 8 + 10 M 8\n")
+        stats = cache.getStats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+        self.assertEqual(stats["hitBytes"], stats["size"])
+
+    def testEvict(self):
+        cache = BlastCache(self.cacheDir, maxSize=30)
+        for i, key in enumerate(["aa1", "bb2", "cc3"]):
+            cache.put(key, self.makeFile("results%i.cigar" % i, "x" * 10))
+            # Make aa1 the most recently used, then bb2
+            path = os.path.join(self.cacheDir, key[:2], key)
+            os.utime(path, (time.time() - 100 * i, time.time() - 100 * i))
+        # Adding a result evicts the least recently used
+        cache.put("dd4", self.makeFile("results3.cigar", "x" * 10))
+        outPath = os.path.join(self.tempDir, "out.cigar")
+        self.assertEqual([cache.get(key, outPath) for key in ["aa1", "bb2", "cc3", "dd4"]],
+                         [True, True, False, True])
+        self.assertEqual(cache.evict(0), 3)
+        self.assertEqual(cache.getStats()["entries"], 0)
+
+    def testEvictNowAndAgain(self):
+        # A small result is only rarely followed by listing a big cache
+        cache = BlastCache(self.cacheDir, maxSize=1000000)
+        with patch.object(cache, "evict") as evict:
+            with patch("random.random", return_value=0.5):
+                cache.put("aa1", self.makeFile("results.cigar", "x" * 10))
+            self.assertFalse(evict.called)
+            with patch("random.random", return_value=0.0001):
+                cache.put("bb2", self.makeFile("results.cigar", "x" * 10))
+            self.assertTrue(evict.called)
+
+    def testRotateStats(self):
+        """The log of lookups is rotated when evicting, keeping the one before."""
+        cache = BlastCache(self.cacheDir)
+        cache.maxStatsSize = 100
+        outPath = os.path.join(self.tempDir, "out.cigar")
+        # Too small to rotate
+        cache.get("aa1", outPath)
+        cache.evict()
+        self.assertFalse(os.path.exists(os.path.join(self.cacheDir, "stats.tsv.1")))
+        for i in range(3):
+            cache.get("aa1", outPath)
+        cache.evict()
+        self.assertTrue(os.path.exists(os.path.join(self.cacheDir, "stats.tsv.1")))
+        self.assertFalse(os.path.exists(os.path.join(self.cacheDir, "stats.tsv")))
+        cache.get("bb2", outPath)
+        self.assertEqual(cache.getStats()["misses"], 5)
+        # Only the previous log is kept
+        for i in range(3):
+            cache.get("bb2", outPath)
+        cache.evict()
+        self.assertEqual(cache.getStats()["misses"], 4)
+
+if __name__ == '__main__':
+    unittest.main()
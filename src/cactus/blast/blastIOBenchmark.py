@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Benchmark the job store I/O of the blast phase, with and without
+compressed intermediates.
+
+The blast phase is run on the given ingroups and outgroups (eg the evolver
+mammals in the cactus test data: simHuman.chr6 and simMouse.chr6 against
+simDog.chr6) once with compressFiles off and once with it on, each with a
+file job store of its own. The job store is sampled as the workflow runs,
+for its peak size and the bytes of the files written into it (files that
+come and go between samples are missed, so this is a lower bound). How
+much, and how fast, each codec shrinks a chunk and the alignments is
+measured too: bzip2 (which the blast used to compress chunks with), gzip
+in parallel blocks (which it uses now) and zstd, if the zstandard module is
+installed. The results are written out as JSON.
+"""
+
+import bz2
+import io
+import json
+import os
+import platform
+import threading
+import time
+from argparse import ArgumentParser
+
+from toil.job import Job
+from toil.common import Toil
+from toil.lib.bioio import logger
+from toil.lib.bioio import setLoggingFromOptions
+
+from cactus.shared.common import setupBinaries, makeURL, compressStream
+from cactus.blast.blast import BlastOptions, BlastIngroupsAndOutgroups
+
+class JobStoreSampler(threading.Thread):
+    """Samples the files in a file job store, until stopped."""
+    def __init__(self, jobStorePath, interval):
+        super(JobStoreSampler, self).__init__(daemon=True)
+        self.jobStorePath = jobStorePath
+        self.interval = interval
+        self.fileSizes = {}
+        self.peakSize = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        size = 0
+        for dirPath, dirNames, fileNames in os.walk(os.path.join(self.jobStorePath, "files")):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                try:
+                    fileSize = os.path.getsize(path)
+                except OSError:
+                    # Deleted since the walk listed it
+                    continue
+                size += fileSize
+                self.fileSizes[path] = max(fileSize, self.fileSizes.get(path, 0))
+        self.peakSize = max(self.peakSize, size)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+def runBlastPhase(options, jobStorePath, compressFiles, alignmentsFile):
+    """Run the blast phase on the inputs with its own job store, returning its
+    wall time and the job store's I/O."""
+    options.jobStore = jobStorePath
+    blastOptions = BlastOptions(chunkSize=options.chunkSize, overlapSize=options.overlapSize,
+                                lastzArguments=options.lastzArguments, compressFiles=compressFiles,
+                                memory=options.lastzMemory)
+    sampler = JobStoreSampler(jobStorePath, options.sampleInterval)
+    start = time.time()
+    with Toil(options) as toil:
+        ingroupIDs = [toil.importFile(makeURL(path)) for path in options.ingroups]
+        outgroupIDs = [toil.importFile(makeURL(path)) for path in options.outgroups]
+        sampler.start()
+        try:
+            alignmentsID = toil.start(BlastIngroupsAndOutgroups(blastOptions, options.ingroups, ingroupIDs,
+                                                                options.outgroups, outgroupIDs))[0]
+        finally:
+            sampler.stop()
+        toil.exportFile(alignmentsID, makeURL(alignmentsFile))
+    return {"compress_files": compressFiles,
+            "wall_seconds": time.time() - start,
+            "job_store_bytes_written": sum(sampler.fileSizes.values()),
+            "job_store_peak_bytes": sampler.peakSize,
+            "alignments_bytes": os.path.getsize(alignmentsFile)}
+
+def benchmarkCodecs(name, data):
+    """Compress the data with each codec, returning its ratio and speed."""
+    codecs = [("bzip2", lambda: bz2.compress(data, 1))]
+    def gzipBlocks():
+        outFile = io.BytesIO()
+        compressStream(io.BytesIO(data), outFile)
+        return outFile.getvalue()
+    codecs.append(("gzip", gzipBlocks))
+    try:
+        import zstandard
+        codecs.append(("zstd", lambda: zstandard.ZstdCompressor(level=1, threads=-1).compress(data)))
+    except ImportError:
+        pass
+    results = []
+    for codec, compress in codecs:
+        start = time.time()
+        compressed = compress()
+        seconds = time.time() - start
+        results.append({"file": name,
+                        "codec": codec,
+                        "bytes": len(data),
+                        "compressed_bytes": len(compressed),
+                        "ratio": float(len(data)) / max(1, len(compressed)),
+                        "mb_per_second": len(data) / 1e6 / max(seconds, 1e-9)})
+    return results
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    Job.Runner.addToilOptions(parser)
+    parser.add_argument("outputJson", help="File to write the results to")
+    parser.add_argument("--ingroups", nargs="+", required=True, help="Ingroup FASTA files")
+    parser.add_argument("--outgroups", nargs="*", default=[], help="Outgroup FASTA files")
+    parser.add_argument("--chunkSize", type=int, default=10000000, help="Size of the chunks blasted")
+    parser.add_argument("--overlapSize", type=int, default=10000, help="Overlap of the chunks")
+    parser.add_argument("--lastzArguments", default="", help="Arguments to lastz")
+    parser.add_argument("--lastzMemory", type=int, default=None, help="Memory of the blast jobs")
+    parser.add_argument("--sampleInterval", type=float, default=0.5,
+                        help="Seconds between samples of the job store")
+    parser.add_argument("--binariesMode", choices=["docker", "local", "singularity"],
+                        help="The way to run the cactus binaries", default=None)
+    parser.add_argument("--latest", dest="latest", action="store_true",
+                        help="Use the latest version of the docker container "
+                        "rather than pulling one matching this version of cactus")
+    parser.add_argument("--containerImage", dest="containerImage", default=None,
+                        help="Use the the specified pre-built containter image "
+                        "rather than pulling one from quay.io")
+    options = parser.parse_args()
+
+    setupBinaries(options)
+    setLoggingFromOptions(options)
+
+    if ":" in options.jobStore and not options.jobStore.startswith("file:"):
+        raise RuntimeError("The job store must be a file job store, to be sampled")
+    jobStorePrefix = options.jobStore[len("file:"):] if options.jobStore.startswith("file:") else options.jobStore
+    runs = []
+    for compressFiles in [False, True]:
+        suffix = "gzip" if compressFiles else "plain"
+        alignmentsFile = os.path.abspath("%s.%s.cigar" % (options.outputJson, suffix))
+        runs.append(runBlastPhase(options, "%s-%s" % (jobStorePrefix, suffix), compressFiles, alignmentsFile))
+        logger.info("compressFiles=%s: %.1fs, %i bytes written to the job store, peak of %i bytes" % (
+            compressFiles, runs[-1]["wall_seconds"], runs[-1]["job_store_bytes_written"],
+            runs[-1]["job_store_peak_bytes"]))
+
+    with open(options.ingroups[0], 'rb') as chunkFile:
+        chunk = chunkFile.read(options.chunkSize)
+    with open(alignmentsFile, 'rb') as cigarFile:
+        cigars = cigarFile.read()
+    codecs = benchmarkCodecs("chunk", chunk) + benchmarkCodecs("alignments", cigars)
+
+    report = {"host": platform.node(),
+              "cpus": os.cpu_count(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "inputs": {"ingroups": options.ingroups,
+                         "outgroups": options.outgroups,
+                         "chunk_size": options.chunkSize},
+              "runs": runs,
+              "codecs": codecs}
+    with open(options.outputJson, "w") as outFile:
+        json.dump(report, outFile, indent=2)
+    for result in codecs:
+        logger.info("%s %s: ratio %.2f, %.0f MB/s" % (result["file"], result["codec"], result["ratio"],
+                                                    result["mb_per_second"]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Tests the blast I/O benchmark
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from cactus.blast.blastIOBenchmark import JobStoreSampler, benchmarkCodecs
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def testJobStoreSampler(self):
+        filesDir = os.path.join(self.tempDir, "files", "for-job", "kind-RunBlast")
+        os.makedirs(filesDir)
+        sampler = JobStoreSampler(self.tempDir, 60)
+        with open(os.path.join(filesDir, "chunk"), "w") as f:
+            f.write("x" * 100)
+        sampler.sample()
+        os.remove(os.path.join(filesDir, "chunk"))
+        with open(os.path.join(filesDir, "results"), "w") as f:
+            f.write("x" * 30)
+        sampler.sample()
+        # Files outside the files dir, like the jobs, aren't counted
+        with open(os.path.join(self.tempDir, "config.pickle"), "w") as f:
+            f.write("x" * 1000)
+        sampler.start()
+        sampler.stop()
+        self.assertEqual(sampler.peakSize, 100)
+        self.assertEqual(sum(sampler.fileSizes.values()), 130)
+
+    def testBenchmarkCodecs(self):
+        data = b">simHuman.chr6\n" + b"ACGTTGCAAC" * 10000
+        results = benchmarkCodecs("chunk", data)
+        self.assertEqual([r["codec"] for r in results][:2], ["bzip2", "gzip"])
+        for result in results:
+            self.assertEqual(result["bytes"], len(data))
+            self.assertGreater(result["ratio"], 10)
+
+if __name__ == '__main__':
+    unittest.main()
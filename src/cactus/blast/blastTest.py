@@ -37,6 +37,10 @@ from cactus.blast.blast import BlastIngroupsAndOutgroups
 from cactus.blast.blast import BlastSequencesAllAgainstAll
 from cactus.blast.blast import BlastSequencesAgainstEachOther
 from cactus.blast.blast import calculateCoverage
+from cactus.blast.blast import getChunkStats, getChunksStats, pruneChunks, estimateBlastCost, bundleBlasts
+from cactus.blast.blast import writeBlastFile, readBlastFile, CollateBlasts
+from cactus.shared.common import isGzipped
+from cactus.shared.localTurbo import LocalFileStore, LocalFileID
 
 from toil.job import Job
 from toil.common import Toil
@@ -202,6 +206,21 @@ class TestCase(unittest.TestCase):
             keptCoverageFile = ingroupCoveragePaths[i]
             self.assertTrue(filecmp.cmp(independentCoverageFile, keptCoverageFile))
 
+    @TestStatus.mediumLength
+    def testCompressedIntermediates(self):
+        """Gzipping the chunks and results passed between the blast jobs
+        shouldn't change the alignments, which should come out unzipped."""
+        encodeRegion = "ENm001"
+        regionPath = os.path.join(self.encodePath, encodeRegion)
+        ingroupPaths = [os.path.join(regionPath, x + "." + encodeRegion + ".fa") for x in ["human", "cow"]]
+        outgroupPaths = [os.path.join(regionPath, x + "." + encodeRegion + ".fa") for x in ["macaque", "dog"]]
+        runCactusBlastIngroupsAndOutgroups(ingroupPaths, outgroupPaths, alignmentsFile=self.tempOutputFile,
+                                           toilDir=os.path.join(self.tempDir, "uncompressedToil"))
+        runCactusBlastIngroupsAndOutgroups(ingroupPaths, outgroupPaths, alignmentsFile=self.tempOutputFile2,
+                                           toilDir=os.path.join(self.tempDir, "compressedToil"), compressFiles=True)
+        checkCigar(self.tempOutputFile2)
+        self.assertEqual(sorted(open(self.tempOutputFile).readlines()), sorted(open(self.tempOutputFile2).readlines()))
+
     @TestStatus.mediumLength
     def testProgressiveOutgroupsVsAllOutgroups(self):
         """Tests the difference in outgroup coverage on an ingroup when
@@ -321,23 +340,149 @@ class TestCase(unittest.TestCase):
         compressFastaFile(tempSeqFile)
         logger.critical("It took %s seconds to compress the fasta file" % (time.time() - startTime))
         startTime = time.time()
-        system("rm %s" % tempSeqFile + ".bz2")
-        system("bzip2 --keep --fast %s" % tempSeqFile)
+        system("rm %s" % tempSeqFile + ".gz")
+        system("gzip --keep --fast %s" % tempSeqFile)
         logger.critical("It took %s seconds to compress the fasta file by system functions" % (time.time() - startTime))
         startTime = time.time()
-        decompressFastaFile(tempSeqFile + ".bz2", tempSeqFile2)
+        decompressFastaFile(tempSeqFile + ".gz", tempSeqFile2)
         logger.critical("It took %s seconds to decompress the fasta file" % (time.time() - startTime))
+        self.assertTrue(filecmp.cmp(tempSeqFile, tempSeqFile2, shallow=False))
         system("rm %s" % tempSeqFile2)
         startTime = time.time()
-        system("bunzip2 --stdout %s > %s" % (tempSeqFile + ".bz2", tempSeqFile2))
+        system("gunzip --stdout %s > %s" % (tempSeqFile + ".gz", tempSeqFile2))
         logger.critical("It took %s seconds to decompress the fasta file using system function" % (time.time() - startTime))
-        logger.critical("File sizes, before: %s, compressed: %s, decompressed: %s" % (os.stat(tempSeqFile).st_size, os.stat(tempSeqFile + ".bz2").st_size, os.stat(tempSeqFile2).st_size))
+        logger.critical("File sizes, before: %s, compressed: %s, decompressed: %s" % (os.stat(tempSeqFile).st_size, os.stat(tempSeqFile + ".gz").st_size, os.stat(tempSeqFile2).st_size))
         #Above test justifies out use of compression to reduce network transfer!
         #startTime = time.time()
         #runNaiveBlast([ tempSeqFile ], self.tempOutputFile, self.tempDir, lastzOptions="--nogapped --step=3 --hspthresh=3000 --ambiguous=iupac")
         #logger.critical("It took %s seconds to run blast" % (time.time() - startTime))
 
 
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    @TestStatus.shortLength
+    def testBlastFiles(self):
+        fileStore = LocalFileStore(self.tempDir)
+        results = []
+        for i in range(2):
+            results.append(os.path.join(self.tempDir, "results%i.cigar" % i))
+            with open(results[-1], "w") as f:
+                f.write("cigar: a|0 0 8 + b|0 0 8 + %i M 8\n" % i)
+        compressedIDs = [writeBlastFile(fileStore, path, BlastOptions(compressFiles=True)) for path in results]
+        self.assertTrue(isGzipped(compressedIDs[0]))
+        # Gzipped results can be collated by concatenating them
+        collated = os.path.join(self.tempDir, "collated.cigar")
+        catFiles(compressedIDs, collated)
+        with open(readBlastFile(fileStore, LocalFileID(collated))) as f:
+            self.assertEqual(f.read(), "cigar: a|0 0 8 + b|0 0 8 + 0 M 8\ncigar: a|0 0 8 + b|0 0 8 + 1 M 8\n")
+        uncompressedID = writeBlastFile(fileStore, results[0], BlastOptions())
+        self.assertFalse(isGzipped(uncompressedID))
+        with open(readBlastFile(fileStore, uncompressedID)) as f:
+            self.assertEqual(f.read(), "cigar: a|0 0 8 + b|0 0 8 + 0 M 8\n")
+
+    @TestStatus.shortLength
+    def testChunkStats(self):
+        chunk = os.path.join(self.tempDir, "chunk.fa")
+        with open(chunk, 'w') as fileHandle:
+            fileHandle.write(">a\nACGTacgt\nNNAC\n>b\nttGG\n")
+        self.assertEqual(getChunkStats(chunk), {"length": 16, "unmasked": 8, "n": 2, "gc": 7})
+
+    @TestStatus.shortLength
+    def testEstimateBlastCost(self):
+        # Only the unmasked bases count
+        self.assertEqual(estimateBlastCost({"unmasked": 1000}, {"unmasked": 2000}, 1000), 2000)
+        self.assertEqual(estimateBlastCost({"unmasked": 2000}, None, 1000), 2000)
+
+    @TestStatus.shortLength
+    def testPruneChunks(self):
+        chunks = []
+        for i, sequence in enumerate(["ACGTACGTAC", "acgtnnNNNN", "acgtACgtac", "acGTacgtac", "ACGTacgtac"]):
+            chunk = os.path.join(self.tempDir, str(i))
+            with open(chunk, 'w') as fileHandle:
+                fileHandle.write(">s%i|0\n%s\n" % (i, sequence))
+            chunks.append(chunk)
+        chunksStats = getChunksStats(chunks, self.tempDir)
+        self.assertEqual([stats["unmasked"] for stats in chunksStats], [10, 0, 2, 2, 4])
+        blastOptions = BlastOptions(chunkSize=20, minimumChunkUnmaskedBases=3)
+        keptChunks, keptStats = pruneChunks(chunks, chunksStats, blastOptions, self.tempDir)
+        # The chunk without unmasked bases is left out, and the two with
+        # too few are merged
+        self.assertEqual(keptChunks[:2], [chunks[0], chunks[4]])
+        self.assertEqual(len(keptChunks), 3)
+        self.assertEqual(keptStats[2]["unmasked"], 4)
+        self.assertEqual(getChunkStats(keptChunks[2]), keptStats[2])
+        # Unless lastz is told to ignore the masking
+        blastOptions.lastzArguments = "--ambiguous=iupac [unmask]"
+        self.assertEqual(pruneChunks(chunks, chunksStats, blastOptions, self.tempDir)[0], chunks)
+
+    @TestStatus.shortLength
+    def testBundleBlasts(self):
+        costs = [1, 8, 3, 12, 5, 2, 4]
+        bundles = bundleBlasts(costs, 10)
+        # Every blast is in exactly one bundle
+        self.assertEqual(sorted(sum(bundles, [])), list(range(len(costs))))
+        bundleCosts = [sum([costs[i] for i in bundle]) for bundle in bundles]
+        # The blast costing more than the target is on its own, and the
+        # others fit
+        self.assertEqual(bundles[0], [3])
+        self.assertTrue(all([cost <= 10 for cost in bundleCosts[1:]]))
+        # Costliest first
+        self.assertEqual(bundleCosts, sorted(bundleCosts, reverse=True))
+        self.assertEqual(len(bundles), 4)
+
+class CollateTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = getTempDirectory(os.getcwd())
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        system("rm -rf %s" % self.tempDir)
+
+    def collate(self, blastOptions, compressInputs=False):
+        """Collate 25 results, overlapping neighbours having an alignment in
+        common, with a fan-in of 4, returning the lines of the collation."""
+        paths = []
+        for i in range(25):
+            paths.append(os.path.join(self.tempDir, "results%i.cigar" % i))
+            with open(paths[-1], "w") as f:
+                f.write("cigar: a 0 %i + b 0 %i + 10 M %i\n" % (i, i, i))
+                f.write("cigar: a 0 %i + b 0 %i + 10 M %i\n" % (i + 1, i + 1, i + 1))
+            if compressInputs:
+                paths[-1] = compressFastaFile(paths[-1])
+        outPath = os.path.join(self.tempDir, "collated.cigar")
+        options = Job.Runner.getDefaultOptions(os.path.join(self.tempDir, "toil"))
+        with Toil(options) as toil:
+            fileIDs = [toil.importFile(makeURL(path)) for path in paths]
+            outID = toil.start(CollateBlasts(blastOptions, fileIDs, decompress=compressInputs))
+            toil.exportFile(outID, makeURL(outPath))
+        self.assertFalse(isGzipped(outPath))
+        with open(outPath) as f:
+            return f.readlines()
+
+    @TestStatus.shortLength
+    def testCollateBlasts(self):
+        lines = self.collate(BlastOptions(collateFanIn=4))
+        self.assertEqual(len(lines), 50)
+        # Still in the order of the results
+        self.assertEqual(lines[:3], ["cigar: a 0 0 + b 0 0 + 10 M 0\n", "cigar: a 0 1 + b 0 1 + 10 M 1\n",
+                                     "cigar: a 0 1 + b 0 1 + 10 M 1\n"])
+
+    @TestStatus.shortLength
+    def testCollateBlastsDedup(self):
+        expected = ["cigar: a 0 %i + b 0 %i + 10 M %i\n" % (i, i, i) for i in range(26)]
+        self.assertEqual(self.collate(BlastOptions(collateFanIn=4, collateDedup=True)), expected)
+        # Gzipped results are unzipped at the end
+        self.assertEqual(self.collate(BlastOptions(collateFanIn=4, collateDedup=True, compressFiles=True),
+                                      compressInputs=True), expected)
+
 def compareResultsFile(results1, results2, closeness=0.95):
     results1 = loadResults(results1)
     logger.info("Loaded first results")
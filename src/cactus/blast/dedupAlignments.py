@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Leave out the alignments found more than once in the overlaps of chunks.
+
+Neighbouring chunks overlap by overlapSize, so an alignment in an overlap
+is found by each pair of chunks that it falls in, in full or cut short at
+the end of a chunk. Once their coordinates are converted back to the
+sequences, these are identical to, or contained in, another alignment. An
+alignment is left out if every pair of bases it aligns is aligned by one
+other alignment (of the same sequences, on the same strands), so no pair
+of aligned bases is lost.
+
+The alignments are sorted by where they start on the first sequence, and
+swept, each being compared with the alignments that overlap it, so only
+those are kept in memory.
+"""
+
+import bisect
+import os
+
+from cactus.shared.common import cactus_call
+
+class Alignment(object):
+    """A cigar line, with the bounds of the alignment on each sequence."""
+    def __init__(self, line):
+        fields = line.split()
+        if len(fields) < 10 or fields[0] != "cigar:" or len(fields) % 2 != 0:
+            raise RuntimeError("Invalid cigar line: %s" % line)
+        self.line = line
+        self.contig1, self.contig2 = fields[1], fields[5]
+        self.start1, self.end1 = int(fields[2]), int(fields[3])
+        self.start2, self.end2 = int(fields[6]), int(fields[7])
+        self.ops = [(fields[i], int(fields[i + 1])) for i in range(10, len(fields), 2)]
+        self.lo1, self.hi1 = min(self.start1, self.end1), max(self.start1, self.end1)
+        self.lo2, self.hi2 = min(self.start2, self.end2), max(self.start2, self.end2)
+        self._blocks = None
+
+    def groupKey(self):
+        """Only alignments of the same sequences, in the same directions, can
+        contain one another."""
+        return (self.contig1, self.contig2, self.start1 <= self.end1, self.start2 <= self.end2)
+
+    def blocks(self):
+        """Get the gapless blocks of aligned bases, as a dict from diagonal to
+        the sorted, disjoint [lo, hi) ranges on the first sequence of the
+        blocks on that diagonal, or None if the operations don't add up to
+        the bounds (so it can't be compared)."""
+        if self._blocks is not None:
+            return self._blocks
+        length1 = sum([length for op, length in self.ops if op in ("M", "D")])
+        length2 = sum([length for op, length in self.ops if op in ("M", "I")])
+        if (length1, length2) != (self.hi1 - self.lo1, self.hi2 - self.lo2):
+            return None
+        d1 = 1 if self.start1 <= self.end1 else -1
+        d2 = 1 if self.start2 <= self.end2 else -1
+        # The first base of a block going backwards is the one before the
+        # position
+        i = self.start1 if d1 == 1 else self.start1 - 1
+        j = self.start2 if d2 == 1 else self.start2 - 1
+        blocks = {}
+        for op, length in self.ops:
+            if op == "M" and length > 0:
+                # Bases i + d1*k and j + d2*k are aligned, so j - d1*d2*i
+                # is the same for all of them
+                lo = min(i, i + d1 * (length - 1))
+                blocks.setdefault(j - d1 * d2 * i, []).append((lo, lo + length))
+            # A D is a gap in the second sequence, an I in the first
+            if op in ("M", "D"):
+                i += d1 * length
+            if op in ("M", "I"):
+                j += d2 * length
+        for ranges in blocks.values():
+            ranges.sort()
+        self._blocks = blocks
+        return blocks
+
+def isContained(alignment, other):
+    """Is every pair of bases aligned by alignment aligned by other?"""
+    if alignment.groupKey() != other.groupKey():
+        return False
+    if not (other.lo1 <= alignment.lo1 and alignment.hi1 <= other.hi1 and
+            other.lo2 <= alignment.lo2 and alignment.hi2 <= other.hi2):
+        return False
+    blocks, otherBlocks = alignment.blocks(), other.blocks()
+    if blocks is None or otherBlocks is None:
+        return False
+    for diagonal, ranges in blocks.items():
+        otherRanges = otherBlocks.get(diagonal, [])
+        for lo, hi in ranges:
+            # The last of the other's blocks starting at or before this one
+            k = bisect.bisect_right(otherRanges, (lo, float("inf"))) - 1
+            if k < 0 or otherRanges[k][1] < hi:
+                return False
+    return True
+
+def sortKey(alignment):
+    """Fields to sort the alignments by, so that each group is together, in
+    order of start on the first sequence, the longest first."""
+    return "%s\t%s\t%i\t%i\t%i\t%i" % (alignment.contig1, alignment.contig2,
+                                       alignment.start1 <= alignment.end1, alignment.start2 <= alignment.end2,
+                                       alignment.lo1, alignment.hi1)
+
+def dedupSortedAlignments(alignments):
+    """Yield the alignments that aren't contained in another, from alignments
+    sorted as by sortKey."""
+    active = []
+    groupKey = None
+    for alignment in alignments:
+        if alignment.groupKey() != groupKey:
+            groupKey = alignment.groupKey()
+            active = []
+        # Those ending before this starts can't contain this or any after it
+        active = [other for other in active if other.hi1 > alignment.lo1]
+        if any([isContained(alignment, other) for other in active]):
+            continue
+        active.append(alignment)
+        yield alignment
+
+def dedupAlignments(inputFile, outputFile, tempDir):
+    """Write the alignments in the cigar file inputFile that aren't contained
+    in another to outputFile. Returns the numbers of alignments and bytes
+    in, and out."""
+    keyedFile = os.path.join(tempDir, "keyed.cigar")
+    numAlignments = 0
+    with open(inputFile) as inFile, open(keyedFile, "w") as keyed:
+        for line in inFile:
+            if line.strip() == "":
+                continue
+            keyed.write("%s\t%s" % (sortKey(Alignment(line)), line))
+            numAlignments += 1
+    sortedFile = os.path.join(tempDir, "sorted.cigar")
+    cactus_call(outfile=sortedFile,
+                parameters=["sort", "-T{}".format(tempDir), "-t", "\t",
+                            "-k1,1", "-k2,2", "-k3,3n", "-k4,4n", "-k5,5n", "-k6,6nr", keyedFile])
+    os.remove(keyedFile)
+    numKept = 0
+    with open(sortedFile) as inFile, open(outputFile, "w") as outFile:
+        alignments = (Alignment(line.split("\t", 6)[6]) for line in inFile)
+        for alignment in dedupSortedAlignments(alignments):
+            outFile.write(alignment.line)
+            numKept += 1
+    os.remove(sortedFile)
+    return {"alignments": numAlignments,
+            "bytes": os.path.getsize(inputFile),
+            "alignmentsKept": numKept,
+            "bytesKept": os.path.getsize(outputFile)}
@@ -0,0 +1,62 @@
+"""Tests leaving out the alignments repeated in chunk overlaps
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cactus.blast.dedupAlignments import Alignment, isContained, dedupAlignments
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def testBlocks(self):
+        alignment = Alignment("cigar: a 10 20 + b 100 109 + 0 M 3 D 2 M 4 I 1 M 1\n")
+        self.assertEqual(alignment.blocks(), {90: [(10, 13)], 88: [(15, 19)], 89: [(19, 20)]})
+        # Going backwards on the second sequence
+        alignment = Alignment("cigar: a 10 15 + b 50 42 - 0 M 2 I 3 M 3\n")
+        self.assertEqual(alignment.blocks(), {59: [(10, 12)], 56: [(12, 15)]})
+        # Operations that don't add up to the bounds
+        self.assertEqual(Alignment("cigar: a 10 20 + b 100 109 + 0 M 10\n").blocks(), None)
+
+    def testIsContained(self):
+        alignment = Alignment("cigar: a 10 20 + b 100 109 + 0 M 3 D 2 M 4 I 1 M 1\n")
+        # Cut short at the end of a chunk
+        self.assertTrue(isContained(Alignment("cigar: a 11 17 + b 101 105 + 0 M 2 D 2 M 2\n"), alignment))
+        self.assertTrue(isContained(alignment, Alignment(alignment.line)))
+        self.assertFalse(isContained(alignment, Alignment("cigar: a 11 17 + b 101 105 + 0 M 2 D 2 M 2\n")))
+        # Within the bounds, but aligning other bases
+        self.assertFalse(isContained(Alignment("cigar: a 11 17 + b 101 107 + 0 M 6\n"), alignment))
+        self.assertFalse(isContained(Alignment("cigar: a 11 17 + c 101 105 + 0 M 2 D 2 M 2\n"), alignment))
+
+    def testDedupAlignments(self):
+        alignments = ["cigar: a 10 20 + b 100 109 + 0 M 3 D 2 M 4 I 1 M 1\n",
+                      "cigar: a 0 8 + b 20 28 + 0 M 8\n",
+                      "cigar: a 11 17 + b 101 105 + 0 M 2 D 2 M 2\n",
+                      "cigar: a 10 20 + b 100 109 + 0 M 3 D 2 M 4 I 1 M 1\n",
+                      "cigar: a 11 17 + b 101 107 + 0 M 6\n",
+                      "cigar: a 5 8 + b 25 28 + 0 M 3\n",
+                      "cigar: a 5 8 + b 28 25 - 0 M 3\n"]
+        inputFile = os.path.join(self.tempDir, "input.cigar")
+        with open(inputFile, "w") as f:
+            f.write("".join(alignments))
+        outputFile = os.path.join(self.tempDir, "output.cigar")
+        with patch.dict(os.environ, {"CACTUS_BINARIES_MODE": "local"}):
+            stats = dedupAlignments(inputFile, outputFile, self.tempDir)
+        with open(outputFile) as f:
+            kept = f.readlines()
+        self.assertEqual(sorted(kept), sorted([alignments[i] for i in [0, 1, 4, 6]]))
+        self.assertEqual(stats["alignments"], 7)
+        self.assertEqual(stats["alignmentsKept"], 4)
+        self.assertEqual(stats["bytesKept"], len("".join(kept)))
+
+if __name__ == '__main__':
+    unittest.main()
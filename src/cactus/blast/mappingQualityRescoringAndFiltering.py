@@ -25,6 +25,7 @@ filtering the alignments to remove lower probability alignments.
 
 """
 from cactus.shared.common import cactus_call
+from cactus.shared.common import ContainerSession
 
 def countLines(inputFile):
     with open(inputFile, 'r') as f:
@@ -37,30 +38,31 @@ def mappingQualityRescoring(job, inputAlignmentFileID,
 
     Returns primary alignments and secondary alignments in two separate files.
     """
-    inputAlignmentFile = job.fileStore.readGlobalFile(inputAlignmentFileID)
+    with ContainerSession(job.fileStore.localTempDir, fileStore=job.fileStore):
+        inputAlignmentFile = job.fileStore.readGlobalFile(inputAlignmentFileID)
 
-    job.fileStore.logToMaster("Input cigar file has %s lines" % countLines(inputAlignmentFile))
+        job.fileStore.logToMaster("Input cigar file has %s lines" % countLines(inputAlignmentFile))
 
-    # Get temporary file
-    assert maxAlignmentsPerSite >= 1
-    tempAlignmentFiles = [job.fileStore.getLocalTempFile() for i in range(maxAlignmentsPerSite)]
+        # Get temporary file
+        assert maxAlignmentsPerSite >= 1
+        tempAlignmentFiles = [job.fileStore.getLocalTempFile() for i in range(maxAlignmentsPerSite)]
 
-    # Mirror and orient alignments, sort, split overlaps and calculate mapping qualities
-    cactus_call(parameters=[["cat", inputAlignmentFile],
-                            ["cactus_mirrorAndOrientAlignments", logLevel],
-                            ["sort", "-T{}".format(job.fileStore.getLocalTempDir()), "-k6,6", "-k7,7n", "-k8,8n"], # This sorts by coordinate
-                            ["uniq"], # This eliminates any annoying duplicates if lastz reports the alignment in both orientations
-                            ["cactus_splitAlignmentOverlaps", logLevel],
-                            ["cactus_calculateMappingQualities", logLevel, str(maxAlignmentsPerSite),
-                             str(minimumMapQValue), str(alpha)] + tempAlignmentFiles])
+        # Mirror and orient alignments, sort, split overlaps and calculate mapping qualities
+        cactus_call(parameters=[["cat", inputAlignmentFile],
+                                ["cactus_mirrorAndOrientAlignments", logLevel],
+                                ["sort", "-T{}".format(job.fileStore.getLocalTempDir()), "-k6,6", "-k7,7n", "-k8,8n"], # This sorts by coordinate
+                                ["uniq"], # This eliminates any annoying duplicates if lastz reports the alignment in both orientations
+                                ["cactus_splitAlignmentOverlaps", logLevel],
+                                ["cactus_calculateMappingQualities", logLevel, str(maxAlignmentsPerSite),
+                                 str(minimumMapQValue), str(alpha)] + tempAlignmentFiles])
 
-    # Merge together the output files in order
-    secondaryTempAlignmentFile = job.fileStore.getLocalTempFile()
-    if len(tempAlignmentFiles) > 1:
-        cactus_call(parameters=[["cat" ] + tempAlignmentFiles[1:]], outfile=secondaryTempAlignmentFile)
+        # Merge together the output files in order
+        secondaryTempAlignmentFile = job.fileStore.getLocalTempFile()
+        if len(tempAlignmentFiles) > 1:
+            cactus_call(parameters=[["cat" ] + tempAlignmentFiles[1:]], outfile=secondaryTempAlignmentFile)
 
-    job.fileStore.logToMaster("Filtered, non-overlapping primary cigar file has %s lines" % countLines(tempAlignmentFiles[0]))
-    job.fileStore.logToMaster("Filtered, non-overlapping secondary cigar file has %s lines" % countLines(secondaryTempAlignmentFile))
+        job.fileStore.logToMaster("Filtered, non-overlapping primary cigar file has %s lines" % countLines(tempAlignmentFiles[0]))
+        job.fileStore.logToMaster("Filtered, non-overlapping secondary cigar file has %s lines" % countLines(secondaryTempAlignmentFile))
 
-    # Now write back alignments results file and return
-    return job.fileStore.writeGlobalFile(tempAlignmentFiles[0]), job.fileStore.writeGlobalFile(secondaryTempAlignmentFile)
+        # Now write back alignments results file and return
+        return job.fileStore.writeGlobalFile(tempAlignmentFiles[0]), job.fileStore.writeGlobalFile(secondaryTempAlignmentFile)
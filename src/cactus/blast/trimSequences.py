@@ -1,34 +1,96 @@
 #!/usr/bin/env python3
+from array import array
+from bisect import bisect_right
 from collections import defaultdict
-from operator import itemgetter
+
+from cactus.shared.intervals import mergeIntervals, complementIntervals
+
+def _coverageRuns(blocks):
+    """Run-length encode the coverage depth of a list of blocks.
+
+    Returns parallel arrays of run starts, the depth of each run and the
+    cumulative number of covered bases before each run (prefix sums).
+    """
+    deltas = defaultdict(int)
+    for block in blocks:
+        if block[2] >= 1 and block[1] > block[0]:
+            deltas[block[0]] += 1
+            deltas[block[1]] -= 1
+    starts = array('q')
+    depths = array('q')
+    prefix = array('q')
+    depth = 0
+    covered = 0
+    for pos in sorted(deltas):
+        if depths:
+            covered += depth * (pos - starts[-1])
+        depth += deltas[pos]
+        starts.append(pos)
+        depths.append(depth)
+        prefix.append(covered)
+    return starts, depths, prefix
+
+def _coveredBefore(runs, pos):
+    """Number of covered bases (counted with depth) in [0, pos)."""
+    starts, depths, prefix = runs
+    i = bisect_right(starts, pos) - 1
+    if i < 0:
+        return 0
+    return prefix[i] + depths[i] * (pos - starts[i])
 
 def windowFilter(windowSize, threshold, blockDict, seqLengths):
+    """Get the regions of each sequence where windows of size windowSize
+    have at least threshold of their bases covered by the blocks.
+
+    The window score only changes slope at block boundaries, so rather than
+    scoring every base we only look for threshold crossings between those
+    breakpoints, giving time and memory linear in the number of blocks.
+    """
     if windowSize == 1 and threshold == 1:
         # Don't need to do expensive window-filtering
         return blockDict
     ret = defaultdict(list)
     for seq, blocks in list(blockDict.items()):
-        curBlock = 0
+        seqLength = seqLengths[seq]
+        runs = _coverageRuns(blocks)
+
+        def passes(i):
+            score = _coveredBefore(runs, i + windowSize) - _coveredBefore(runs, i)
+            return score / float(windowSize) >= threshold
+
+        # The score is linear between consecutive breakpoints, so the
+        # threshold can be crossed at most once in each segment.
+        breakpoints = set([0, seqLength])
+        for pos in runs[0]:
+            for point in (pos, pos - windowSize):
+                if 0 < point < seqLength:
+                    breakpoints.add(point)
+        breakpoints = sorted(breakpoints)
+
         inRegion = False
         regionStart = 0
-        for i in range(seqLengths[seq]):
-            score = 0
-            while curBlock < len(blocks) and blocks[curBlock][1] < i:
-                curBlock += 1
-            for blockNum in range(curBlock, len(blocks)):
-                block = blocks[blockNum]
-                if block[0] > i + windowSize:
-                    break
-                size = min(block[1], i + windowSize) - max(i, block[0])
-                if block[2] >= 1:
-                    score += size
-            score /= float(windowSize)
-            if score >= threshold and not inRegion:
-                regionStart = i
-                inRegion = True
-            elif score < threshold and inRegion:
-                ret[seq].append((regionStart, i + windowSize - 1))
-                inRegion = False
+        for segStart, segEnd in zip(breakpoints, breakpoints[1:]):
+            crossings = []
+            if passes(segStart) != inRegion:
+                crossings.append(segStart)
+            if passes(segEnd - 1) != passes(segStart):
+                # Binary search for the first base past the crossing
+                lo, hi = segStart, segEnd - 1
+                startState = passes(segStart)
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if passes(mid) == startState:
+                        lo = mid
+                    else:
+                        hi = mid
+                crossings.append(hi)
+            for i in crossings:
+                if not inRegion:
+                    regionStart = i
+                    inRegion = True
+                else:
+                    ret[seq].append((regionStart, i + windowSize - 1))
+                    inRegion = False
     return ret
 
 def uniquifyBlocks(blocksDict, mergeDistance):
@@ -36,21 +98,7 @@ def uniquifyBlocks(blocksDict, mergeDistance):
     blocks (merging blocks that are mergeDistance or less apart)."""
     ret = defaultdict(list)
     for chr, blocks in list(blocksDict.items()):
-        blocks = sorted(blocks, key=itemgetter(0))
-        newBlocks = []
-        prevBlock = None
-        for block in blocks:
-            if prevBlock is None:
-                prevBlock = block
-            else:
-                if prevBlock[1] < block[0] - mergeDistance:
-                    newBlocks.append(prevBlock)
-                    prevBlock = block
-                else:
-                    prevBlock = (prevBlock[0], block[1])
-        if prevBlock is not None:
-            newBlocks.append(prevBlock)
-        ret[chr] = newBlocks
+        ret[chr] = mergeIntervals(blocks, mergeDistance)
     return ret
 
 def getSeparateBedBlocks(bedFile, depth=1):
@@ -102,13 +150,7 @@ def complementBlocks(blocksDict, seqLengths):
     """Complement a sorted block-dict."""
     ret = defaultdict(list)
     for chr, blocks in list(blocksDict.items()):
-        len = seqLengths[chr]
-        start = 0
-        for block in blocks:
-            ret[chr].append((start, block[0]))
-            start = block[1]
-        if start != len:
-            ret[chr].append((start, len))
+        ret[chr] = complementIntervals(blocks, seqLengths[chr])
     # Add in blocks for the sequences that aren't covered at all.
     for chr, len in list(seqLengths.items()):
         if chr not in ret: # This still works with defaultdicts
@@ -1,11 +1,51 @@
 import unittest
+import random
+import time
+from collections import defaultdict
 from io import StringIO
 from textwrap import dedent
 from sonLib.bioio import getTempFile
 from sonLib.bioio import TestStatus
-from cactus.blast.trimSequences import trimSequences
+from cactus.blast.trimSequences import trimSequences, windowFilter
 import os
 
+def perBaseWindowFilter(windowSize, threshold, blockDict, seqLengths):
+    """The original base-by-base window filter, kept as a reference."""
+    ret = defaultdict(list)
+    for seq, blocks in list(blockDict.items()):
+        curBlock = 0
+        inRegion = False
+        regionStart = 0
+        for i in range(seqLengths[seq]):
+            score = 0
+            while curBlock < len(blocks) and blocks[curBlock][1] < i:
+                curBlock += 1
+            for blockNum in range(curBlock, len(blocks)):
+                block = blocks[blockNum]
+                if block[0] > i + windowSize:
+                    break
+                size = min(block[1], i + windowSize) - max(i, block[0])
+                if block[2] >= 1:
+                    score += size
+            score /= float(windowSize)
+            if score >= threshold and not inRegion:
+                regionStart = i
+                inRegion = True
+            elif score < threshold and inRegion:
+                ret[seq].append((regionStart, i + windowSize - 1))
+                inRegion = False
+    return ret
+
+def randomBlocks(seqLength, maxBlockSize, maxGapSize, maxDepth=3):
+    """Sorted, non-overlapping blocks like those output by cactus_coverage."""
+    blocks = []
+    pos = random.randint(0, maxGapSize)
+    while pos < seqLength:
+        end = pos + random.randint(1, maxBlockSize)
+        blocks.append((pos, end, random.randint(0, maxDepth)))
+        pos = end + random.randint(0, maxGapSize)
+    return blocks
+
 class TestCase(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
@@ -109,5 +149,32 @@ class TestCase(unittest.TestCase):
         >seq1|15
         G''') in output.getvalue())
 
+    @TestStatus.shortLength
+    def testWindowFilterMatchesPerBase(self):
+        random.seed(42)
+        for i in range(500):
+            seqLengths = defaultdict(int, {'seq1': random.randint(0, 300)})
+            blocks = {'seq1': randomBlocks(seqLengths['seq1'], 30, 20)}
+            windowSize = random.randint(2, 25)
+            threshold = random.choice([0.0, 0.33, 0.5, 0.8, 1.0])
+            self.assertEqual(windowFilter(windowSize, threshold, blocks, seqLengths),
+                             perBaseWindowFilter(windowSize, threshold, blocks, seqLengths))
+
+    @TestStatus.veryLongLength
+    def testWindowFilterBenchmark(self):
+        # Compare against the per-base filter on a synthetic 100 Mb contig
+        random.seed(42)
+        seqLengths = defaultdict(int, {'chr1': 100000000})
+        blocks = {'chr1': randomBlocks(seqLengths['chr1'], 2000, 3000, maxDepth=1)}
+        start = time.time()
+        fast = windowFilter(10, 0.8, blocks, seqLengths)
+        fastTime = time.time() - start
+        start = time.time()
+        slow = perBaseWindowFilter(10, 0.8, blocks, seqLengths)
+        slowTime = time.time() - start
+        print("windowFilter on %d blocks: %.2fs, per-base: %.2fs" % (len(blocks['chr1']),
+                                                                     fastTime, slowTime))
+        self.assertEqual(fast, slow)
+
 if __name__ == "__main__":
     unittest.main()
@@ -24,7 +24,6 @@ from toil.lib.bioio import getTempFile
 from toil.lib.bioio import logger
 from toil.lib.bioio import setLoggingFromOptions
 from toil.lib.bioio import system
-from sonLib.bioio import catFiles
 from sonLib.bioio import getLogLevelString
 
 from toil.job import Job
@@ -33,6 +32,7 @@ from toil.realtimeLogger import RealtimeLogger
 from toil.lib.humanize import bytes2human
 
 from cactus.shared.common import makeURL
+from cactus.shared.common import catFiles
 from cactus.shared.common import cactus_call
 from cactus.shared.common import RunAsFollowOn
 from cactus.shared.common import getOptionalAttrib
@@ -59,6 +59,7 @@ from cactus.shared.common import runConvertAlignmentsToInternalNames
 from cactus.shared.common import runStripUniqueIDs
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import readGlobalFileWithoutCache
+from cactus.shared.localTurbo import useLocalTurbo, runJobs
 
 from cactus.blast.blast import BlastIngroupsAndOutgroups
 from cactus.blast.blast import BlastOptions
@@ -70,6 +71,7 @@ from cactus.shared.experimentWrapper import ExperimentWrapper
 from cactus.shared.experimentWrapper import DbElemWrapper
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.pipeline.dbServerToil import DbServerService, getDbServer
+from cactus.pipeline.dbSnapshot import listenForSnapshot, waitForSnapshot
 
 ############################################################
 ############################################################
@@ -106,10 +108,12 @@ class CactusJob(RoundedJob):
 
         memory = None
         cores = None
-        if hasattr(self, 'memoryPoly'):
+        memoryPoly = self.getMemoryPoly()
+        if memoryPoly is not None:
             # Memory should be determined by a polynomial fit on the
             # input size
-            memory = self.evaluateResourcePoly(self.memoryPoly)
+            memory = self.evaluateResourcePoly(memoryPoly)
+            memory = self.escalateExtrapolatedMemory(memory)
             if hasattr(self, 'memoryCap'):
                 memory = int(min(memory, self.memoryCap))
 
@@ -123,15 +127,55 @@ class CactusJob(RoundedJob):
             memory = self.getOptionalJobAttrib("memory", typeFn=int,
                                                default=getOptionalAttrib(self.constantsNode, "defaultMemory", int, default=sys.maxsize))
             cores = self.getOptionalJobAttrib("cpu", typeFn=int,
-                                              default=getOptionalAttrib(self.constantsNode, "defaultCpu", int, default=sys.maxsize))
+                                              default=getattr(self, 'cpu', getOptionalAttrib(self.constantsNode, "defaultCpu", int, default=sys.maxsize)))
+        if cores is None and hasattr(self, 'cpu'):
+            # The cores the job needs, whatever its memory is based on
+            cores = self.cpu
         RoundedJob.__init__(self, memory=memory, cores=cores, disk=disk,
                             checkpoint=checkpoint, preemptable=preemptable)
 
-    def evaluateResourcePoly(self, poly):
-        """Evaluate a polynomial based on the total sequence size."""
+    def getRefittedMemoryPoly(self):
+        """Get the memory polynomial refitted from observed runs that is set on
+        the job's node in the config (eg by a --memoryOverlay), if there is
+        one in terms of the feature the job uses."""
+        if self.jobNode is not None and "memoryPoly" in self.jobNode.attrib:
+            feature = self.getOptionalJobAttrib("memoryPolyFeature", default="totalSequenceSize")
+            if feature == getattr(self, 'feature', 'totalSequenceSize'):
+                return [float(c) for c in self.jobNode.attrib["memoryPoly"].split()]
+        return None
+
+    def getMemoryPoly(self):
+        """Get the memory polynomial of the job, preferring a refitted one to
+        the built-in coefficients."""
+        return self.getRefittedMemoryPoly() or getattr(self, 'memoryPoly', None)
+
+    def escalateExtrapolatedMemory(self, memory):
+        """Add the out-of-memory retry margin up front if the job's input is
+        bigger than any of the runs a refitted memoryPoly was fitted to, as
+        the polynomial is likely to be too tight out there."""
+        maxFeature = self.getOptionalJobAttrib("memoryPolyMaxFeature", typeFn=float)
+        if maxFeature is None or self.getRefittedMemoryPoly() is None:
+            return memory
+        x = self.getFeatures()[getattr(self, 'feature', 'totalSequenceSize')]
+        if x <= maxFeature:
+            return memory
+        escalated = int(memory * (1 + self.oomRetryMargin))
+        logger.info("Raising the memory of %s from %s to %s, as its %s of %s is beyond the %s its "
+                    "memoryPoly was fitted to" % (self.__class__.__name__, bytes2human(memory),
+                                                  bytes2human(escalated), getattr(self, 'feature', 'totalSequenceSize'),
+                                                  x, maxFeature))
+        return escalated
+
+    def getFeatures(self):
+        """Get the input sizes that the job's resource usage depends on."""
         features = {'totalSequenceSize': self.cactusWorkflowArguments.totalSequenceSize}
         if hasattr(self, 'featuresFn'):
             features.update(self.featuresFn())
+        return features
+
+    def evaluateResourcePoly(self, poly):
+        """Evaluate a polynomial based on the total sequence size."""
+        features = self.getFeatures()
         if hasattr(self, 'feature'):
             x = features[self.feature]
         else:
@@ -276,8 +320,15 @@ class StartPrimaryDB(CactusPhasesJob):
             memory = max(2500000000, self.evaluateResourcePoly([4.10201882, 2.01324291e+08]))
             cores = cw.getKtserverCpu(default=0.1)
             dbElem = ExperimentWrapper(self.cactusWorkflowArguments.experimentNode)
+            if dbElem.getDbType() == "redis" and cw.getKtserverRedisShards() > 1:
+                # The C cactusDisk clients don't hash keys across the shards, so all their
+                # traffic would go to the first shard and the others would sit idle
+                raise RuntimeError("redisShards is %d, but the cactus binaries can only use a single "
+                                   "redis-server. Set redisShards to 1 in the ktserver element of the "
+                                   "config" % cw.getKtserverRedisShards())
             service = self.addService(DbServerService(dbElem=dbElem,
                                                       existingSnapshotID=self.dbServerDump,
+                                                      compressSnapshot=cw.getKtserverCompressSnapshots(),
                                                       isSecondary=False,
                                                       memory=memory, cores=cores))
             dbString = service.rv(0)
@@ -299,15 +350,11 @@ class SavePrimaryDB(CactusPhasesJob):
                                      flowerName=0)
         fileStore.logToMaster("At end of %s phase, got stats %s" % (self.phaseName, stats))
         dbElem = DbElemWrapper(ET.fromstring(self.cactusWorkflowArguments.cactusDiskDatabaseString))
-        # Send the terminate message
-        getDbServer(dbElem, fileStore).stopServer()
-        # Wait for the file to appear in the right place. This may take a while
-        while True:
-            with fileStore.readGlobalFileStream(self.cactusWorkflowArguments.snapshotID) as f:
-                if f.read(1) != b'':
-                    # The file is no longer empty
-                    break
-            time.sleep(10)
+        # Send the terminate message, asking to be told when the snapshot is
+        # in the job store. This may take a while
+        listener, address = listenForSnapshot(dbElem.getDbNumShards())
+        getDbServer(dbElem, fileStore).stopServer(notifyAddress=address)
+        waitForSnapshot(listener, count=dbElem.getDbNumShards())
         # We have the file now
         intermediateResultsUrl = getattr(self.cactusWorkflowArguments, 'intermediateResultsUrl', None)
         if intermediateResultsUrl is not None:
@@ -325,6 +372,9 @@ class CactusRecursionJob(CactusJob):
     featuresFn = flowerFeatures
     feature = 'flowerGroupSize'
     maxSequenceSizeOfFlowerGroupingDefault = 1000000
+    # Whether the job can be run in the local pool of the job making it, in
+    # local turbo mode (see localTurbo), ie it makes no jobs of its own
+    runsLocally = False
     def __init__(self, phaseNode, constantsNode, cactusDiskDatabaseString, flowerNames, flowerSizes, overlarge=False, precomputedAlignmentIDs=None, checkpoint = False, cactusWorkflowArguments=None, preemptable=True, memPoly=None):
         self.cactusDiskDatabaseString = cactusDiskDatabaseString
         self.flowerNames = flowerNames
@@ -376,6 +426,7 @@ class CactusRecursionJob(CactusJob):
             phaseNode = self.phaseNode
 
         logger.info("Make wrapper jobs: There are %i flowers" % len(flowersAndSizes))
+        localJobs = []
         for overlarge, flowerNames, flowerSizes in flowersAndSizes:
             if overlarge: #Make sure large flowers are on their own, in their own job
                 flowerStatsString = runCactusFlowerStats(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
@@ -391,13 +442,20 @@ class CactusRecursionJob(CactusJob):
                                            overlarge=True,
                                            cactusWorkflowArguments=self.cactusWorkflowArguments)).rv()
             else:
-                logger.info("Adding recursive flower job")
-                self.addChild(job(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
-                                  phaseNode=phaseNode, constantsNode=self.constantsNode,
-                                  flowerNames=flowerNames,
-                                  flowerSizes=flowerSizes,
-                                  overlarge=False,
-                                  cactusWorkflowArguments=self.cactusWorkflowArguments)).rv()
+                childJob = job(cactusDiskDatabaseString=self.cactusDiskDatabaseString,
+                               phaseNode=phaseNode, constantsNode=self.constantsNode,
+                               flowerNames=flowerNames,
+                               flowerSizes=flowerSizes,
+                               overlarge=False,
+                               cactusWorkflowArguments=self.cactusWorkflowArguments)
+                if job.runsLocally and useLocalTurbo(sum(flowerSizes)):
+                    localJobs.append(childJob)
+                else:
+                    logger.info("Adding recursive flower job")
+                    self.addChild(childJob).rv()
+        if len(localJobs) > 0:
+            logger.info("Running %i %s jobs in the local pool" % (len(localJobs), job.__name__))
+            runJobs(localJobs, self._fileStore, self.cores, self.memory)
 
     def makeRecursiveJobs(self, fileStore=None, job=None, phaseNode=None):
         """Make a set of child jobs for a given set of parent flowers.
@@ -561,7 +619,14 @@ class CactusTrimmingBlastPhase(CactusPhasesJob):
                          trimOutgroupFlanking=self.getOptionalPhaseAttrib("trimOutgroupFlanking", int, 100),
                          trimOutgroupDepth=self.getOptionalPhaseAttrib("trimOutgroupDepth", int, 1),
                          keepParalogs=self.getOptionalPhaseAttrib("keepParalogs", bool, False),
-                         gpuLastz=getOptionalAttrib(cafNode, "gpuLastz", bool, False)),
+                         gpuLastz=getOptionalAttrib(cafNode, "gpuLastz", bool, False),
+                         bundleSeconds=getOptionalAttrib(cafNode, "blastBundleSeconds", float, 0),
+                         bundleCores=getOptionalAttrib(cafNode, "blastBundleCores", int, 4),
+                         lastzBasesSquaredPerSecond=getOptionalAttrib(cafNode, "lastzBasesSquaredPerSecond", float, 5e10),
+                         minimumChunkUnmaskedBases=getOptionalAttrib(cafNode, "minimumChunkUnmaskedBases", int, 1),
+                         collateFanIn=getOptionalAttrib(cafNode, "blastCollateFanIn", int, 1000),
+                         collateDedup=getOptionalAttrib(cafNode, "blastCollateDedup", bool, False),
+                         dedupOverlaps=getOptionalAttrib(cafNode, "blastDedupOverlaps", bool, False)),
             list(map(itemgetter(0), ingroupsAndNewIDs)), list(map(itemgetter(1), ingroupsAndNewIDs)),
             list(map(itemgetter(0), outgroupsAndNewIDs)), list(map(itemgetter(1), outgroupsAndNewIDs))))
         
@@ -675,6 +740,8 @@ def inverseJukesCantor(d):
 
 class CactusCafPhase(CactusPhasesJob):
     memoryPoly = [2.51087392e+00, 4.49616219e+08]
+    # Enough to convert the coverage, primary and secondary alignments at once
+    cpu = 3
 
     def __init__(self, **kwargs):
         # Ensure non-preemptability, since this job takes a long time
@@ -691,8 +758,7 @@ class CactusCafPhase(CactusPhasesJob):
             tempFile = fileStore.getLocalTempFile()
             system("cat %s > %s" % (" ".join(bedFiles), tempFile))
             ingroupCoverageFile = fileStore.getLocalTempFile()
-            runConvertAlignmentsToInternalNames(self.cactusWorkflowArguments.cactusDiskDatabaseString, tempFile, ingroupCoverageFile, self.topFlowerName, isBedFile=True)
-            self.cactusWorkflowArguments.ingroupCoverageID = fileStore.writeGlobalFile(ingroupCoverageFile)
+            ingroupCoverageFuture = runConvertAlignmentsToInternalNames(self.cactusWorkflowArguments.cactusDiskDatabaseString, tempFile, ingroupCoverageFile, self.topFlowerName, isBedFile=True, job=self)
 
         if (not self.cactusWorkflowArguments.configWrapper.getDoTrimStrategy()) or (self.cactusWorkflowArguments.outgroupEventNames == None):
             setupFilteringByIdentity(self.cactusWorkflowArguments)
@@ -707,21 +773,28 @@ class CactusCafPhase(CactusPhasesJob):
         assert self.getPhaseNumber() == 1
 
         # Convert the cigar files to use 64-bit cactus Names instead of the headers.
-
-        # Primary alignments first
+        # The primary and any secondary alignments are converted side by side.
         alignmentsFile = fileStore.readGlobalFile(self.cactusWorkflowArguments.alignmentsID)
         convertedAlignmentsFile = fileStore.getLocalTempFile()
-        runConvertAlignmentsToInternalNames(cactusDiskString=self.cactusWorkflowArguments.cactusDiskDatabaseString, alignmentsFile=alignmentsFile, outputFile=convertedAlignmentsFile, flowerName=self.topFlowerName)
+        alignmentsFuture = runConvertAlignmentsToInternalNames(cactusDiskString=self.cactusWorkflowArguments.cactusDiskDatabaseString, alignmentsFile=alignmentsFile, outputFile=convertedAlignmentsFile, flowerName=self.topFlowerName, job=self)
+
+        if self.cactusWorkflowArguments.secondaryAlignmentsID != None:
+            secondaryAlignmentsFile = fileStore.readGlobalFile(self.cactusWorkflowArguments.secondaryAlignmentsID)
+            convertedSecondaryAlignmentsFile = fileStore.getLocalTempFile()
+            secondaryAlignmentsFuture = runConvertAlignmentsToInternalNames(cactusDiskString=self.cactusWorkflowArguments.cactusDiskDatabaseString, alignmentsFile=secondaryAlignmentsFile, outputFile=convertedSecondaryAlignmentsFile, flowerName=self.topFlowerName, job=self)
+
+        if len(self.cactusWorkflowArguments.ingroupCoverageIDs) > 0:
+            ingroupCoverageFuture.result()
+            self.cactusWorkflowArguments.ingroupCoverageID = fileStore.writeGlobalFile(ingroupCoverageFile)
+
+        alignmentsFuture.result()
         fileStore.logToMaster("Converted headers of cigar file %s to internal names, new file %s" % (self.cactusWorkflowArguments.alignmentsID, convertedAlignmentsFile))
         self.cactusWorkflowArguments.alignmentsID = fileStore.writeGlobalFile(convertedAlignmentsFile, cleanup=True)
 
-        # Now any secondary alignments
         if self.cactusWorkflowArguments.secondaryAlignmentsID != None:
-            secondaryAlignmentsFile = fileStore.readGlobalFile(self.cactusWorkflowArguments.secondaryAlignmentsID)
-            convertedAlignmentsFile = fileStore.getLocalTempFile()
-            runConvertAlignmentsToInternalNames(cactusDiskString=self.cactusWorkflowArguments.cactusDiskDatabaseString, alignmentsFile=secondaryAlignmentsFile, outputFile=convertedAlignmentsFile, flowerName=self.topFlowerName)
-            fileStore.logToMaster("Converted headers of secondary cigar file %s to internal names, new file %s" % (self.cactusWorkflowArguments.secondaryAlignmentsID, convertedAlignmentsFile))
-            self.cactusWorkflowArguments.secondaryAlignmentsID = fileStore.writeGlobalFile(convertedAlignmentsFile, cleanup=True)
+            secondaryAlignmentsFuture.result()
+            fileStore.logToMaster("Converted headers of secondary cigar file %s to internal names, new file %s" % (self.cactusWorkflowArguments.secondaryAlignmentsID, convertedSecondaryAlignmentsFile))
+            self.cactusWorkflowArguments.secondaryAlignmentsID = fileStore.writeGlobalFile(convertedSecondaryAlignmentsFile, cleanup=True)
 
         # While we're at it, remove the unique IDs prepended to
         # the headers inside the cactus DB.
@@ -891,6 +964,8 @@ def runBarForJob(self, fileStore=None, features=None, calculateWhichEndsToComput
 class CactusBarWrapper(CactusRecursionJob):
     """Runs the BAR algorithm implementation.
     """
+    runsLocally = True
+
     def featuresFn(self):
         """Merges both end size features and flower features--they will both
         have an impact on resource usage."""
@@ -1093,6 +1168,8 @@ class CactusNormalRecursion2(CactusRecursionJob):
 class CactusNormalWrapper(CactusRecursionJob):
     """This jobs run the normalisation script.
     """
+    runsLocally = True
+
     def run(self, fileStore):
         runCactusMakeNormal(self.cactusDiskDatabaseString, flowerNames=self.flowerNames,
                             maxNumberOfChains=self.getOptionalPhaseAttrib("maxNumberOfChains", int, default=30))
@@ -1127,6 +1204,8 @@ class CactusAVGRecursion2(CactusRecursionJob):
 class CactusAVGWrapper(CactusRecursionJob):
     """This job runs tree building
     """
+    runsLocally = True
+
     def run(self, fileStore):
         runCactusPhylogeny(self.cactusDiskDatabaseString, flowerNames=self.flowerNames)
 
@@ -1172,6 +1251,7 @@ class CactusReferenceRecursion(CactusRecursionJob):
 class CactusReferenceWrapper(CactusRecursionJob):
     """Actually run the reference code.
     """
+    runsLocally = True
     memoryPoly = [0.71709110685129696, 141266641]
     feature = 'maxFlowerSize'
 
@@ -1211,6 +1291,7 @@ class CactusReferenceRecursion3(CactusRecursionJob):
 class CactusSetReferenceCoordinatesUpWrapper(CactusRecursionJob):
     """Does the up pass for filling in the reference sequence coordinates, once a reference has been established.
     """
+    runsLocally = True
     memoryPoly = [1.3030742924744299, 180741939.947]
     feature = 'maxFlowerSize'
 
@@ -1252,6 +1333,7 @@ class CactusSetReferenceCoordinatesDownRecursion2(CactusRecursionJob):
 class CactusSetReferenceCoordinatesDownWrapper(CactusRecursionJob):
     """Does the down pass for filling Fills in the coordinates, once a reference is added.
     """
+    runsLocally = True
     memoryPoly = [0.52844015396914878, 116287385]
     feature = 'maxFlowerSize'
 
@@ -1314,6 +1396,8 @@ class CactusCheckRecursion(CactusRecursionJob):
 class CactusCheckWrapper(CactusRecursionJob):
     """Runs the actual check wrapper
     """
+    runsLocally = True
+
     def run(self, fileStore):
         runCactusCheck(self.cactusDiskDatabaseString, self.flowerNames, checkNormalised=self.getOptionalPhaseAttrib("checkNormalised", bool, False))
 
@@ -1469,6 +1553,8 @@ class CactusWorkflowArguments:
         #The config node
         self.configNode = configNode
         self.configWrapper = ConfigWrapper(self.configNode)
+        if getattr(options, "memoryOverlay", None) is not None:
+            self.configWrapper.applyOverlay(ET.fromstring(options.memoryOverlay))
         #Now deal with the constants that need to be added here
         self.configWrapper.substituteAllPredefinedConstantsWithLiterals()
         self.configWrapper.setBuildHal(options.buildHal)
@@ -1477,6 +1563,15 @@ class CactusWorkflowArguments:
         #Now build the remaining options from the arguments
         findRequiredNode(self.configNode, "avg").attrib["buildAvgs"] = "1" if options.buildAvgs else "0"
 
+def readMemoryOverlay(path):
+    """Read a memoryPoly overlay for --memoryOverlay. The contents, rather than
+    the path, are kept in the options so that jobs can apply it wherever
+    they run."""
+    with open(path) as overlayFile:
+        overlay = overlayFile.read()
+    ET.fromstring(overlay)
+    return overlay
+
 def addCactusWorkflowOptions(parser):
     parser.add_argument("--experiment", dest="experimentFile",
                       help="The file containing a link to the experiment parameters")
@@ -1490,6 +1585,9 @@ def addCactusWorkflowOptions(parser):
     parser.add_argument("--intermediateResultsUrl",
                         help="URL prefix to save intermediate results like DB dumps to (e.g. "
                         "prefix-dump-caf, prefix-dump-avg, etc.)", default=None)
+    parser.add_argument("--memoryOverlay", type=readMemoryOverlay, default=None,
+                        help="Config overlay with memoryPoly coefficients refitted from previous "
+                        "runs, as written by cactus-fit-memory")
 
 class RunCactusPreprocessorThenCactusSetup(RoundedJob):
     def __init__(self, options, cactusWorkflowArguments):
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Benchmark the database backends under cactus-like load.
+
+Each backend is started through DbServerService, as the workflow starts
+the primary database, and loaded by concurrent client processes with a mix
+of reads and writes. Record sizes are drawn from a log-normal distribution,
+like the flowers, caps and sequences cactusDisk stores: mostly small, with
+a long tail of large records. The throughput, latency percentiles, server
+memory and snapshot time of each backend are written out as JSON, so that
+runs can be compared over time.
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import time
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+
+from toil.job import Job
+from toil.common import Toil
+from toil.lib.bioio import logger
+from toil.lib.bioio import setLoggingFromOptions
+
+from cactus.shared.common import setupBinaries
+from cactus.shared.experimentWrapper import DbElemWrapper
+from cactus.pipeline.dbServerToil import DbServerService, getDbServer
+from cactus.pipeline.dbSnapshot import listenForSnapshot, waitForSnapshot
+
+# Read fractions of the cactus phases that the workloads imitate. Setup and
+# CAF mostly fill the database, while BAR and reference mostly read flowers
+# and write back what they changed.
+WORKLOADS = {"caf": 0.3, "bar": 0.7, "reference": 0.8}
+
+# The latency percentiles that are reported.
+PERCENTILES = [50, 90, 99, 99.9]
+
+def recordSize(rng, median, sigma, maxSize):
+    """Draw a record size from a log-normal distribution, capped at maxSize."""
+    return min(maxSize, int(rng.lognormvariate(math.log(median), sigma)))
+
+def percentile(sortedValues, pct):
+    if len(sortedValues) == 0:
+        return None
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * pct / 100.0))]
+
+def getDbClient(confString):
+    return getDbServer(DbElemWrapper(ET.fromstring(confString))).getClient()
+
+def getServerRss(client):
+    """Get the resident memory of the server(s) behind a client, in bytes, or
+    None if the server doesn't report it."""
+    if hasattr(client, "clients"):
+        shardRss = [getServerRss(shardClient) for shardClient in client.clients]
+        return None if None in shardRss else sum(shardRss)
+    if hasattr(client, "info"):
+        return int(client.info()["used_memory_rss"])
+    report = client.report()
+    if "sys_mem_rss" in report:
+        return int(report["sys_mem_rss"])
+    return None
+
+def fillKeys(confString, keys, options, seed):
+    """Write an initial record for each of the given keys."""
+    rng = random.Random(seed)
+    client = getDbClient(confString)
+    for key in keys:
+        client.set(str(key), os.urandom(recordSize(rng, options.medianRecordSize, options.recordSizeSigma,
+                                                   options.maxRecordSize)))
+    client.close()
+
+def runClient(confString, options, seed):
+    """Run one client's share of the mixed workload. Returns the latencies of
+    the reads and of the writes, in seconds."""
+    rng = random.Random(seed)
+    client = getDbClient(confString)
+    readFraction = WORKLOADS[options.workload]
+    readLatencies = []
+    writeLatencies = []
+    for i in range(options.opsPerClient):
+        key = str(rng.randrange(options.numKeys))
+        if rng.random() < readFraction:
+            start = time.perf_counter()
+            client.get(key)
+            readLatencies.append(time.perf_counter() - start)
+        else:
+            value = os.urandom(recordSize(rng, options.medianRecordSize, options.recordSizeSigma,
+                                          options.maxRecordSize))
+            start = time.perf_counter()
+            client.set(key, value)
+            writeLatencies.append(time.perf_counter() - start)
+    client.close()
+    return readLatencies, writeLatencies
+
+def summarizeLatencies(latencies):
+    latencies = sorted(latencies)
+    ret = {"count": len(latencies)}
+    for pct in PERCENTILES:
+        ret["p%s_ms" % pct] = None if not latencies else 1000 * percentile(latencies, pct)
+    ret["max_ms"] = None if not latencies else 1000 * latencies[-1]
+    return ret
+
+def runLoad(job, options, backend, dbInfo):
+    """Load a running database, then have it snapshotted, timing each step."""
+    confString = dbInfo[0]
+    dbElem = DbElemWrapper(ET.fromstring(confString))
+    keys = list(range(options.numKeys))
+    with multiprocessing.Pool(options.numClients) as pool:
+        start = time.time()
+        pool.starmap(fillKeys, [(confString, keys[i::options.numClients], options, options.seed + i)
+                                for i in range(options.numClients)])
+        fillTime = time.time() - start
+
+        start = time.time()
+        clientLatencies = pool.starmap(runClient, [(confString, options, options.seed + options.numClients + i)
+                                                   for i in range(options.numClients)])
+        mixedTime = time.time() - start
+
+    client = getDbClient(confString)
+    rss = getServerRss(client)
+    client.close()
+
+    # Take the snapshot the way SavePrimaryDB does at the end of a phase
+    start = time.time()
+    listener, address = listenForSnapshot(dbElem.getDbNumShards())
+    getDbServer(dbElem).stopServer(notifyAddress=address)
+    waitForSnapshot(listener, count=dbElem.getDbNumShards())
+    snapshotTime = time.time() - start
+
+    readLatencies = [l for reads, writes in clientLatencies for l in reads]
+    writeLatencies = [l for reads, writes in clientLatencies for l in writes]
+    result = {"backend": backend,
+              "shards": dbElem.getDbNumShards(),
+              "fill_ops_per_second": options.numKeys / fillTime,
+              "ops_per_second": options.numClients * options.opsPerClient / mixedTime,
+              "read_latency": summarizeLatencies(readLatencies),
+              "write_latency": summarizeLatencies(writeLatencies),
+              "server_rss_bytes": rss,
+              "snapshot_seconds": snapshotTime}
+    job.fileStore.logToMaster("%s: %.0f ops/s, snapshot in %.2fs" % (backend, result["ops_per_second"],
+                                                                       snapshotTime))
+    return result
+
+def benchmarkBackend(job, options, backend):
+    """Start a database of the given type and load it in a child job."""
+    confElem = ET.Element("st_kv_database_conf", type=backend)
+    ET.SubElement(confElem, backend, in_memory="1", snapshot="1")
+    dbElem = DbElemWrapper(confElem)
+    if backend == "redis" and options.redisShards > 1:
+        dbElem.setDbNumShards(options.redisShards)
+    dbInfo = job.addService(DbServerService(dbElem=dbElem, isSecondary=False,
+                                            compressSnapshot=options.compressSnapshot,
+                                            memory=options.serverMemory,
+                                            cores=max(1, dbElem.getDbNumShards()),
+                                            disk=options.serverDisk))
+    return job.addChildJobFn(runLoad, options, backend, dbInfo,
+                             cores=options.numClients, memory=options.clientMemory).rv()
+
+def benchmarkBackends(job, options, backends, results):
+    """Benchmark each backend in turn, so that they don't compete for the machine."""
+    if len(backends) == 0:
+        return results
+    backendJob = job.addChildJobFn(benchmarkBackend, options, backends[0])
+    return job.addFollowOnJobFn(benchmarkBackends, options, backends[1:],
+                                results + [backendJob.rv()]).rv()
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    Job.Runner.addToilOptions(parser)
+    parser.add_argument("outputJson", help="File to write the results to")
+    parser.add_argument("--backends", nargs="+", choices=["kyoto_tycoon", "redis"],
+                        default=["kyoto_tycoon", "redis"], help="Databases to benchmark")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS.keys()), default="bar",
+                        help="Cactus phase whose read/write mix to imitate")
+    parser.add_argument("--numClients", type=int, default=8,
+                        help="Number of concurrent client processes")
+    parser.add_argument("--numKeys", type=int, default=100000,
+                        help="Number of records in the database")
+    parser.add_argument("--opsPerClient", type=int, default=20000,
+                        help="Number of reads and writes each client makes")
+    parser.add_argument("--medianRecordSize", type=int, default=1000,
+                        help="Median record size, in bytes")
+    parser.add_argument("--recordSizeSigma", type=float, default=1.5,
+                        help="Spread (sigma of the log) of the record sizes")
+    parser.add_argument("--maxRecordSize", type=int, default=16 * 1024 * 1024,
+                        help="Largest record size, in bytes")
+    parser.add_argument("--redisShards", type=int, default=1,
+                        help="Number of redis-servers to spread the redis database over")
+    parser.add_argument("--compressSnapshot", action="store_true",
+                        help="Compress the snapshots taken at the end")
+    parser.add_argument("--serverMemory", default="8G", help="Memory to reserve for each database")
+    parser.add_argument("--serverDisk", default="8G", help="Disk to reserve for each database's snapshot")
+    parser.add_argument("--clientMemory", default="4G", help="Memory to reserve for the clients")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the workload")
+    parser.add_argument("--binariesMode", choices=["docker", "local", "singularity"],
+                        help="The way to run the database servers", default=None)
+    parser.add_argument("--latest", dest="latest", action="store_true",
+                        help="Use the latest version of the docker container "
+                        "rather than pulling one matching this version of cactus")
+    parser.add_argument("--containerImage", dest="containerImage", default=None,
+                        help="Use the the specified pre-built containter image "
+                        "rather than pulling one from quay.io")
+    options = parser.parse_args()
+
+    setupBinaries(options)
+    setLoggingFromOptions(options)
+
+    with Toil(options) as toil:
+        results = toil.start(Job.wrapJobFn(benchmarkBackends, options, options.backends, []))
+
+    report = {"host": platform.node(),
+              "cpus": os.cpu_count(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "workload": {"name": options.workload,
+                           "read_fraction": WORKLOADS[options.workload],
+                           "clients": options.numClients,
+                           "keys": options.numKeys,
+                           "ops_per_client": options.opsPerClient,
+                           "median_record_size": options.medianRecordSize,
+                           "record_size_sigma": options.recordSizeSigma,
+                           "max_record_size": options.maxRecordSize},
+              "results": results}
+    with open(options.outputJson, "w") as outFile:
+        json.dump(report, outFile, indent=2)
+    for result in results:
+        logger.info("%s: %.0f ops/s, read p99 %.3fms, write p99 %.3fms, snapshot %.2fs" % (
+            result["backend"], result["ops_per_second"], result["read_latency"]["p99_ms"] or 0,
+            result["write_latency"]["p99_ms"] or 0, result["snapshot_seconds"]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Tests the database benchmark
+"""
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cactus.pipeline.dbBenchmark import recordSize, percentile, summarizeLatencies, \
+    getServerRss, main
+
+
+class FakeRedisClient:
+    def __init__(self, rss):
+        self.rss = rss
+
+    def info(self):
+        return {"used_memory_rss": str(self.rss)}
+
+
+class FakeShardedClient:
+    def __init__(self, clients):
+        self.clients = clients
+
+
+class FakeKtClient:
+    def __init__(self, report):
+        self.reportDict = report
+
+    def report(self):
+        return self.reportDict
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def testRecordSize(self):
+        rng = random.Random(1)
+        sizes = sorted([recordSize(rng, 1000, 1.5, 100000) for i in range(10001)])
+        self.assertTrue(500 < sizes[5000] < 2000)
+        self.assertEqual(sizes[-1], 100000)
+
+    def testLatencySummary(self):
+        latencies = [i / 1000.0 for i in range(1, 1001)]
+        random.shuffle(latencies)
+        self.assertEqual(percentile(sorted(latencies), 50), 0.501)
+        summary = summarizeLatencies(latencies)
+        self.assertEqual(summary["count"], 1000)
+        self.assertAlmostEqual(summary["p99_ms"], 991)
+        self.assertAlmostEqual(summary["max_ms"], 1000)
+        self.assertEqual(summarizeLatencies([])["p50_ms"], None)
+
+    def testServerRss(self):
+        self.assertEqual(getServerRss(FakeRedisClient(10)), 10)
+        self.assertEqual(getServerRss(FakeShardedClient([FakeRedisClient(10), FakeRedisClient(5)])), 15)
+        self.assertEqual(getServerRss(FakeKtClient({"sys_mem_rss": "7"})), 7)
+        self.assertEqual(getServerRss(FakeKtClient({})), None)
+
+    def testBenchmark(self):
+        """Run a tiny benchmark of both backends end to end."""
+        outputJson = os.path.join(self.tempDir, "results.json")
+        argv = ["dbBenchmark", os.path.join(self.tempDir, "jobStore"), outputJson,
+                "--numClients", "2", "--numKeys", "100", "--opsPerClient", "200",
+                "--serverMemory", "1G", "--serverDisk", "1G", "--clientMemory", "1G"]
+        with patch.object(sys, "argv", argv):
+            main()
+        with open(outputJson) as f:
+            report = json.load(f)
+        self.assertEqual([r["backend"] for r in report["results"]], ["kyoto_tycoon", "redis"])
+        for result in report["results"]:
+            self.assertGreater(result["ops_per_second"], 0)
+            self.assertEqual(result["read_latency"]["count"] + result["write_latency"]["count"], 400)
+            self.assertGreater(result["snapshot_seconds"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
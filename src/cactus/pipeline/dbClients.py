@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Minimal in-process clients for the database servers.
+
+These are used to check on and signal the redis-server and ktserver
+processes without going through redis-cli or ktremotemgr, each call of
+which costs a process (and in docker mode, a container) launch.
+"""
+
+import http.client
+import socket
+import zlib
+from collections import defaultdict
+from time import sleep
+from urllib.parse import quote
+
+# How often to look for a key we are waiting on, in seconds.
+KEY_POLL_INTERVAL = 0.5
+
+def encodeRespCommand(args):
+    """Encode a command as a RESP array of bulk strings."""
+    ret = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        ret.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(ret)
+
+class RedisClient:
+    """Talks the Redis serialization protocol (RESP) over a single socket.
+
+    If unixSocket is given, it is connected to rather than host and port."""
+    def __init__(self, host, port, timeout=10, unixSocket=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.unixSocket = unixSocket
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        if self.sock is None:
+            if self.unixSocket is not None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.unixSocket)
+                except OSError:
+                    sock.close()
+                    raise
+                self.sock = sock
+            else:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.reader = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def command(self, *args):
+        """Send a command and return its reply. Error replies are raised as
+        RuntimeErrors, and connection problems as OSErrors."""
+        self.connect()
+        try:
+            self.sock.sendall(encodeRespCommand(args))
+            return self.readReply()
+        except OSError:
+            self.close()
+            raise
+
+    def pipeline(self, commands):
+        """Send several commands at once and return their replies, saving a
+        round trip per command. Raises the first error reply, if any, after
+        all the replies are read."""
+        self.connect()
+        try:
+            self.sock.sendall(b''.join(encodeRespCommand(args) for args in commands))
+            replies = []
+            error = None
+            for i in range(len(commands)):
+                try:
+                    replies.append(self.readReply())
+                except RuntimeError as e:
+                    replies.append(None)
+                    error = error or e
+        except OSError:
+            self.close()
+            raise
+        if error is not None:
+            raise error
+        return replies
+
+    def readReply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection to redis server at %s:%s closed" % (self.host, self.port))
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RuntimeError("redis server error: %s" % rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection to redis server at %s:%s closed" % (self.host, self.port))
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.readReply() for i in range(length)]
+        raise RuntimeError("Unexpected reply from redis server: %s" % line)
+
+    def ping(self):
+        """Is the server up and done loading its data?"""
+        try:
+            return self.command('PING') == 'PONG'
+        except (OSError, RuntimeError):
+            self.close()
+            return False
+
+    def get(self, key):
+        """Get the value of a key as bytes, or None if it is not set."""
+        return self.command('GET', key)
+
+    def info(self):
+        """Get the server's INFO statistics as a dict of strings."""
+        ret = {}
+        for line in self.command('INFO').decode().splitlines():
+            if ':' in line and not line.startswith('#'):
+                name, value = line.split(':', 1)
+                ret[name] = value
+        return ret
+
+    def set(self, key, value):
+        self.command('SET', key, value)
+
+    def delete(self, key):
+        self.command('DEL', key)
+
+    def shutdown(self, save=True):
+        """Ask the server to exit, writing a snapshot first if save is True."""
+        try:
+            self.command('SHUTDOWN', 'SAVE' if save else 'NOSAVE')
+        except ConnectionError:
+            # The server closes the connection instead of replying when it
+            # shuts down successfully.
+            pass
+        self.close()
+
+def getShardIndex(key, numShards):
+    """Get the shard that holds a key: the CRC-32 (as computed by zlib) of
+    the key's bytes, modulo the number of shards."""
+    if not isinstance(key, bytes):
+        key = str(key).encode()
+    return zlib.crc32(key) % numShards
+
+class ShardedRedisClient:
+    """Spreads keys across several redis-servers by hashing them."""
+    def __init__(self, clients):
+        self.clients = clients
+
+    def getClient(self, key):
+        return self.clients[getShardIndex(key, len(self.clients))]
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def ping(self):
+        return all([client.ping() for client in self.clients])
+
+    def get(self, key):
+        return self.getClient(key).get(key)
+
+    def set(self, key, value):
+        self.getClient(key).set(key, value)
+
+    def delete(self, key):
+        self.getClient(key).delete(key)
+
+    def pipeline(self, commands):
+        """Run commands of the form (name, key, ...) on the shards holding
+        their keys, one pipeline per shard, and return the replies in order."""
+        byShard = defaultdict(list)
+        for i, args in enumerate(commands):
+            byShard[getShardIndex(args[1], len(self.clients))].append(i)
+        replies = [None] * len(commands)
+        for shard, indexes in byShard.items():
+            shardReplies = self.clients[shard].pipeline([commands[i] for i in indexes])
+            for i, reply in zip(indexes, shardReplies):
+                replies[i] = reply
+        return replies
+
+class KtClient:
+    """Talks to a ktserver through its HTTP interface over a single
+    persistent connection."""
+    def __init__(self, host, port, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, method, path, body=None):
+        """Make a request and return the status and body of the response."""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request(method, path, body=body)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+    def ping(self):
+        """Is the server up and answering requests?"""
+        try:
+            status, body = self.request('GET', '/rpc/void')
+            return status == 200
+        except (OSError, http.client.HTTPException):
+            return False
+
+    def report(self):
+        """Get the server's /rpc/report statistics as a dict of strings."""
+        status, body = self.request('GET', '/rpc/report')
+        if status != 200:
+            raise RuntimeError("ktserver returned status %d for its report" % status)
+        ret = {}
+        for line in body.decode().splitlines():
+            if '\t' in line:
+                name, value = line.split('\t', 1)
+                ret[name] = value
+        return ret
+
+    def get(self, key):
+        """Get the value of a key as bytes, or None if it is not set."""
+        status, body = self.request('GET', '/' + quote(key))
+        if status == 404:
+            return None
+        if status != 200:
+            raise RuntimeError("ktserver returned status %d getting %s" % (status, key))
+        return body
+
+    def set(self, key, value):
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        status, body = self.request('PUT', '/' + quote(key), body=value)
+        if status not in (200, 201, 204):
+            raise RuntimeError("ktserver returned status %d setting %s" % (status, key))
+
+    def delete(self, key):
+        status, body = self.request('DELETE', '/' + quote(key))
+        if status not in (200, 204, 404):
+            raise RuntimeError("ktserver returned status %d removing %s" % (status, key))
+
+def waitForKey(client, key, checkFn=None, pollInterval=KEY_POLL_INTERVAL):
+    """Block until the given key is set, and return its value.
+
+    checkFn, if given, is called between polls and should raise if the
+    server has died. Failed connections are retried, as the server being
+    busy is not a reason to give up."""
+    while True:
+        try:
+            value = client.get(key)
+            if value is not None:
+                return value
+        except (OSError, http.client.HTTPException):
+            pass
+        if checkFn is not None:
+            checkFn()
+        sleep(pollInterval)
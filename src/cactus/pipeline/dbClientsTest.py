@@ -0,0 +1,193 @@
+"""Tests the in-process database clients against small fake servers
+"""
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import time
+
+from cactus.pipeline.dbClients import RedisClient, ShardedRedisClient, KtClient, \
+    encodeRespCommand, getShardIndex, waitForKey
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Understands just enough RESP to serve the commands the client uses."""
+    def readCommand(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for i in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            args = self.readCommand()
+            if args is None:
+                return
+            command = args[0].upper()
+            if command == b'PING':
+                self.wfile.write(b'+PONG\r\n')
+            elif command == b'GET':
+                value = data.get(args[1])
+                self.wfile.write(b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value))
+            elif command == b'SET':
+                data[args[1]] = args[2]
+                self.wfile.write(b'+OK\r\n')
+            elif command == b'DEL':
+                self.wfile.write(b':%d\r\n' % (data.pop(args[1], None) is not None))
+            elif command == b'SHUTDOWN':
+                self.server.shutdownArgs = args[1:]
+                return
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
+class FakeKtHandler(BaseHTTPRequestHandler):
+    """Serves the REST and /rpc/void parts of the ktserver HTTP interface."""
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/rpc/void':
+            self.reply(200)
+        elif self.path in self.server.data:
+            self.reply(200, self.server.data[self.path])
+        else:
+            self.reply(404)
+
+    def do_PUT(self):
+        self.server.data[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+        self.reply(201)
+
+    def do_DELETE(self):
+        self.reply(204 if self.server.data.pop(self.path, None) is not None else 404)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+
+class ThreadedUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TestCase(unittest.TestCase):
+    def startServer(self, server):
+        server.data = {}
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        if isinstance(server.server_address, tuple):
+            return server.server_address[1]
+
+    def testEncodeRespCommand(self):
+        self.assertEqual(encodeRespCommand(['SET', 'KEY', 1]),
+                         b'*3\r\n$3\r\nSET\r\n$3\r\nKEY\r\n$1\r\n1\r\n')
+
+    def testRedisClient(self):
+        server = ThreadedTCPServer(('localhost', 0), FakeRedisHandler)
+        client = RedisClient('localhost', self.startServer(server))
+        self.assertTrue(client.ping())
+        self.assertEqual(client.get('FLAG'), None)
+        client.set('FLAG', '1')
+        self.assertEqual(client.get('FLAG'), b'1')
+        client.delete('FLAG')
+        self.assertEqual(client.get('FLAG'), None)
+        self.assertRaises(RuntimeError, client.command, 'NOTACOMMAND')
+        client.shutdown(save=True)
+        self.assertEqual(server.shutdownArgs, [b'SAVE'])
+
+    def testRedisClientUnixSocket(self):
+        socketPath = os.path.join(tempfile.mkdtemp(), 'redis.sock')
+        self.addCleanup(shutil.rmtree, os.path.dirname(socketPath))
+        server = ThreadedUnixServer(socketPath, FakeRedisHandler)
+        self.startServer(server)
+        # The host and port are ignored when there is a socket to use
+        client = RedisClient('localhost', 1, unixSocket=socketPath)
+        self.assertTrue(client.ping())
+        client.set('FLAG', '1')
+        self.assertEqual(client.get('FLAG'), b'1')
+        client.close()
+
+    def testShardedRedisClient(self):
+        servers = [ThreadedTCPServer(('localhost', 0), FakeRedisHandler) for i in range(3)]
+        client = ShardedRedisClient([RedisClient('localhost', self.startServer(server)) for server in servers])
+        self.assertTrue(client.ping())
+        keys = [str(i) for i in range(100)]
+        client.pipeline([('SET', key, key + 'v') for key in keys])
+        for key in keys:
+            # Each key lives on the shard it hashes to, and only there
+            shard = getShardIndex(key, 3)
+            self.assertEqual(servers[shard].data[key.encode()], (key + 'v').encode())
+            self.assertEqual(sum([key.encode() in server.data for server in servers]), 1)
+        self.assertEqual(client.pipeline([('GET', key) for key in keys]), [(key + 'v').encode() for key in keys])
+        self.assertTrue(all([len(server.data) > 0 for server in servers]))
+        client.delete('1')
+        self.assertEqual(client.get('1'), None)
+        client.close()
+
+    def testShardIndex(self):
+        # The CRC-32 of "123456789" is the standard check value 0xCBF43926
+        self.assertEqual(getShardIndex('123456789', 2 ** 32), 0xCBF43926)
+        self.assertEqual(getShardIndex(b'123456789', 7), 0xCBF43926 % 7)
+
+    def testKtClient(self):
+        server = HTTPServer(('localhost', 0), FakeKtHandler)
+        client = KtClient('localhost', self.startServer(server))
+        self.assertTrue(client.ping())
+        self.assertEqual(client.get('FLAG'), None)
+        client.set('FLAG', '1')
+        self.assertEqual(client.get('FLAG'), b'1')
+        client.delete('FLAG')
+        client.delete('FLAG')
+        self.assertEqual(client.get('FLAG'), None)
+        client.close()
+
+    def testPingWithoutServer(self):
+        server = ThreadedTCPServer(('localhost', 0), FakeRedisHandler)
+        port = server.server_address[1]
+        server.server_close()
+        self.assertFalse(RedisClient('localhost', port).ping())
+        self.assertFalse(KtClient('localhost', port).ping())
+
+    def testWaitForKey(self):
+        """The terminate flag should be noticed well within a second of
+        being set, rather than on the next minute-long poll."""
+        server = ThreadedTCPServer(('localhost', 0), FakeRedisHandler)
+        port = self.startServer(server)
+        setTimes = []
+        def setFlag():
+            setTimes.append(time())
+            RedisClient('localhost', port).set('TERMINATE', '1')
+        timer = threading.Timer(0.3, setFlag)
+        timer.start()
+        self.assertEqual(waitForKey(RedisClient('localhost', port), 'TERMINATE', pollInterval=0.1), b'1')
+        self.assertLess(time() - setTimes[0], 1)
+
+    def testWaitForKeyCheck(self):
+        server = ThreadedTCPServer(('localhost', 0), FakeRedisHandler)
+        client = RedisClient('localhost', self.startServer(server))
+        def checkFn():
+            raise RuntimeError("server died")
+        self.assertRaises(RuntimeError, waitForKey, client, 'TERMINATE', checkFn=checkFn, pollInterval=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
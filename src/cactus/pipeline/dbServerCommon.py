@@ -5,11 +5,11 @@ Functions to get network info
 """
 
 import platform
+import random
 import socket
 from contextlib import closing
 
 from toil.lib.bioio import logger
-from cactus.shared.common import cactus_call
 
 def getHostName():
     if platform.system() == 'Darwin':
@@ -40,18 +40,25 @@ def getPublicIP():
         # to provide a default argument
         return '127.0.0.1'
 
-def findOccupiedPorts():
-    """Attempt to find all currently taken TCP ports.
+def reservePort(maxPort, attempts=1000):
+    """Reserve a free TCP port no higher than maxPort by binding a socket
+    to it. The port can't be taken by anyone else until the returned socket
+    is closed, which should be done just before the server is started on it.
 
-    Returns a set of ints, representing taken ports."""
-    netstatOutput = cactus_call(parameters=["netstat", "-tuplen"], check_output=True)
-    ports = set()
-    for line in netstatOutput.split("\n"):
-        fields = line.split()
-        if len(fields) != 9:
-            # Header or other garbage line
+    Returns a tuple of the port and the bound socket."""
+    # Let the OS pick first, as it knows what is free. Its ephemeral range
+    # can be above maxPort, though, in which case we pick ourselves.
+    candidates = [0] + [random.randint(1025, maxPort) for i in range(attempts)]
+    for candidate in candidates:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind(('', candidate))
+        except OSError:
+            sock.close()
             continue
-        port = int(fields[3].split(':')[-1])
-        ports.add(port)
-    logger.debug('Detected ports in use: %s' % repr(ports))
-    return ports
\ No newline at end of file
+        port = sock.getsockname()[1]
+        if port <= maxPort:
+            logger.debug('Reserved port %d' % port)
+            return port, sock
+        sock.close()
+    raise RuntimeError("Unable to find a free port below %d" % maxPort)
@@ -2,15 +2,22 @@
 """Tests the database servers using DbServerService
 """
 import unittest
+import multiprocessing
 import os
+import shutil
+import socket
+import tempfile
+import time
+from contextlib import contextmanager
 from toil.common import Toil
 from toil.job import Job
 
 from cactus.shared.experimentWrapper import DbElemWrapper
-from cactus.shared.common import cactus_call
 from cactus.pipeline.dbServerToil import DbServerService
-from cactus.pipeline.ktserverControl import KtServer
-from cactus.pipeline.redisServerControl import RedisServer
+from cactus.pipeline.dbServerCommon import reservePort
+from cactus.pipeline.dbSnapshot import listenForSnapshot, waitForSnapshot, GZIP_MAGIC
+from cactus.pipeline.ktserverControl import KtServer, MAX_KTSERVER_PORT
+from cactus.pipeline.redisServerControl import RedisServer, ShardedRedisServer
 
 import xml.etree.ElementTree as ET
 
@@ -60,34 +67,128 @@ def runAndTestDbServerService(dbElem, testFunc, inputSnapshotPath=None, outputSn
 def _testKtSetFlag(xmlString):
     """ set FLAG to 1 in a Kyoto_Tycoon database (the first server)"""
     dbElem = DbElemWrapper(ET.fromstring(xmlString))
-    ktServer = KtServer(dbElem)
-    cactus_call(parameters=['ktremotemgr', 'set'] + ktServer.getRemoteParams() + ['FLAG', '1'])
+    client = KtServer(dbElem).getClient()
+    client.set('FLAG', '1')
+    client.close()
 
 
 def _testKtGetFlag(xmlString):
     """ get and check FLAG in a Kyoto_Tycoon database (the second server)"""
     dbElem = DbElemWrapper(ET.fromstring(xmlString))
-    ktServer = KtServer(dbElem)
-    flag = cactus_call(parameters=['ktremotemgr', 'get'] + ktServer.getRemoteParams() + ['FLAG'], check_output=True)
-    assert flag.strip() == '1'
+    client = KtServer(dbElem).getClient()
+    assert client.get('FLAG') == b'1'
+    client.close()
 
 
 def _testRedisSetFlag(xmlString):
     """ set FLAG to 1 in a Redis database (the first server)"""
     dbElem = DbElemWrapper(ET.fromstring(xmlString))
-    redisServer = RedisServer(dbElem)
-    base_call = ['redis-cli'] + redisServer.getRemoteParams()
-    out = cactus_call(parameters=base_call + ['set', 'FLAG', '1'], check_output=True)
-    assert out.strip() == "OK"
+    client = RedisServer(dbElem).getClient()
+    client.set('FLAG', '1')
+    client.close()
 
 
 def _testRedisGetFlag(xmlString):
     """ get and check FLAG in a Redis database (the second server)"""
     dbElem = DbElemWrapper(ET.fromstring(xmlString))
-    redisServer = RedisServer(dbElem)
-    base_call = ['redis-cli'] + redisServer.getRemoteParams()
-    flag = cactus_call(parameters=base_call + ['get', 'FLAG'], check_output=True)
-    assert flag.strip() == '1'
+    client = RedisServer(dbElem).getClient()
+    assert client.get('FLAG') == b'1'
+    client.close()
+
+
+class LocalJobStore:
+    """The part of a job store the servers use to move snapshots, with
+    file IDs being local paths."""
+    @contextmanager
+    def updateFileStream(self, fileID):
+        with open(fileID, 'wb') as f:
+            yield f
+
+    @contextmanager
+    def readFileStream(self, fileID):
+        with open(fileID, 'rb') as f:
+            yield f
+
+
+class LocalFileStore:
+    """The part of a file store the servers use, with file IDs being local
+    paths, so that the servers can be run without a Toil workflow."""
+    def __init__(self, tempDir):
+        self.tempDir = tempDir
+        self.jobStore = LocalJobStore()
+
+    def getLocalTempDir(self):
+        return tempfile.mkdtemp(dir=self.tempDir)
+
+    def getLocalTempFile(self):
+        handle, path = tempfile.mkstemp(dir=self.tempDir)
+        os.close(handle)
+        return path
+
+    def readGlobalFile(self, fileID, userPath):
+        shutil.copyfile(fileID, userPath)
+        return userPath
+
+
+def measureHandoff(confString, getServer, snapshotPath, tempDir, compressSnapshot=False):
+    """Fill a server, stop it and start a second one on its snapshot, as
+    happens between cactus phases. Returns the time taken from asking the
+    first server to stop until its snapshot is exported, and from then until
+    the second server answers requests with the data."""
+    fileStore = LocalFileStore(tempDir)
+    server = getServer(DbElemWrapper(ET.fromstring(confString)), fileStore, None, snapshotPath,
+                       compressSnapshot)
+    process = server.runServer()[0]
+    client = server.getClient()
+    client.set('FLAG', '1')
+    client.close()
+    start = time.time()
+    listener, address = listenForSnapshot()
+    server.stopServer(notifyAddress=address)
+    waitForSnapshot(listener)
+    stopTime = time.time() - start
+    process.join()
+    assert process.exitcode == 0
+
+    start = time.time()
+    server = getServer(DbElemWrapper(ET.fromstring(confString)), fileStore, snapshotPath, None)
+    process = server.runServer()[0]
+    client = server.getClient()
+    assert client.get('FLAG') == b'1'
+    assert client.get('TERMINATE') is None
+    client.close()
+    startTime = time.time() - start
+    server.stopServer()
+    process.join()
+    return stopTime, startTime
+
+
+def _loadShards(confString, numOps, batchSize=1000, recordSize=1000):
+    """Write and read back numOps records through a sharded client."""
+    client = ShardedRedisServer(DbElemWrapper(ET.fromstring(confString))).getClient()
+    value = os.urandom(recordSize)
+    prefix = os.urandom(8).hex()
+    for start in range(0, numOps, batchSize):
+        keys = ['%s%d' % (prefix, i) for i in range(start, min(start + batchSize, numOps))]
+        client.pipeline([('SET', key, value) for key in keys])
+        client.pipeline([('GET', key) for key in keys])
+    client.close()
+
+
+def benchmarkShards(numShards, tempDir, numClients=16, numOps=50000):
+    """Get the operations per second that numClients processes get out of a
+    ShardedRedisServer with numShards shards."""
+    dbElem = DbElemWrapper(ET.fromstring(REDIS_CONF_STRING))
+    dbElem.setDbNumShards(numShards)
+    server = ShardedRedisServer(dbElem, LocalFileStore(tempDir))
+    processes, dbElem, logPath = server.runServer()
+    start = time.time()
+    with multiprocessing.Pool(numClients) as pool:
+        pool.starmap(_loadShards, [(dbElem.getConfString(), numOps)] * numClients)
+    opsPerSecond = 2 * numOps * numClients / (time.time() - start)
+    server.stopServer()
+    processes.join()
+    return opsPerSecond
 
 
 class TestCase(unittest.TestCase):
@@ -96,6 +197,7 @@ class TestCase(unittest.TestCase):
         os.mkdir("./testSnapshot")
         self.snapshotTempPath = os.path.abspath("./testSnapshot/snapshot.temp")
         open(self.snapshotTempPath, "w").close()
+        self.tempDir = tempfile.mkdtemp()
 
     #@unittest.skip("skip KT!")
     def testKtServerService(self):
@@ -117,7 +219,44 @@ class TestCase(unittest.TestCase):
         runAndTestDbServerService(dbElem=initialDbElem, testFunc=_testRedisGetFlag,
                                   inputSnapshotPath=self.snapshotTempPath)
 
+    def testReservePort(self):
+        port, reservation = reservePort(MAX_KTSERVER_PORT)
+        self.assertTrue(1024 < port <= MAX_KTSERVER_PORT)
+        # Nothing else can have the port while it is held
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertRaises(OSError, sock.bind, ('', port))
+        reservation.close()
+        sock.bind(('', port))
+        sock.close()
+
+    def testKtHandoffLatency(self):
+        stopTime, startTime = measureHandoff(KT_CONF_STRING, KtServer, self.snapshotTempPath, self.tempDir)
+        print("ktserver handoff: stop and export %.2fs, restart %.2fs" % (stopTime, startTime))
+        # The terminate flag used to only be looked at once a minute.
+        self.assertLess(stopTime, 30)
+
+    def testRedisHandoffLatency(self):
+        stopTime, startTime = measureHandoff(REDIS_CONF_STRING, RedisServer, self.snapshotTempPath, self.tempDir)
+        print("redis-server handoff: stop and export %.2fs, restart %.2fs" % (stopTime, startTime))
+        self.assertLess(stopTime, 30)
+
+    def testRedisCompressedHandoffLatency(self):
+        stopTime, startTime = measureHandoff(REDIS_CONF_STRING, RedisServer, self.snapshotTempPath, self.tempDir,
+                                             compressSnapshot=True)
+        print("redis-server compressed handoff: stop and export %.2fs, restart %.2fs" % (stopTime, startTime))
+        with open(self.snapshotTempPath, 'rb') as f:
+            self.assertEqual(f.read(len(GZIP_MAGIC)), GZIP_MAGIC)
+
+    def testRedisShardScaling(self):
+        results = [(numShards, benchmarkShards(numShards, self.tempDir)) for numShards in [1, 2, 4]]
+        for numShards, opsPerSecond in results:
+            print("redis-server with %d shards: %.0f ops/s" % (numShards, opsPerSecond))
+        # Only check that sharding doesn't hurt, as the scaling depends on
+        # the cores available
+        self.assertGreater(results[-1][1], 0.8 * results[0][1])
+
     def tearDown(self) -> None:
+        shutil.rmtree(self.tempDir)
         os.remove(self.snapshotTempPath)
         os.rmdir("./testSnapshot")
 
@@ -6,20 +6,23 @@
 
 import os
 import stat
+import time
 from toil.job import Job
 from cactus.pipeline.ktserverControl import KtServer
-from cactus.pipeline.redisServerControl import RedisServer
+from cactus.pipeline.redisServerControl import RedisServer, ShardedRedisServer
 
 class DbServerService(Job.Service):
-    def __init__(self, dbElem, isSecondary, existingSnapshotID=None,
+    def __init__(self, dbElem, isSecondary, existingSnapshotID=None, compressSnapshot=False,
                  memory=None, cores=None, disk=None):
         Job.Service.__init__(self, memory=memory, cores=cores, disk=disk, preemptable=False)
         self.dbElem = dbElem
         self.isSecondary = isSecondary
         self.existingSnapshotID = existingSnapshotID
+        self.compressSnapshot = compressSnapshot
         self.failed = False
         self.process = None
         self.dbServer = None
+        self.startupTime = None
 
     def start(self, job):
         snapshotExportID = job.fileStore.jobStore.getEmptyFileStoreID()
@@ -31,11 +34,16 @@ class DbServerService(Job.Service):
         os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)
         self.dbServer = getDbServer(self.dbElem, fileStore=job.fileStore,
                                     existingSnapshotID=self.existingSnapshotID,
-                                    snapshotExportID=snapshotExportID)
+                                    snapshotExportID=snapshotExportID,
+                                    compressSnapshot=self.compressSnapshot)
+        startTime = time.time()
         self.process, self.dbElem, self.logPath = self.dbServer.runServer()
         assert self.dbElem.getDbHost() != None
         self.dbServer.blockUntilServerIsRunning()
         self.check()
+        self.startupTime = time.time() - startTime
+        job.fileStore.logToMaster("%s server on %s:%d ready in %.2f seconds" % (
+            self.dbElem.getDbType(), self.dbElem.getDbHost(), self.dbElem.getDbPort(), self.startupTime))
         return self.dbElem.getConfString(), snapshotExportID
 
     def stop(self, job):
@@ -47,6 +55,10 @@ class DbServerService(Job.Service):
             pass
         if not self.failed:
             self.dbServer.blockUntilServerIsFinished()
+            # The babysitter exits once the snapshot is exported, which has
+            # to happen before this job ends and takes it down.
+            self.process.join()
+            self.check()
 
     def check(self):
         if self.process.exceptionMsg.empty():
@@ -57,13 +69,16 @@ class DbServerService(Job.Service):
             raise RuntimeError(msg)
 
 
-def getDbServer(dbElem, fileStore=None, existingSnapshotID=None, snapshotExportID=None):
+def getDbServer(dbElem, fileStore=None, existingSnapshotID=None, snapshotExportID=None,
+                compressSnapshot=False):
     """
     Get the correct object that handles the database server based on database type
     Each database has a specific class with common functionalities
     """
     if dbElem.getDbType() == "kyoto_tycoon":
-        return KtServer(dbElem, fileStore, existingSnapshotID, snapshotExportID)
+        return KtServer(dbElem, fileStore, existingSnapshotID, snapshotExportID, compressSnapshot)
+    elif dbElem.getDbType() == "redis" and dbElem.getDbNumShards() > 1:
+        return ShardedRedisServer(dbElem, fileStore, existingSnapshotID, snapshotExportID, compressSnapshot)
     elif dbElem.getDbType() == "redis":
-        return RedisServer(dbElem, fileStore, existingSnapshotID, snapshotExportID)
+        return RedisServer(dbElem, fileStore, existingSnapshotID, snapshotExportID, compressSnapshot)
     raise RuntimeError("The database type, %s, is not supported" % dbElem.getDbType())
\ No newline at end of file
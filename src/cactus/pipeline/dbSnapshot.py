@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Functions to move database snapshots in and out of the job store.
+
+Snapshots can be written gzip-compressed, with blocks compressed in
+parallel into independent gzip members (like pigz does), and are streamed
+rather than staged in a second local copy. On a file job store on the same
+filesystem, uncompressed snapshots are linked rather than copied. Whoever
+asked for the snapshot can be told when it is in place over a socket,
+rather than having to watch the job store.
+"""
+
+import fcntl
+import os
+import shutil
+import socket
+
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.lib.bioio import logger
+from cactus.pipeline.dbServerCommon import getHostName
+from cactus.shared.common import compressStream, decompressStream, GZIP_MAGIC, COMPRESSION_BLOCK_SIZE
+
+# The Linux ioctl to share the blocks of one file with another (reflink).
+FICLONE = 0x40049409
+
+def linkOrCopy(srcPath, destPath):
+    """Replace destPath with the contents of srcPath, by hard link, reflink
+    or copy, whichever works first."""
+    tempPath = destPath + '.tmp'
+    if os.path.exists(tempPath):
+        os.remove(tempPath)
+    try:
+        os.link(srcPath, tempPath)
+    except OSError:
+        try:
+            with open(srcPath, 'rb') as src, open(tempPath, 'wb') as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfile(srcPath, tempPath)
+    os.replace(tempPath, destPath)
+
+def exportSnapshot(jobStore, snapshotPath, fileID, compress=False):
+    """Put the snapshot at snapshotPath into the existing job store file fileID."""
+    if not compress and isinstance(jobStore, FileJobStore):
+        linkOrCopy(snapshotPath, jobStore._getFilePathFromId(fileID))
+        return
+    with open(snapshotPath, 'rb') as inFile, jobStore.updateFileStream(fileID) as outFile:
+        if compress:
+            compressStream(inFile, outFile)
+        else:
+            shutil.copyfileobj(inFile, outFile, COMPRESSION_BLOCK_SIZE)
+
+def importSnapshot(fileStore, fileID, snapshotPath):
+    """Extract a snapshot written by exportSnapshot to snapshotPath."""
+    with fileStore.jobStore.readFileStream(fileID) as inFile:
+        header = inFile.read(len(GZIP_MAGIC))
+    if header != GZIP_MAGIC:
+        # Neither the redis nor the ktserver snapshot formats start like a
+        # gzip file. Let the file store link the file if it can.
+        fileStore.readGlobalFile(fileID, userPath=snapshotPath)
+        return
+    with fileStore.jobStore.readFileStream(fileID) as inFile, open(snapshotPath, 'wb') as outFile:
+        decompressStream(inFile, outFile)
+
+def listenForSnapshot(count=1):
+    """Open a socket on which to be told when count snapshots have been
+    exported.
+
+    Returns the listening socket and its address, as a host:port string."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('', 0))
+    listener.listen(count)
+    return listener, "%s:%d" % (getHostName(), listener.getsockname()[1])
+
+def notifySnapshot(address, error=None):
+    """Tell whoever is listening at address that the snapshot is exported, or
+    that exporting it failed with the given error message."""
+    host, port = address.rsplit(':', 1)
+    try:
+        with socket.create_connection((host, int(port)), timeout=60) as sock:
+            sock.sendall(b'OK\n' if error is None else b'ERROR ' + error.encode())
+    except OSError as e:
+        logger.warning("Unable to report snapshot export to %s: %s" % (address, e))
+
+def waitForSnapshot(listener, timeout=None, count=1):
+    """Block until told on the listening socket that count snapshots (one
+    per shard) are exported.
+
+    Raises RuntimeError if an export failed."""
+    listener.settimeout(timeout)
+    try:
+        for i in range(count):
+            try:
+                connection, address = listener.accept()
+            except socket.timeout:
+                raise RuntimeError("Timed out waiting for the database snapshot")
+            with connection:
+                connection.settimeout(timeout)
+                chunks = []
+                while True:
+                    chunk = connection.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            message = b''.join(chunks).decode()
+            if message != 'OK\n':
+                raise RuntimeError("Database snapshot was not exported: %s" % message)
+    finally:
+        listener.close()
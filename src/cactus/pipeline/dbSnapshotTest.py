@@ -0,0 +1,46 @@
+"""Tests moving database snapshots in and out of the job store
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cactus.pipeline.dbSnapshot import linkOrCopy, listenForSnapshot, notifySnapshot, waitForSnapshot
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def testLinkOrCopy(self):
+        src = os.path.join(self.tempDir, 'snapshot')
+        dest = os.path.join(self.tempDir, 'jobStoreFile')
+        with open(src, 'w') as f:
+            f.write('snapshot')
+        open(dest, 'w').close()
+        linkOrCopy(src, dest)
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'snapshot')
+        # The source can go away with the temp dir it lives in
+        os.remove(src)
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'snapshot')
+
+    def testNotify(self):
+        listener, address = listenForSnapshot()
+        threading.Thread(target=notifySnapshot, args=(address,)).start()
+        waitForSnapshot(listener, timeout=60)
+
+        listener, address = listenForSnapshot()
+        threading.Thread(target=notifySnapshot, args=(address,), kwargs={'error': 'disk full'}).start()
+        with self.assertRaises(RuntimeError) as context:
+            waitForSnapshot(listener, timeout=60)
+        self.assertTrue('disk full' in str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,17 +4,18 @@ Functions to launch and manage KyotoTycoon servers.
 """
 
 import os
-import random
 import signal
 import sys
 import traceback
 from glob import glob
 from multiprocessing import Process, Queue
-from time import sleep
+from time import sleep, time
 
 from toil.lib.bioio import logger
 from cactus.shared.common import cactus_call
-from cactus.pipeline.dbServerCommon import getHostName, findOccupiedPorts
+from cactus.pipeline.dbServerCommon import getHostName, reservePort
+from cactus.pipeline.dbSnapshot import exportSnapshot, importSnapshot, notifySnapshot
+from cactus.pipeline.dbClients import KtClient, waitForKey
 
 # For some reason ktserver believes there are only 32768 TCP ports.
 MAX_KTSERVER_PORT = 32767
@@ -22,14 +23,20 @@ MAX_KTSERVER_PORT = 32767
 # The name of the snapshot that KT outputs.
 KTSERVER_SNAPSHOT_NAME = "00000000.ktss"
 
+# How often the babysitter scans the server log for errors, in seconds.
+LOG_CHECK_INTERVAL = 60
+
 
 class KtServer:
-    def __init__(self, dbElem, fileStore=None, existingSnapshotID=None, snapshotExportID=None):
+    def __init__(self, dbElem, fileStore=None, existingSnapshotID=None, snapshotExportID=None,
+                 compressSnapshot=False):
         self.dbElem = dbElem
         self.logPath = None
         self.fileStore = fileStore
         self.existingSnapshotID = existingSnapshotID
         self.snapshotExportID = snapshotExportID
+        self.compressSnapshot = compressSnapshot
+        self.portReservation = None
 
     def runServer(self):
         """
@@ -44,19 +51,15 @@ class KtServer:
         """
         self.logPath = self.fileStore.getLocalTempFile()
         self.dbElem.setDbHost(getHostName())
-        # Find a suitable port to run on.
-        try:
-            occupiedPorts = findOccupiedPorts()
-            unoccupiedPorts = set(range(1025, MAX_KTSERVER_PORT)) - occupiedPorts
-            port = random.choice(list(unoccupiedPorts))
-        except:
-            logger.warning("Can't find which ports are occupied--likely netstat is not installed."
-                           " Choosing a random port to start the DB on, good luck!")
-            port = random.randint(1025,MAX_KTSERVER_PORT)
+        # Hold a port until the server is about to start on it, so that
+        # nothing else can take it in the meantime.
+        port, self.portReservation = reservePort(MAX_KTSERVER_PORT)
         self.dbElem.setDbPort(port)
         process = KtServerProcess(self)
         process.daemon = True
         process.start()
+        # The babysitter process has its own copy of the reservation
+        self.portReservation.close()
 
         if not self.blockUntilServerIsRunning():
             try:
@@ -68,24 +71,25 @@ class KtServer:
 
         return process, self.dbElem, self.logPath
 
-    def blockUntilServerIsRunning(self, createTimeout=1800):
+    def blockUntilServerIsRunning(self, createTimeout=1800, timeStep=0.1):
         """Check status until it's successful, an error is found, or we timeout.
 
         Returns True if the ktserver is now running, False if something went wrong."""
         success = False
-        for i in range(createTimeout):
-            if self.isServerFailed():
-                logger.critical('Error starting ktserver.')
-                success = False
-                break
+        start = time()
+        while time() - start < createTimeout:
             if self.isServerRunning():
                 logger.info('Ktserver running.')
                 success = True
                 break
-            sleep(1)
+            if self.isServerFailed():
+                logger.critical('Error starting ktserver.')
+                success = False
+                break
+            sleep(timeStep)
         return success
 
-    def blockUntilServerIsFinished(self, timeout=1800, timeStep=10):
+    def blockUntilServerIsFinished(self, timeout=1800, timeStep=1):
         """Wait for the ktserver log to indicate that it shut down properly.
 
         Returns True if the server shut down, False if the timeout expired."""
@@ -98,13 +102,12 @@ class KtServer:
         raise RuntimeError("Timeout reached while waiting for ktserver.")
 
     def isServerRunning(self):
-        """Check if the server started running."""
-        success = False
-        with open(self.logPath) as f:
-            for line in f:
-                if line.lower().find("listening") >= 0:
-                    success = True
-        return success
+        """Check if the server started running and answers requests."""
+        client = self.getClient()
+        try:
+            return client.ping()
+        finally:
+            client.close()
 
     def isServerFailed(self):
         """Does the server log contain an error?"""
@@ -155,9 +158,20 @@ class KtServer:
         return ['-port', str(self.dbElem.getDbPort()),
                 '-host', host]
 
-    def stopServer(self):
-        """Attempt to send the terminate signal to a ktserver."""
-        cactus_call(parameters=['ktremotemgr', 'set'] + self.getRemoteParams() + ['TERMINATE', '1'])
+    def getClient(self, timeout=10):
+        """Get an in-process client connected to the ktserver."""
+        return KtClient(self.dbElem.getDbHost() or 'localhost', self.dbElem.getDbPort(), timeout=timeout)
+
+    def stopServer(self, notifyAddress=None):
+        """Attempt to send the terminate signal to a ktserver.
+
+        If notifyAddress (host:port) is given, a message is sent there once
+        the snapshot has been exported, see dbSnapshot.waitForSnapshot."""
+        client = self.getClient()
+        try:
+            client.set('TERMINATE', notifyAddress or '1')
+        finally:
+            client.close()
 
 
 class KtServerProcess(Process):
@@ -171,6 +185,8 @@ class KtServerProcess(Process):
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
+        # Where to report that the snapshot has been exported, if anywhere
+        self.notifyAddress = None
         super(KtServerProcess, self).__init__()
 
     def run(self):
@@ -178,7 +194,10 @@ class KtServerProcess(Process):
         try:
             self.tryRun(*self.args, **self.kwargs)
         except BaseException:
-            self.exceptionMsg.put("".join(traceback.format_exception(*sys.exc_info())))
+            msg = "".join(traceback.format_exception(*sys.exc_info()))
+            self.exceptionMsg.put(msg)
+            if self.notifyAddress is not None:
+                notifySnapshot(self.notifyAddress, error=msg)
             raise
 
     def tryRun(self, ktServer):
@@ -188,30 +207,35 @@ class KtServerProcess(Process):
         if ktServer.existingSnapshotID is not None:
             # Extract the existing snapshot to the snapshot
             # directory so it will be automatically loaded
-            ktServer.fileStore.readGlobalFile(ktServer.existingSnapshotID, userPath=snapshotPath)
+            importSnapshot(ktServer.fileStore, ktServer.existingSnapshotID, snapshotPath)
+        # Give up the port so the server can bind it
+        ktServer.portReservation.close()
         process = cactus_call(server=True, shell=False,
                               parameters=ktServer.getServerCommand(snapshotDir),
                               port=ktServer.dbElem.getDbPort())
         ktServer.blockUntilServerIsRunning()
+        client = ktServer.getClient()
         if ktServer.existingSnapshotID is not None:
             # Clear the termination flag from the snapshot
-            cactus_call(parameters=["ktremotemgr", "remove"] + ktServer.getRemoteParams() + ["TERMINATE"])
-        while True:
-            # Check for the termination signal
-            try:
-                cactus_call(parameters=["ktremotemgr", "get"] + ktServer.getRemoteParams() + ["TERMINATE"],
-                            swallowStdErr=True)
-            except:
-                # No terminate signal sent yet
-                pass
-            else:
-                # Terminate signal received
-                break
-            # Check that the DB is still alive
-            if process.poll() is not None or ktServer.isServerFailed():
+            client.delete('TERMINATE')
+        lastLogCheck = [time()]
+        def checkServer():
+            # Check that the DB is still alive. The log is only scanned
+            # occasionally, as it can get long.
+            logFailed = False
+            if time() - lastLogCheck[0] >= LOG_CHECK_INTERVAL:
+                lastLogCheck[0] = time()
+                logFailed = ktServer.isServerFailed()
+            if process.poll() is not None or logFailed:
                 with open(ktServer.logPath) as f:
                     raise RuntimeError("KTServer failed. Log: %s" % f.read())
-            sleep(60)
+        # Wait for the termination signal
+        terminateValue = waitForKey(client, 'TERMINATE', checkFn=checkServer)
+        if terminateValue != b'1':
+            self.notifyAddress = terminateValue.decode()
+        client.close()
+        # ktserver writes its snapshot when interrupted; there is no
+        # request to make it do so remotely.
         process.send_signal(signal.SIGINT)
         process.wait()
         ktServer.blockUntilServerIsFinished()
@@ -228,4 +252,7 @@ class KtServerProcess(Process):
                     raise RuntimeError("KTServer left more than one snapshot. Log: %s" % f.read())
 
             # Export the snapshot file to the file store
-            ktServer.fileStore.jobStore.updateFile(ktServer.snapshotExportID, snapshotPath)
\ No newline at end of file
+            exportSnapshot(ktServer.fileStore.jobStore, snapshotPath, ktServer.snapshotExportID,
+                           compress=ktServer.compressSnapshot)
+        if self.notifyAddress is not None:
+            notifySnapshot(self.notifyAddress)
\ No newline at end of file
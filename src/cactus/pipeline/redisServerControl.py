@@ -3,17 +3,20 @@
 Functions to launch and manage Redis servers.
 """
 
+import copy
 import os
-import random
 import signal
 import sys
 import traceback
 from multiprocessing import Process, Queue
-from time import sleep
+from time import sleep, time
 
 from toil.lib.bioio import logger
+from cactus.shared.experimentWrapper import DbElemWrapper
 from cactus.shared.common import cactus_call
-from cactus.pipeline.dbServerCommon import getHostName, findOccupiedPorts
+from cactus.pipeline.dbServerCommon import getHostName, reservePort
+from cactus.pipeline.dbSnapshot import exportSnapshot, importSnapshot, notifySnapshot
+from cactus.pipeline.dbClients import RedisClient, ShardedRedisClient, waitForKey
 
 
 MAX_REDIS_PORT = 65535
@@ -21,14 +24,30 @@ MAX_REDIS_PORT = 65535
 # The name of the snapshot that Redis outputs.
 REDIS_SNAPSHOT_NAME = "dump.rdb"
 
+# The name of the Unix socket that Redis listens on alongside its port.
+REDIS_SOCKET_NAME = "redis.sock"
+
+# Unix socket paths longer than this can't be bound.
+MAX_UNIX_SOCKET_PATH = 100
+
+# The first line of the snapshot of a sharded server, which lists the
+# snapshots of its shards.
+SHARD_MANIFEST_HEADER = "cactus redis shards"
+
+# How often the babysitter scans the server log for errors, in seconds.
+LOG_CHECK_INTERVAL = 60
+
 
 class RedisServer:
-    def __init__(self, dbElem, fileStore=None, existingSnapshotID=None, snapshotExportID=None):
+    def __init__(self, dbElem, fileStore=None, existingSnapshotID=None, snapshotExportID=None,
+                 compressSnapshot=False):
         self.dbElem = dbElem
         self.logPath = None
         self.fileStore = fileStore
         self.existingSnapshotID = existingSnapshotID
         self.snapshotExportID = snapshotExportID
+        self.compressSnapshot = compressSnapshot
+        self.portReservation = None
         self.databaseDir = None
 
     def runServer(self):
@@ -42,59 +61,68 @@ class RedisServer:
         Returns a tuple containing an updated version of the database config dbElem and the
         path to the log file.
         """
+        self.checkInstalled()
+        process = self.launchServer()
+        if not self.blockUntilServerIsRunning():
+            try:
+                with open(self.logPath) as f:
+                    log = f.read()
+            except:
+                log = ''
+            raise RuntimeError("Unable to launch redis-server in time. Log: %s" % log)
+
+        return process, self.dbElem, self.logPath
+
+    def checkInstalled(self):
+        try:
+            cactus_call(shell=False, parameters=['redis-server','--version'])
+        except:
+            raise RuntimeError("redis-server is not installed")
 
+    def launchServer(self):
+        """Start the babysitter process, which starts the redis-server, without
+        waiting for the server to come up. Returns the babysitter process."""
         self.databaseDir = self.fileStore.getLocalTempDir()
         # log file can be saved in a subdirectory of where the snapshot is being saved
         self.logPath = os.path.join(self.databaseDir, "redis.log")
         open(self.logPath, 'a').close()
+        # Clients on this host can skip the TCP stack by using a Unix
+        # socket, if the temp dir is shallow enough for it to be bound.
+        socketPath = os.path.join(self.databaseDir, REDIS_SOCKET_NAME)
+        if len(socketPath) <= MAX_UNIX_SOCKET_PATH:
+            self.dbElem.setDbUnixSocket(socketPath)
 
         self.dbElem.setDbHost(getHostName())
-        # Find a suitable port to run on.
-        try:
-            occupiedPorts = findOccupiedPorts()
-            unoccupiedPorts = set(range(1025, MAX_REDIS_PORT)) - occupiedPorts
-            port = random.choice(list(unoccupiedPorts))
-        except:
-            logger.warning("Can't find which ports are occupied--likely netstat is not installed."
-                           " Choosing a random port to start the DB on, good luck!")
-            port = random.randint(1025, MAX_REDIS_PORT)
+        # Hold a port until the server is about to start on it, so that
+        # nothing else can take it in the meantime.
+        port, self.portReservation = reservePort(MAX_REDIS_PORT)
         self.dbElem.setDbPort(port)
-        try:
-            cactus_call(shell=False, parameters=['redis-server','--version'])
-        except:
-            raise RuntimeError("redis-server is not installed")
         process = RedisServerProcess(self)
         process.daemon = True
         process.start()
+        # The babysitter process has its own copy of the reservation
+        self.portReservation.close()
+        return process
 
-        if not self.blockUntilServerIsRunning():
-            try:
-                with open(self.logPath) as f:
-                    log = f.read()
-            except:
-                log = ''
-            raise RuntimeError("Unable to launch redis-server in time. Log: %s" % log)
-
-        return process, self.dbElem, self.logPath
-
-    def blockUntilServerIsRunning(self, createTimeout=1800):
+    def blockUntilServerIsRunning(self, createTimeout=1800, timeStep=0.1):
         """Check status until it's successful, an error is found, or we timeout.
 
         Returns True if the redis-server is now running, False if something went wrong."""
         success = False
-        for i in range(createTimeout):
-            if self.isServerFailed():
-                logger.critical('Error starting Redis server.')
-                success = False
-                break
+        start = time()
+        while time() - start < createTimeout:
             if self.isServerRunning():
                 logger.info('Redis server running.')
                 success = True
                 break
-            sleep(1)
+            if self.isServerFailed():
+                logger.critical('Error starting Redis server.')
+                success = False
+                break
+            sleep(timeStep)
         return success
 
-    def blockUntilServerIsFinished(self, timeout=1800, timeStep=10):
+    def blockUntilServerIsFinished(self, timeout=1800, timeStep=1):
         """Wait for the redis-server log to indicate that it shut down properly.
 
         Returns True if the server shut down, False if the timeout expired."""
@@ -107,13 +135,12 @@ class RedisServer:
         raise RuntimeError("Timeout reached while waiting for redis server.")
 
     def isServerRunning(self):
-        """Check if the server started running."""
-        success = False
-        with open(self.logPath) as f:
-            for line in f:
-                if line.lower().find("accept connections") >= 0:
-                    success = True
-        return success
+        """Check if the server started running and answers requests."""
+        client = self.getClient()
+        try:
+            return client.ping()
+        finally:
+            client.close()
 
     def isServerFailed(self):
         """Does the server log contain an error?"""
@@ -158,6 +185,9 @@ class RedisServer:
         cmd += ["--save", "", "--save", "1000000", "1000000"]
         cmd += ["--dir", snapshotDir, "--dbfilename", REDIS_SNAPSHOT_NAME]
         cmd += ["--logfile", 'redis.log']
+        if self.dbElem.getDbUnixSocket() is not None:
+            # Relative to --dir, so that it works inside a container too
+            cmd += ["--unixsocket", REDIS_SOCKET_NAME, "--unixsocketperm", "700"]
         cmd += tuning.split()
         return cmd
 
@@ -166,9 +196,25 @@ class RedisServer:
         host = self.dbElem.getDbHost() or 'localhost'
         return ['-p', str(self.dbElem.getDbPort()), '-h', host]
 
-    def stopServer(self):
-        """Attempt to send the terminate signal to a redis-server."""
-        cactus_call(parameters=['redis-cli'] + self.getRemoteParams() + ['set', 'TERMINATE', '1'])
+    def getClient(self, timeout=10):
+        """Get an in-process client connected to the redis-server, through
+        its Unix socket if we are on the same host."""
+        unixSocket = self.dbElem.getDbUnixSocket()
+        if unixSocket is not None and not os.path.exists(unixSocket):
+            unixSocket = None
+        return RedisClient(self.dbElem.getDbHost() or 'localhost', self.dbElem.getDbPort(),
+                           timeout=timeout, unixSocket=unixSocket)
+
+    def stopServer(self, notifyAddress=None):
+        """Attempt to send the terminate signal to a redis-server.
+
+        If notifyAddress (host:port) is given, a message is sent there once
+        the snapshot has been exported, see dbSnapshot.waitForSnapshot."""
+        client = self.getClient()
+        try:
+            client.set('TERMINATE', notifyAddress or '1')
+        finally:
+            client.close()
 
 
 class RedisServerProcess(Process):
@@ -182,6 +228,8 @@ class RedisServerProcess(Process):
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
+        # Where to report that the snapshot has been exported, if anywhere
+        self.notifyAddress = None
         super(RedisServerProcess, self).__init__()
 
     def run(self):
@@ -189,7 +237,10 @@ class RedisServerProcess(Process):
         try:
             self.tryRun(*self.args, **self.kwargs)
         except BaseException:
-            self.exceptionMsg.put("".join(traceback.format_exception(*sys.exc_info())))
+            msg = "".join(traceback.format_exception(*sys.exc_info()))
+            self.exceptionMsg.put(msg)
+            if self.notifyAddress is not None:
+                notifySnapshot(self.notifyAddress, error=msg)
             raise
 
     def tryRun(self, redisServer):
@@ -198,31 +249,38 @@ class RedisServerProcess(Process):
         if redisServer.existingSnapshotID is not None:
             # Extract the existing snapshot to the snapshot
             # directory so it will be automatically loaded
-            redisServer.fileStore.readGlobalFile(redisServer.existingSnapshotID, userPath=snapshotPath)
+            importSnapshot(redisServer.fileStore, redisServer.existingSnapshotID, snapshotPath)
+        # Give up the port so the server can bind it
+        redisServer.portReservation.close()
         process = cactus_call(server=True, shell=False,
                               parameters=redisServer.getServerCommand(snapshotDir),
                               port=redisServer.dbElem.getDbPort())
 
         redisServer.blockUntilServerIsRunning()
+        client = redisServer.getClient()
         if redisServer.existingSnapshotID is not None:
             # Clear the termination flag from the snapshot
-            cactus_call(parameters=["redis-cli"] + redisServer.getRemoteParams() + ["del", "TERMINATE"])
-        while True:
-            # Check for the termination signal
-            terminateFlag = cactus_call(parameters=["redis-cli"] + redisServer.getRemoteParams() + ["get", "TERMINATE"],
-                                        swallowStdErr=True, check_output=True)
-            if terminateFlag.strip() != '1':
-                # No terminate signal sent yet
-                pass
-            else:
-                # Terminate signal received
-                break
-            # Check that the DB is still alive
-            if process.poll() is not None or redisServer.isServerFailed():
+            client.delete('TERMINATE')
+        lastLogCheck = [time()]
+        def checkServer():
+            # Check that the DB is still alive. The log is only scanned
+            # occasionally, as it can get long.
+            logFailed = False
+            if time() - lastLogCheck[0] >= LOG_CHECK_INTERVAL:
+                lastLogCheck[0] = time()
+                logFailed = redisServer.isServerFailed()
+            if process.poll() is not None or logFailed:
                 with open(redisServer.logPath) as f:
                     raise RuntimeError("redis server failed. Log: %s" % f.read())
-            sleep(60)
-        process.send_signal(signal.SIGINT)
+        # Wait for the termination signal
+        terminateValue = waitForKey(client, 'TERMINATE', checkFn=checkServer)
+        if terminateValue != b'1':
+            self.notifyAddress = terminateValue.decode()
+        try:
+            # Have the server write its snapshot and exit
+            client.shutdown(save=True)
+        except RuntimeError:
+            process.send_signal(signal.SIGINT)
         process.wait()
         redisServer.blockUntilServerIsFinished()
         if redisServer.snapshotExportID is not None:
@@ -231,4 +289,120 @@ class RedisServerProcess(Process):
                     raise RuntimeError("redis-server did not leave a snapshot on termination,"
                                        " but a snapshot was requested. Log: %s" % f.read())
             # Export the snapshot file to the file store
-            redisServer.fileStore.jobStore.updateFile(redisServer.snapshotExportID, snapshotPath)
+            exportSnapshot(redisServer.fileStore.jobStore, snapshotPath, redisServer.snapshotExportID,
+                           compress=redisServer.compressSnapshot)
+        if self.notifyAddress is not None:
+            notifySnapshot(self.notifyAddress)
+
+
+
+class RedisShardProcesses:
+    """The babysitter processes of the shards of a ShardedRedisServer,
+    standing in for the process of a single server."""
+    exceptionMsg = RedisServerProcess.exceptionMsg
+
+    def __init__(self, processes):
+        self.processes = processes
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+
+class ShardedRedisServer:
+    """Runs several redis-servers on this host, each holding the keys that
+    dbClients.getShardIndex assigns to it.
+
+    The host and port in dbElem are those of the first shard, and all of
+    the shards are listed with DbElemWrapper.setDbShards. The snapshot is a
+    manifest of the snapshots of the shards, which the shards' babysitters
+    save and restore in parallel.
+
+    Only ShardedRedisClient hashes keys across the shards. The C cactusDisk
+    clients connect to the first shard alone, so the cactus workflow
+    refuses to run with more than one.
+    """
+    def __init__(self, dbElem, fileStore=None, existingSnapshotID=None, snapshotExportID=None,
+                 compressSnapshot=False):
+        self.dbElem = dbElem
+        self.logPath = None
+        self.fileStore = fileStore
+        self.existingSnapshotID = existingSnapshotID
+        self.snapshotExportID = snapshotExportID
+        self.compressSnapshot = compressSnapshot
+        self.shards = None
+
+    def runServer(self):
+        """Run all the shards. Returns the same as RedisServer.runServer."""
+        numShards = self.dbElem.getDbNumShards()
+        shardSnapshotIDs = [None] * numShards
+        if self.existingSnapshotID is not None:
+            shardSnapshotIDs = readShardManifest(self.fileStore.jobStore, self.existingSnapshotID)
+            if len(shardSnapshotIDs) != numShards:
+                raise RuntimeError("Snapshot has %d shards, but %d were requested. Keys would be"
+                                   " looked for on the wrong shards" % (len(shardSnapshotIDs), numShards))
+        shardExportIDs = [None] * numShards
+        if self.snapshotExportID is not None:
+            shardExportIDs = [self.fileStore.jobStore.getEmptyFileStoreID() for i in range(numShards)]
+            writeShardManifest(self.fileStore.jobStore, self.snapshotExportID, shardExportIDs)
+        self.shards = []
+        for i in range(numShards):
+            shardElem = DbElemWrapper(copy.deepcopy(self.dbElem.confElem))
+            shardElem.getDbElem().attrib.pop("num_shards", None)
+            self.shards.append(RedisServer(shardElem, self.fileStore, shardSnapshotIDs[i],
+                                           shardExportIDs[i], self.compressSnapshot))
+
+        self.shards[0].checkInstalled()
+        processes = [shard.launchServer() for shard in self.shards]
+        for shard in self.shards:
+            if not shard.blockUntilServerIsRunning():
+                with open(shard.logPath) as f:
+                    raise RuntimeError("Unable to launch redis-server shard in time. Log: %s" % f.read())
+
+        first = self.shards[0].dbElem
+        self.dbElem.setDbHost(first.getDbHost())
+        self.dbElem.setDbPort(first.getDbPort())
+        if first.getDbUnixSocket() is not None:
+            self.dbElem.setDbUnixSocket(first.getDbUnixSocket())
+        self.dbElem.setDbShards([shard.dbElem for shard in self.shards])
+        self.logPath = self.shards[0].logPath
+        return RedisShardProcesses(processes), self.dbElem, self.logPath
+
+    def getShardServers(self):
+        """Get the shards, either those we launched or those listed in dbElem."""
+        if self.shards is not None:
+            return self.shards
+        return [RedisServer(shardElem) for shardElem in self.dbElem.getDbShards()]
+
+    def blockUntilServerIsRunning(self, createTimeout=1800):
+        return all([shard.blockUntilServerIsRunning(createTimeout) for shard in self.getShardServers()])
+
+    def blockUntilServerIsFinished(self, timeout=1800):
+        for shard in self.getShardServers():
+            shard.blockUntilServerIsFinished(timeout)
+        return True
+
+    def getClient(self, timeout=10):
+        """Get a client that spreads keys across the shards."""
+        return ShardedRedisClient([shard.getClient(timeout) for shard in self.getShardServers()])
+
+    def stopServer(self, notifyAddress=None):
+        """Send the terminate signal to every shard. If notifyAddress is
+        given, each shard reports there separately once its snapshot has been
+        exported."""
+        for shard in self.getShardServers():
+            shard.stopServer(notifyAddress)
+
+
+def writeShardManifest(jobStore, fileID, shardFileIDs):
+    with jobStore.updateFileStream(fileID) as f:
+        f.write(("\n".join([SHARD_MANIFEST_HEADER] + [str(i) for i in shardFileIDs]) + "\n").encode())
+
+
+def readShardManifest(jobStore, fileID):
+    """Get the snapshot IDs of the shards from a sharded server's snapshot."""
+    with jobStore.readFileStream(fileID) as f:
+        lines = f.read().decode().split()
+    if len(lines) == 0 or " ".join(lines[:3]) != SHARD_MANIFEST_HEADER:
+        raise RuntimeError("Snapshot %s is not from a sharded redis server" % fileID)
+    return lines[3:]
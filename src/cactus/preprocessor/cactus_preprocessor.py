@@ -24,6 +24,7 @@ from cactus.shared.common import runGetChunks
 from cactus.shared.common import makeURL
 from cactus.shared.common import readGlobalFileWithoutCache
 from cactus.shared.common import cactusRootPath
+from cactus.shared.localTurbo import useLocalTurbo, getPoolCores, runJobs, LocalFileID
 from cactus.shared.configWrapper import ConfigWrapper
 from cactus.progressive.seqFile import SeqFile
 from cactus.shared.common import setupBinaries, importSingularityImage
@@ -98,20 +99,25 @@ class MergeChunks2(RoundedJob):
 
     def run(self, fileStore):
         chunkList = [readGlobalFileWithoutCache(fileStore, fileID) for fileID in self.chunkIDList]
-
-        #Docker expects paths relative to the work dir
-        chunkList = [os.path.basename(chunk) for chunk in chunkList]
         outSequencePath = fileStore.getLocalTempFile()
-        cactus_call(outfile=outSequencePath, stdin_string=" ".join(chunkList),
-                    parameters=["cactus_batch_mergeChunks"])
+        mergeChunks(chunkList, outSequencePath)
         return fileStore.writeGlobalFile(outSequencePath)
 
+def mergeChunks(chunkList, outSequencePath):
+    """merge a list of chunk files into a fasta file"""
+    #Docker expects paths relative to the work dir
+    workDir = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in chunkList + [outSequencePath]])
+    chunkList = [os.path.relpath(chunk, workDir) for chunk in chunkList]
+    cactus_call(outfile=outSequencePath, stdin_string=" ".join(chunkList),
+                parameters=["cactus_batch_mergeChunks"], work_dir=workDir)
+
 class PreprocessSequence(RoundedJob):
     """Cut a sequence into chunks, process, then merge
     """
     def __init__(self, prepOptions, inSequenceID, chunksToCompute=None):
         disk = 3*inSequenceID.size if hasattr(inSequenceID, "size") else None
-        RoundedJob.__init__(self, cores=prepOptions.cpu, memory=prepOptions.memory, disk=disk,
+        cores = getPoolCores(inSequenceID.size, prepOptions.cpu) if hasattr(inSequenceID, "size") else prepOptions.cpu
+        RoundedJob.__init__(self, cores=cores, memory=prepOptions.memory, disk=disk,
                      preemptable=True)
         self.prepOptions = prepOptions
         self.inSequenceID = inSequenceID
@@ -158,7 +164,14 @@ class PreprocessSequence(RoundedJob):
             inChunkList = [os.path.abspath(path) for path in inChunkList]
         logger.info("Chunks = %s" % inChunkList)
 
-        inChunkIDList = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in inChunkList]
+        localTurbo = useLocalTurbo(os.path.getsize(inSequence))
+        if localTurbo:
+            # Small enough to process the chunks here, straight from and to
+            # local files
+            inChunkIDList = [LocalFileID(chunk) for chunk in inChunkList]
+        else:
+            inChunkIDList = [fileStore.writeGlobalFile(chunk, cleanup=True) for chunk in inChunkList]
+        chunkJobs = []
         outChunkIDList = []
         #For each input chunk we create an output chunk, it is the output chunks that get concatenated together.
         if not self.chunksToCompute:
@@ -179,7 +192,18 @@ class PreprocessSequence(RoundedJob):
             else:
                 # otherwise, it's taken from the ratio of chunks
                 proportionSampled = float(inChunkNumber)/len(inChunkIDList)
-            outChunkIDList.append(self.addChild(self.getChunkedJobForCurrentStage(inChunkIDs, proportionSampled, inChunkIDList[i])).rv())
+            chunkJobs.append(self.getChunkedJobForCurrentStage(inChunkIDs, proportionSampled, inChunkIDList[i]))
+
+        if localTurbo:
+            outChunkList = runJobs(chunkJobs, fileStore, self.cores, self.memory)
+            if chunked:
+                outSequencePath = fileStore.getLocalTempFile()
+                mergeChunks(outChunkList, outSequencePath)
+            else:
+                outSequencePath = outChunkList[0]
+            return fileStore.writeGlobalFile(outSequencePath)
+        for chunkJob in chunkJobs:
+            outChunkIDList.append(self.addChild(chunkJob).rv())
 
         if chunked:
             # Merge results of the chunking process back into a genome-wide file
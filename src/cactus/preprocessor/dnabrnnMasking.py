@@ -9,8 +9,6 @@ import shutil
 
 from toil.lib.threading import cpu_count
 
-from sonLib.bioio import catFiles
-
 from cactus.shared.common import cactus_call
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import cactusRootPath
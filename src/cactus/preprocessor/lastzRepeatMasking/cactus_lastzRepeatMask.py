@@ -9,10 +9,10 @@ import shutil
 
 from toil.lib.threading import cpu_count
 
-from sonLib.bioio import catFiles
-
 from cactus.shared.common import cactus_call
+from cactus.shared.common import catFiles
 from cactus.shared.common import RoundedJob
+from cactus.shared.common import ContainerSession
 from toil.realtimeLogger import RealtimeLogger
 
 class RepeatMaskOptions:
@@ -179,16 +179,17 @@ class LastzRepeatMaskJob(RoundedJob):
         """
         Using sampled target fragments, mask repetitive regions of the query.
         """
-        assert len(self.targetIDs) >= 1
-        assert self.repeatMaskOptions.fragment > 1
-        queryFile = fileStore.readGlobalFile(self.queryID)
-        targetFiles = [fileStore.readGlobalFile(fileID) for fileID in self.targetIDs]
-
-        if self.repeatMaskOptions.gpuLastz:
-            assert len(targetFiles) == 1
-            alignment = self.gpuRepeatMask(fileStore, targetFiles[0])
-        else:
-            fragments = self.getFragments(fileStore, queryFile)
-            alignment = self.alignFastaFragments(fileStore, targetFiles, fragments)
-        maskedQuery = self.maskCoveredIntervals(fileStore, queryFile, alignment)
-        return fileStore.writeGlobalFile(maskedQuery)
+        with ContainerSession(fileStore.localTempDir, fileStore=fileStore):
+            assert len(self.targetIDs) >= 1
+            assert self.repeatMaskOptions.fragment > 1
+            queryFile = fileStore.readGlobalFile(self.queryID)
+            targetFiles = [fileStore.readGlobalFile(fileID) for fileID in self.targetIDs]
+
+            if self.repeatMaskOptions.gpuLastz:
+                assert len(targetFiles) == 1
+                alignment = self.gpuRepeatMask(fileStore, targetFiles[0])
+            else:
+                fragments = self.getFragments(fileStore, queryFile)
+                alignment = self.alignFastaFragments(fileStore, targetFiles, fragments)
+            maskedQuery = self.maskCoveredIntervals(fileStore, queryFile, alignment)
+            return fileStore.writeGlobalFile(maskedQuery)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Summarize the resource usage of the programs a cactus workflow ran.
+
+The records are kept in the job store of a workflow run with --stats (and
+with a job store that is kept, eg with --clean never), like the stats that
+`toil stats` reports. They are grouped by phase, tool and the order of
+magnitude of the input size feature of the job they ran in.
+
+cactus-fit-memory refits the memoryPoly of each job class to the peak memory
+its runs used, and writes the polynomials as a config overlay that can be
+given to a workflow with --memoryOverlay.
+"""
+
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+
+from toil.common import Toil
+
+from cactus.shared import callMetrics
+
+GROUP_FIELDS = ["phase", "job", "tool", "bucket"]
+
+def readCallRecords(jobStore):
+    """Get all the call records from a job store."""
+    records = []
+    for stats in callMetrics.readStats(jobStore):
+        records.extend(stats.get(callMetrics.STATS_KEY, []))
+    return records
+
+def getBucket(record):
+    features = record.get("features") or {}
+    feature = record.get("feature")
+    if feature is None or feature not in features:
+        return None
+    return "%s:%s" % (feature, callMetrics.featureBucket(features[feature]))
+
+def _total(records, field):
+    values = [r[field] for r in records if r.get(field) is not None]
+    return sum(values) if values else None
+
+def _max(records, field):
+    values = [r[field] for r in records if r.get(field) is not None]
+    return max(values) if values else None
+
+def summarizeCallRecords(records, groupBy=("phase", "tool", "bucket")):
+    """Sum up the records in each group, returning a row per group with the
+    most total wall time first."""
+    groups = {}
+    for record in records:
+        values = dict(record, bucket=getBucket(record))
+        key = tuple([values.get(field) for field in groupBy])
+        groups.setdefault(key, []).append(record)
+    rows = []
+    for key, group in groups.items():
+        row = dict(zip(groupBy, key))
+        wallTime = _total(group, "wall_time") or 0
+        userTime = _total(group, "user_time")
+        sysTime = _total(group, "sys_time")
+        rssValues = [r["max_rss"] for r in group if r.get("max_rss") is not None]
+        row.update({"calls": len(group),
+                    "failed": len([r for r in group if r.get("exit_code") != 0]),
+                    "wall_time": wallTime,
+                    "mean_wall_time": wallTime / len(group),
+                    "max_wall_time": _max(group, "wall_time"),
+                    "cpu_time": None if userTime is None else userTime + (sysTime or 0),
+                    "max_rss": max(rssValues) if rssValues else None,
+                    "mean_rss": sum(rssValues) / len(rssValues) if rssValues else None,
+                    "read_bytes": _total(group, "read_bytes"),
+                    "write_bytes": _total(group, "write_bytes")})
+        rows.append(row)
+    return sorted(rows, key=lambda row: -row["wall_time"])
+
+def writeSummary(rows, groupBy, outFile):
+    columns = list(groupBy) + ["calls", "failed", "wall_time", "mean_wall_time", "max_wall_time",
+                               "cpu_time", "max_rss", "mean_rss", "read_bytes", "write_bytes"]
+    outFile.write("\t".join(columns) + "\n")
+    for row in rows:
+        values = []
+        for column in columns:
+            value = row[column]
+            if value is None:
+                value = "NA"
+            elif isinstance(value, float):
+                value = "%.2f" % value
+            values.append(str(value))
+        outFile.write("\t".join(values) + "\n")
+
+def getJobPeaks(records):
+    """Get the peak memory of each run of a job, as the largest max_rss of the
+    calls it made, with the value of the feature its resources are modelled
+    on. Returns a dict from (job, phase, feature) to a list of (feature value,
+    peak) pairs."""
+    runs = {}
+    for i, record in enumerate(records):
+        features = record.get("features") or {}
+        feature = record.get("feature")
+        if record.get("max_rss") is None or feature not in features or record.get("job") is None:
+            continue
+        # Records from before job_id was recorded count as runs of their own
+        runId = record.get("job_id") or i
+        key = (record["job"], record.get("phase"), feature)
+        run = runs.setdefault((key, runId), [features[feature], 0])
+        run[1] = max(run[1], record["max_rss"])
+    peaks = {}
+    for (key, runId), (x, peak) in runs.items():
+        peaks.setdefault(key, []).append((x, peak))
+    return peaks
+
+def evaluatePoly(poly, x):
+    """Evaluate a polynomial with the highest degree coefficient first, like a
+    memoryPoly."""
+    return sum([coefficient * x**degree for degree, coefficient in enumerate(reversed(poly))])
+
+def fitPolynomial(xs, ys, degree):
+    """Least squares fit of a polynomial of the given degree, with the highest
+    degree coefficient first."""
+    degree = min(degree, len(set(xs)) - 1)
+    # Scale x so the normal equations stay well conditioned for
+    # genome-sized features
+    scale = float(max([abs(x) for x in xs])) or 1.0
+    n = degree + 1
+    matrix = [[sum([(x / scale)**(i + j) for x in xs]) for j in range(n)] +
+              [sum([(x / scale)**i * y for x, y in zip(xs, ys)])] for i in range(n)]
+    # Gaussian elimination with partial pivoting
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda row: abs(matrix[row][col]))
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        if matrix[col][col] == 0:
+            raise RuntimeError("Can't fit a degree {} polynomial to {} points".format(degree, len(xs)))
+        for row in range(n):
+            if row != col:
+                factor = matrix[row][col] / matrix[col][col]
+                matrix[row] = [a - factor * b for a, b in zip(matrix[row], matrix[col])]
+    coefficients = [matrix[i][n] / matrix[i][i] / scale**i for i in range(n)]
+    return list(reversed(coefficients))
+
+def quantile(values, q):
+    """The q quantile of the values, interpolating between the closest two."""
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def getWaste(poly, peaks):
+    """How a memoryPoly would have done for the given runs: the memory reserved
+    beyond what they used, and how many runs would have run out of memory."""
+    wasted = 0
+    ooms = 0
+    for x, peak in peaks:
+        predicted = int(evaluatePoly(poly, x))
+        if predicted < peak:
+            ooms += 1
+        else:
+            wasted += predicted - peak
+    return {"wasted_bytes": wasted, "ooms": ooms}
+
+def fitMemoryPolys(records, safetyQuantile=0.95, minSamples=5, currentPolys=None):
+    """Fit a memoryPoly for each job class with at least minSamples runs. The
+    least squares fit is shifted up by the safetyQuantile of its residuals, so
+    that that fraction of the observed runs would have had enough memory.
+    currentPolys maps job class names to their current memoryPoly, whose
+    degree is kept (linear if there is none). Returns a list of fits, with the
+    waste of the current and the refitted polynomial."""
+    fits = []
+    for (job, phase, feature), peaks in sorted(getJobPeaks(records).items(), key=lambda i: str(i[0])):
+        if len(peaks) < minSamples:
+            continue
+        currentPoly = (currentPolys or {}).get(job)
+        degree = len(currentPoly) - 1 if currentPoly else 1
+        xs = [x for x, peak in peaks]
+        ys = [peak for x, peak in peaks]
+        poly = fitPolynomial(xs, ys, degree)
+        residuals = [y - evaluatePoly(poly, x) for x, y in peaks]
+        poly[-1] += max(0.0, quantile(residuals, safetyQuantile))
+        fits.append({"job": job, "phase": phase, "feature": feature, "samples": len(peaks),
+                     "maxFeature": max(xs),
+                     "memoryPoly": poly,
+                     "currentPoly": currentPoly,
+                     "current": getWaste(currentPoly, peaks) if currentPoly else None,
+                     "refit": getWaste(poly, peaks)})
+    return fits
+
+def makeMemoryOverlay(fits):
+    """Make the config overlay that sets the refitted memoryPolys on the job
+    nodes of their phases, with the largest feature value they were fitted
+    to."""
+    root = ET.Element("cactusWorkflowConfig")
+    for fit in fits:
+        if fit["phase"] is None:
+            continue
+        phaseNode = root.find(fit["phase"])
+        if phaseNode is None:
+            phaseNode = ET.SubElement(root, fit["phase"])
+        ET.SubElement(phaseNode, fit["job"], {"memoryPoly": " ".join([repr(c) for c in fit["memoryPoly"]]),
+                                              "memoryPolyFeature": fit["feature"],
+                                              # Jobs beyond this get extra memory up front
+                                              "memoryPolyMaxFeature": repr(fit["maxFeature"])})
+    return root
+
+def writeWasteReport(fits, outFile):
+    columns = ["phase", "job", "feature", "samples", "current_wasted_bytes", "current_ooms",
+               "refit_wasted_bytes", "refit_ooms"]
+    outFile.write("\t".join(columns) + "\n")
+    for fit in fits:
+        current = fit["current"] or {"wasted_bytes": "NA", "ooms": "NA"}
+        values = [fit["phase"], fit["job"], fit["feature"], fit["samples"], current["wasted_bytes"],
+                  current["ooms"], fit["refit"]["wasted_bytes"], fit["refit"]["ooms"]]
+        outFile.write("\t".join([str(v) for v in values]) + "\n")
+
+def readRecords(path):
+    """Read the call records from a file of JSON lines, as written by
+    cactus-metrics --records, or from a job store."""
+    if os.path.isfile(path):
+        with open(path) as recordsFile:
+            return [json.loads(line) for line in recordsFile if line.strip()]
+    return readCallRecords(Toil.resumeJobStore(path))
+
+def main_fit_memory():
+    parser = ArgumentParser(description="Refit the memoryPoly of each cactus job to the peak memory "
+                            "used in previous runs, and write them as a config overlay for --memoryOverlay. "
+                            "Reports how much memory the current and refitted polynomials would have "
+                            "reserved beyond what the runs used, and how many runs would have run out.")
+    parser.add_argument("inputs", nargs="+",
+                        help="Job stores of workflows run with --stats, or call record files written "
+                        "by cactus-metrics --records")
+    parser.add_argument("outputOverlay", help="Config overlay to write")
+    parser.add_argument("--quantile", type=float, default=0.95,
+                        help="Fraction of the observed runs that the refitted memory must cover")
+    parser.add_argument("--minSamples", type=int, default=5,
+                        help="Only refit jobs with at least this many observed runs")
+    options = parser.parse_args()
+    if not 0 <= options.quantile <= 1:
+        raise RuntimeError("--quantile must be between 0 and 1")
+
+    from cactus.pipeline import cactus_workflow
+    records = []
+    for path in options.inputs:
+        records += readRecords(path)
+    jobs = set([record.get("job") for record in records])
+    currentPolys = dict([(job, getattr(cactus_workflow, job).memoryPoly) for job in jobs
+                         if hasattr(getattr(cactus_workflow, job, None), "memoryPoly")])
+    fits = fitMemoryPolys(records, options.quantile, options.minSamples, currentPolys)
+    if len(fits) == 0:
+        raise RuntimeError("No job had {} runs with memory records".format(options.minSamples))
+    ET.ElementTree(makeMemoryOverlay(fits)).write(options.outputOverlay)
+    writeWasteReport(fits, sys.stdout)
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("jobStore", help="Job store of a workflow run with --stats")
+    parser.add_argument("--groupBy", nargs="+", choices=GROUP_FIELDS, default=["phase", "tool", "bucket"],
+                        help="Fields to group the calls by. bucket is the order of magnitude of the "
+                        "input size feature the job's resources are modelled on")
+    parser.add_argument("--json", action="store_true",
+                        help="Write the summary as JSON rather than a tab-separated table")
+    parser.add_argument("--records", default=None,
+                        help="Also write every call record to this file, as JSON lines")
+    options = parser.parse_args()
+
+    records = readCallRecords(Toil.resumeJobStore(options.jobStore))
+    if len(records) == 0:
+        raise RuntimeError("No call records found in {}. Was the workflow run with --stats?".format(options.jobStore))
+    if options.records:
+        with open(options.records, "w") as recordsFile:
+            for record in records:
+                recordsFile.write(json.dumps(record) + "\n")
+
+    rows = summarizeCallRecords(records, options.groupBy)
+    if options.json:
+        json.dump(rows, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        writeSummary(rows, options.groupBy, sys.stdout)
+
+if __name__ == '__main__':
+    main()
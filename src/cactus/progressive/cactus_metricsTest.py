@@ -0,0 +1,101 @@
+"""Tests summarizing the call records of a workflow
+"""
+import io
+import unittest
+import xml.etree.ElementTree as ET
+
+from cactus.shared import callMetrics
+from cactus.shared.test import FakeJobStore
+from cactus.shared.configWrapper import ConfigWrapper
+from cactus.progressive.cactus_metrics import readCallRecords, summarizeCallRecords, writeSummary, \
+    getJobPeaks, fitPolynomial, fitMemoryPolys, makeMemoryOverlay
+
+
+def makeRecord(tool, phase, size, wallTime, maxRss=None, exitCode=0):
+    return {"tool": tool, "phase": phase, "job": "Job", "feature": "totalSequenceSize",
+            "features": {"totalSequenceSize": size}, "wall_time": wallTime,
+            "user_time": wallTime / 2, "sys_time": 0.0, "max_rss": maxRss,
+            "read_bytes": None, "write_bytes": 10, "exit_code": exitCode}
+
+
+class TestCase(unittest.TestCase):
+    def testReadCallRecords(self):
+        # Toil's own stats are skipped
+        records = [makeRecord("cactus_caf", "caf", 10, 1.0)]
+        jobStore = FakeJobStore([{"workers": {"logsToMaster": []}},
+                                 {callMetrics.STATS_KEY: records},
+                                 {callMetrics.STATS_KEY: records}])
+        self.assertEqual(readCallRecords(jobStore), records + records)
+
+    def testSummarize(self):
+        records = [makeRecord("cactus_caf", "caf", 1500, 4.0, maxRss=100),
+                   makeRecord("cactus_caf", "caf", 2500, 2.0, maxRss=300, exitCode=1),
+                   makeRecord("cactus_caf", "caf", 25000, 1.0),
+                   makeRecord("cactus_bar", "bar", 1500, 10.0, maxRss=50)]
+        rows = summarizeCallRecords(records)
+        self.assertEqual([(r["phase"], r["tool"], r["bucket"]) for r in rows],
+                         [("bar", "cactus_bar", "totalSequenceSize:1e3-1e4"),
+                          ("caf", "cactus_caf", "totalSequenceSize:1e3-1e4"),
+                          ("caf", "cactus_caf", "totalSequenceSize:1e4-1e5")])
+        caf = rows[1]
+        self.assertEqual(caf["calls"], 2)
+        self.assertEqual(caf["failed"], 1)
+        self.assertEqual(caf["wall_time"], 6.0)
+        self.assertEqual(caf["mean_wall_time"], 3.0)
+        self.assertEqual(caf["cpu_time"], 3.0)
+        self.assertEqual(caf["max_rss"], 300)
+        self.assertEqual(caf["mean_rss"], 200)
+        self.assertEqual(caf["read_bytes"], None)
+        self.assertEqual(caf["write_bytes"], 20)
+        self.assertEqual(rows[2]["max_rss"], None)
+
+        rows = summarizeCallRecords(records, groupBy=["tool"])
+        self.assertEqual([(r["tool"], r["calls"]) for r in rows], [("cactus_bar", 1), ("cactus_caf", 3)])
+        out = io.StringIO()
+        writeSummary(rows, ["tool"], out)
+        lines = out.getvalue().split("\n")
+        self.assertEqual(lines[0].split("\t")[:3], ["tool", "calls", "failed"])
+        self.assertEqual(lines[2].split("\t")[:4], ["cactus_caf", "3", "1", "7.00"])
+
+    def testFitPolynomial(self):
+        xs = [1e9, 2e9, 3e9, 4e9]
+        poly = fitPolynomial(xs, [2e-9 * x * x + 3 * x + 5e9 for x in xs], 2)
+        self.assertAlmostEqual(poly[0] / 2e-9, 1)
+        self.assertAlmostEqual(poly[1] / 3, 1)
+        self.assertAlmostEqual(poly[2] / 5e9, 1)
+        # Not enough distinct points for the degree
+        self.assertEqual(len(fitPolynomial([1, 1], [2, 3], 1)), 1)
+
+    def testFitMemoryPolys(self):
+        records = []
+        for i in range(1, 21):
+            # Two calls per run, and the run's peak is the larger
+            for rss in [10 * i, 100 * i + (50 if i == 20 else 0)]:
+                record = makeRecord("cactus_caf", "caf", i, 1.0, maxRss=rss)
+                record["job_id"] = "run%d" % i
+                records.append(record)
+        self.assertEqual(sorted(getJobPeaks(records)[("Job", "caf", "totalSequenceSize")])[:2],
+                         [(1, 100), (2, 200)])
+        fits = fitMemoryPolys(records, safetyQuantile=1.0, currentPolys={"Job": [1000, 0]})
+        self.assertEqual(len(fits), 1)
+        fit = fits[0]
+        self.assertEqual(fit["samples"], 20)
+        self.assertEqual(fit["refit"]["ooms"], 0)
+        self.assertEqual(fit["current"]["ooms"], 0)
+        self.assertLess(fit["refit"]["wasted_bytes"], fit["current"]["wasted_bytes"])
+        self.assertEqual(fitMemoryPolys(records, minSamples=21), [])
+
+        # The overlay sets the polynomial on the job's node in its phase
+        config = ConfigWrapper(ET.fromstring('<cactusWorkflowConfig><caf minimumTreeCoverage="0.3">'
+                                             '<Job memory="10"/></caf></cactusWorkflowConfig>'))
+        config.applyOverlay(makeMemoryOverlay(fits))
+        jobNode = config.xmlRoot.find("caf").find("Job")
+        self.assertEqual(jobNode.attrib["memory"], "10")
+        self.assertEqual(jobNode.attrib["memoryPolyFeature"], "totalSequenceSize")
+        self.assertEqual(float(jobNode.attrib["memoryPolyMaxFeature"]), 20)
+        self.assertEqual([float(c) for c in jobNode.attrib["memoryPoly"].split()], fit["memoryPoly"])
+        self.assertEqual(config.xmlRoot.find("caf").attrib["minimumTreeCoverage"], "0.3")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -119,6 +119,8 @@ def main(toil_mode=False):
     parser.add_argument("--alignPreemptible", type=int, help="Preemptible attempt count for each cactus-align job [default=1]", default=1)
     parser.add_argument("--halAppendPreemptible", type=int, help="Preemptible attempt count for each halAppendSubtree job [default=1]", default=1)
     parser.add_argument("--database", choices=["kyoto_tycoon", "redis"], help="The type of database", default="kyoto_tycoon")
+    parser.add_argument("--criticalPath", action="store_true", help="Report the longest chain of dependent jobs, using costs estimated "
+                        "from the input sequence sizes, at the end of the plan (or in the log with cactus-prepare-toil)")
 
     options = parser.parse_args()
     #todo support root option
@@ -431,8 +433,11 @@ def get_plan(options, project, inSeqFile, outSeqFile, toil):
         # (using RoundedJob because root job must be sublcass of Job,
         #  https://github.com/ComparativeGenomicsToolkit/cactus/pull/284#issuecomment-684125478)
         start_job = RoundedJob()
-        parent_job = start_job
         job_idx = {}
+
+    # the exact dependencies of every task, keyed on (task, event).  each toil job is hooked onto
+    # only the jobs it depends on, rather than waiting for every job in the previous round
+    task_deps = {}
     
     # preprocessing
     plan += '\n## Preprocessor\n'
@@ -442,15 +447,18 @@ def get_plan(options, project, inSeqFile, outSeqFile, toil):
         if options.wdl:
             plan += wdl_call_preprocess(options, inSeqFile, outSeqFile, pre_batch)
         elif options.toil:
-            job_idx[("preprocess", leaves[i])] = parent_job.addChildJobFn(toil_call_preprocess, options, inSeqFile, outSeqFile, leaves[i],
-                                                                          cores=options.preprocessCores,
-                                                                          memory=options.preprocessMemory,
-                                                                          disk=options.preprocessDisk)
+            job_idx[("preprocess", leaves[i])] = start_job.addChildJobFn(toil_call_preprocess, options, inSeqFile, outSeqFile, leaves[i],
+                                                                         cores=options.preprocessCores,
+                                                                         memory=options.preprocessMemory,
+                                                                         disk=options.preprocessDisk)
         else:
             plan += 'cactus-preprocess {} {} {} --inputNames {} {} {}\n'.format(
                 get_jobstore(options), options.seqFile, options.outSeqFile, ' '.join(pre_batch),
                 options.cactusOptions, get_toil_resource_opts(options, 'preprocess'))
 
+    for leaf in leaves:
+        task_deps[("preprocess", leaf)] = []
+
     if options.preprocessOnly:
         plan += '\n## Cactus\n'
         plan += 'cactus {} {} {} {}\n'.format(get_jobstore(options), options.outSeqFile,
@@ -476,7 +484,7 @@ def get_plan(options, project, inSeqFile, outSeqFile, toil):
     def get_deps(event):
         deps = set(schedule.deps(event))
         if event in follow_on_deps:
-            deps = deps.union(set(follow_on_deps[event]))
+            deps.add(follow_on_deps[event])
         # I don't know why the schedule doesn't always give the children
         # todo: understand!
         try:
@@ -524,6 +532,27 @@ def get_plan(options, project, inSeqFile, outSeqFile, toil):
             events_and_virtuals.remove(tr)
         groups.append(group)
 
+    def get_blast_deps(event):
+        """ get the tasks whose output the blast (and therefore align) of event needs: the preprocessed
+        leaves and aligned ancestors it takes sequence from, plus any events the schedule puts first,
+        looking through virtual events to the real ones they stand for """
+        leaf_deps, anc_deps = get_dep_names(options, project, event)
+        dep_tasks = [("preprocess", dep) for dep in leaf_deps] + [("align", dep) for dep in anc_deps]
+        to_visit = list(get_deps(event))
+        visited = set()
+        while len(to_visit) > 0:
+            dep = to_visit.pop()
+            if dep in visited:
+                continue
+            visited.add(dep)
+            if dep in leaves:
+                dep_tasks.append(("preprocess", dep))
+            elif schedule.isVirtual(dep):
+                to_visit += list(get_deps(dep))
+            else:
+                dep_tasks.append(("align", dep))
+        return sorted(set(dep_tasks))
+
     def halPath(event):
         if event == project.mcTree.getRootName():
             return options.outHal
@@ -536,12 +565,10 @@ def get_plan(options, project, inSeqFile, outSeqFile, toil):
     plan += '\n## Alignment\n'
     for i, group in enumerate(groups):
         plan += '\n### Round {}'.format(i)
-        if options.toil:
-            # advance toil phase
-            # todo: recapitulate exact dependencies
-            parent_job = parent_job.addFollowOn(Job())
         for event in sorted(group):
             plan += '\n'
+            task_deps[("blast", event)] = get_blast_deps(event)
+            task_deps[("align", event)] = [("blast", event)]
             if options.wdl:
                 plan += wdl_call_blast(options, project, event, cigarPath(event))
                 plan += wdl_call_align(options, project, event, cigarPath(event), halPath(event), outSeqFile.pathMap[event])
@@ -549,17 +576,18 @@ def get_plan(options, project, inSeqFile, outSeqFile, toil):
                 # promises only get fulfilleed if they are passed directly as arguments to the toil job, so we pull out the ones we need here
                 leaf_deps, anc_deps = get_dep_names(options, project, event)
                 fa_promises = [job_idx[("preprocess", dep)].rv() for dep in leaf_deps] + [job_idx[("align", dep)].rv(0) for dep in anc_deps]
-                job_idx[("blast", event)] = parent_job.addChildJobFn(toil_call_blast,
-                                                                     options,
-                                                                     outSeqFile,
-                                                                     project,
-                                                                     event,
-                                                                     cigarPath(event),
-                                                                     leaf_deps + anc_deps,
-                                                                     *fa_promises,
-                                                                     cores=options.blastCores,
-                                                                     memory=options.blastMemory,
-                                                                     disk=options.preprocessDisk)
+                job_idx[("blast", event)] = toil_add_job(start_job, job_idx, task_deps[("blast", event)],
+                                                         Job.wrapJobFn(toil_call_blast,
+                                                                       options,
+                                                                       outSeqFile,
+                                                                       project,
+                                                                       event,
+                                                                       cigarPath(event),
+                                                                       leaf_deps + anc_deps,
+                                                                       *fa_promises,
+                                                                       cores=options.blastCores,
+                                                                       memory=options.blastMemory,
+                                                                       disk=options.preprocessDisk))
                 job_idx[("align", event)] = job_idx[("blast", event)].addFollowOnJobFn(toil_call_align,
                                                                                        options, outSeqFile,
                                                                                        project,
@@ -583,42 +611,61 @@ def get_plan(options, project, inSeqFile, outSeqFile, toil):
                 # todo: just output the fasta in cactus-align.
                 plan += 'hal2fasta {} {} {} > {}\n'.format(halPath(event), event, options.halOptions, outSeqFile.pathMap[event])
 
-    # advance toil phase
-    if options.toil:
-        parent_job = parent_job.addFollowOn(Job())
-                
-    # stitch together the final tree
+    # stitch together the final tree.  each event's subtree is merged into its parent's hal as soon as
+    # it is complete, so that independent subtrees are merged in parallel, round by round up the tree
     plan += '\n## HAL merging\n'
     root = project.mcTree.getRootName()
-    prev_event = None
-    append_count = 0
-    event_list = []
-    for group in reversed(groups):
-        for event in group:
-            if event != root:
-                if options.wdl:
-                    plan += wdl_call_hal_append(options, project, event, prev_event)
-                elif not options.toil:
-                    plan += 'halAppendSubtree {} {} {} {} --merge {}\n'.format(
-                        halPath(root), halPath(event), event, event, options.halOptions)
-                append_count += 1
-                event_list.append(event)
-            prev_event = event
+    subtree_hal = {}
+    subtree_task = {}
+    for i, merge_round in enumerate(get_hal_merge_rounds(project, [event for group in groups for event in group])):
+        plan += '\n### Merge round {}\n'.format(i)
+        for event, child_events in merge_round:
+            task_deps[("hal_append", event)] = [("align", event)] + [subtree_task.get(e, ("align", e)) for e in child_events]
+            subtree_task[event] = ("hal_append", event)
+            if options.wdl:
+                parent_hal = '{}.out_hal_file'.format(align_call_name(event))
+                for child_event in child_events:
+                    plan += wdl_call_hal_append(options, parent_hal, subtree_hal.get(child_event, '{}.out_hal_file'.format(align_call_name(child_event))),
+                                                child_event)
+                    parent_hal = '{}.out_file'.format(hal_append_call_name(child_event))
+                subtree_hal[event] = parent_hal
+            elif options.toil:
+                job_idx[('hal_append', event)] = toil_add_job(start_job, job_idx, task_deps[('hal_append', event)],
+                                                              Job.wrapJobFn(toil_call_hal_append_subtrees,
+                                                                            options,
+                                                                            project,
+                                                                            event,
+                                                                            job_idx[('align', event)].rv(1),
+                                                                            child_events,
+                                                                            *[subtree_hal.get(e, job_idx[('align', e)].rv(1)) for e in child_events],
+                                                                            cores=1,
+                                                                            memory=options.alignMemory,
+                                                                            disk=options.halAppendDisk))
+                subtree_hal[event] = job_idx[('hal_append', event)].rv()
+            else:
+                # the appends for different events in a round are independent, so give each its own line
+                plan += ' && '.join(['halAppendSubtree {} {} {} {} --merge {}'.format(
+                    halPath(event), halPath(child_event), child_event, child_event, options.halOptions) for child_event in child_events]) + '\n'
 
     if options.toil:
-        job_idx['hal_append'] = parent_job.addChildJobFn(toil_call_hal_append_subtrees,
-                                                         options,
-                                                         project,
-                                                         root,
-                                                         job_idx[('align', root)].rv(1),
-                                                         event_list,
-                                                         *[job_idx[('align', e)].rv(1) for e in event_list],
-                                                         cores=1,
-                                                         memory=options.alignMemory,
-                                                         disk=options.halAppendDisk)
+        job_idx['hal_export'] = toil_add_job(start_job, job_idx, [subtree_task.get(root, ('align', root))],
+                                             Job.wrapJobFn(toil_call_export_hal,
+                                                           options,
+                                                           root,
+                                                           subtree_hal.get(root, job_idx[('align', root)].rv(1)),
+                                                           cores=1,
+                                                           memory=options.alignMemory,
+                                                           disk=options.halAppendDisk))
+
+    if options.criticalPath:
+        report = get_critical_path_report(options, inSeqFile, outSeqFile, task_deps, groups)
+        if options.toil:
+            logger.info(report)
+        else:
+            plan += '\n' + '\n'.join(['# ' + line if line else '' for line in report.split('\n')])
 
     if options.wdl:
-        plan += wdl_workflow_end(options, prev_event, append_count > 1)
+        plan += wdl_workflow_end(options, subtree_hal.get(root, '{}.out_hal_file'.format(align_call_name(root))))
 
     if options.toil:
         start_time = timeit.default_timer()
@@ -674,6 +721,121 @@ def get_dep_names(options, project, event):
             anc_names.append(input_name)
     return leaf_names, anc_names
     
+def get_hal_merge_rounds(project, events):
+    """ group the events that have children among the given events into rounds of hal merging, where
+    every event in a round has had all of its children's subtrees completed in earlier rounds.  each
+    round is a list of (event, child events) pairs, so the number of rounds is the height of the tree """
+    event_set = set(events)
+    heights = {}
+    def get_height(event):
+        if event not in heights:
+            node = project.mcTree.nameToId[event]
+            children = [project.mcTree.getName(child) for child in project.mcTree.getChildren(node)]
+            child_events = sorted([child for child in children if child in event_set])
+            heights[event] = (max([get_height(child) for child in child_events]) + 1 if child_events else 0, child_events)
+        return heights[event][0]
+    rounds = []
+    for event in sorted(event_set):
+        height = get_height(event)
+        if height > 0:
+            while len(rounds) < height:
+                rounds.append([])
+            rounds[height - 1].append((event, heights[event][1]))
+    return rounds
+    
+def toil_add_job(start_job, job_idx, dep_tasks, job):
+    """ add the job as a child of every job it depends on (or of the start job if there are none),
+    so that toil runs it as soon as its own inputs are ready """
+    parent_jobs = [job_idx[dep_task] for dep_task in dep_tasks if dep_task in job_idx]
+    if len(parent_jobs) == 0:
+        parent_jobs = [start_job]
+    for parent_job in parent_jobs:
+        parent_job.addChild(job)
+    return job
+
+def get_critical_path_report(options, in_seq_file, out_seq_file, task_deps, groups):
+    """ estimate the cost of every task from the sizes of the input sequences, then find the
+    longest chain of dependent tasks. this is a lower bound on the wall time no matter how many
+    jobs run at once. it is compared to the estimate for running the alignments in rounds """
+    tree = out_seq_file.tree
+    # use the fasta sizes when they're all available locally, otherwise just count genomes
+    leaf_sizes = {}
+    for leaf in tree.getLeaves():
+        name = tree.getName(leaf)
+        path = in_seq_file.pathMap.get(name, '')
+        leaf_sizes[name] = os.path.getsize(path) if '://' not in path and os.path.isfile(path) else None
+    use_sizes = all([size is not None for size in leaf_sizes.values()])
+    genome_sizes = {}
+    def genome_size(node):
+        name = tree.getName(node)
+        if name not in genome_sizes:
+            if tree.isLeaf(node):
+                genome_sizes[name] = leaf_sizes[name] if use_sizes else 1
+            else:
+                # guess an ancestor is as big as its biggest child
+                genome_sizes[name] = max([genome_size(child) for child in tree.getChildren(node)])
+        return genome_sizes[name]
+    genome_size(tree.getRootId())
+
+    def task_cost(task):
+        step, event = task
+        if step == 'preprocess':
+            return genome_sizes[event]
+        elif step in ['blast', 'align']:
+            # these scale with all the sequence that goes into the subproblem
+            return sum([genome_sizes[dep[1]] for dep in task_deps[('blast', event)]])
+        elif step == 'hal_append':
+            return sum([genome_sizes[dep[1]] for dep in task_deps[task][1:]])
+        return 0
+
+    finish = {}
+    critical_dep = {}
+    def finish_time(task):
+        if task not in finish:
+            deps = [dep for dep in task_deps.get(task, []) if dep in task_deps]
+            start = 0
+            critical_dep[task] = None
+            for dep in deps:
+                if finish_time(dep) > start:
+                    start = finish_time(dep)
+                    critical_dep[task] = dep
+            finish[task] = start + task_cost(task)
+        return finish[task]
+
+    last_task = max(task_deps.keys(), key = finish_time)
+    path = [last_task]
+    while critical_dep[path[-1]] is not None:
+        path.append(critical_dep[path[-1]])
+    path.reverse()
+
+    # the old way: every round waits for the slowest job in the round before it
+    round_time = max([task_cost(task) for task in task_deps if task[0] == 'preprocess'])
+    for group in groups:
+        if len(group) > 0:
+            round_time += max([task_cost(('blast', event)) + task_cost(('align', event)) for event in group])
+    append_costs = {}
+    for task in task_deps:
+        if task[0] == 'hal_append':
+            append_costs[task] = task_cost(task)
+    append_levels = {}
+    def append_level(task):
+        if task not in append_levels:
+            append_levels[task] = max([append_level(dep) for dep in task_deps[task] if dep[0] == 'hal_append'] + [0]) + 1
+        return append_levels[task]
+    for level in set([append_level(task) for task in append_costs]):
+        round_time += max([append_costs[task] for task in append_costs if append_level(task) == level])
+
+    total = sum([task_cost(task) for task in task_deps])
+    unit = 'bytes of input sequence' if use_sizes else 'input genomes'
+    report = '## Critical path\n'
+    report += 'task costs are estimated in {}\n'.format(unit)
+    report += 'total cost of all tasks : {}\n'.format(total)
+    report += 'critical path length : {} ({:.1f}% of total)\n'.format(finish[last_task], 100. * finish[last_task] / max(total, 1))
+    report += 'length when run in rounds : {}\n'.format(round_time)
+    for task in path:
+        report += '    {} {} : cost={} finish={}\n'.format(task[0], task[1], task_cost(task), finish[task])
+    return report
+
 def wdl_workflow_start(options, in_seq_file):
 
     s = 'version 1.0\n\n'
@@ -707,13 +869,10 @@ def wdl_workflow_start(options, in_seq_file):
     s += '    }\n'
     return s
 
-def wdl_workflow_end(options, event, was_appended):
+def wdl_workflow_end(options, out_hal):
     s = '\n'
     s += '    output {\n'
-    if was_appended:
-        s += '        File out_hal = {}.out_file\n'.format(hal_append_call_name(event))
-    else:
-        s += '        File out_hal = {}.out_hal_file\n'.format(align_call_name(event))
+    s += '        File out_hal = {}\n'.format(out_hal)
     s += '    }\n'
     s += '}\n'
     return s
@@ -1030,15 +1189,8 @@ def wdl_task_hal_append(options):
 
     return s
 
-def wdl_call_hal_append(options, project, event, prev_event):
-
-    if prev_event == project.mcTree.getRootName():
-        # first time: the parent comes out of align
-        parent_hal = '{}.out_hal_file'.format(align_call_name(prev_event))
-    else:
-        # otherwise, it comes from the previous append
-        parent_hal = '{}.out_file'.format(hal_append_call_name(prev_event))
-    child_hal = '{}.out_hal_file'.format(align_call_name(event))
+def wdl_call_hal_append(options, parent_hal, child_hal, event):
+    """ append the subtree of event, from child_hal, into parent_hal.  the hal file inputs are wdl expressions """
     s = '    call hal_append_subtree as {} {{\n'.format(hal_append_call_name(event))
     s += '        input:'
     s += ' in_hal_parent={},'.format(parent_hal)
@@ -1065,6 +1217,14 @@ def toil_call_hal_append_subtrees(job, options, project, root_name, root_hal_id,
         cactus_call(parameters=['halAppendSubtree', root_file, hal_files[-1], event_name, event_name, '--merge'] +
                     options.halOptions.strip().split(' '))
 
+    return job.fileStore.writeGlobalFile(root_file)
+
+def toil_call_export_hal(job, options, root_name, hal_id):
+
+    work_dir = job.fileStore.getLocalTempDir()
+    root_file = os.path.join(work_dir, '{}.hal'.format(root_name))
+    job.fileStore.readGlobalFile(hal_id, root_file)
+
     # bypassing toil.exportFile for now as it only works on promises returned by the
     # start job, which isn't how this is set up. also in practice it's often more convenient
     # to output to s3
@@ -1076,7 +1236,7 @@ def toil_call_hal_append_subtrees(job, options, project, root_name, root_hal_id,
         # write the output to disk
         shutil.copy2(root_file,  options.outHal)
 
-    return job.fileStore.writeGlobalFile(root_file)
+    return hal_id
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import unittest
+from argparse import Namespace
+from unittest.mock import patch
+
+from sonLib.bioio import TestStatus
+from sonLib.nxnewick import NXNewick
+
+from cactus.progressive.multiCactusTree import MultiCactusTree
+from cactus.progressive.cactus_prepare import get_hal_merge_rounds, get_critical_path_report, get_plan
+
+class FakeProject:
+    def __init__(self, newick):
+        self.mcTree = MultiCactusTree(NXNewick().parseString(newick, addImpliedRoots = False))
+
+class FakeSeqFile:
+    def __init__(self, newick, pathMap):
+        self.tree = MultiCactusTree(NXNewick().parseString(newick, addImpliedRoots = False))
+        self.pathMap = pathMap
+
+class FakeSchedule:
+    """ the dependencies, follow-ons and virtual events that Schedule would compute from the experiments """
+    def __init__(self, deps, followOns, virtuals):
+        self.depMap = deps
+        self.followOns = followOns
+        self.virtuals = virtuals
+    def loadProject(self, project):
+        pass
+    def compute(self):
+        pass
+    def deps(self, name):
+        return self.depMap.get(name, [])
+    def followOn(self, name):
+        return self.followOns.get(name)
+    def isVirtual(self, name):
+        return name in self.virtuals
+
+class FakePromise:
+    def __init__(self, job, path):
+        self.job = job
+        self.path = path
+    def __eq__(self, other):
+        return isinstance(other, FakePromise) and self.job is other.job and self.path == other.path
+
+class RecorderJob:
+    """ stands in for toil's Job, recording the jobs each job is hooked onto instead of running anything """
+    jobs = []
+    def __init__(self, fn=None, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.parents = []
+        self.followOnOf = None
+        RecorderJob.jobs.append(self)
+    @staticmethod
+    def wrapJobFn(fn, *args, **kwargs):
+        return RecorderJob(fn, *args, **kwargs)
+    def addChild(self, job):
+        job.parents.append(self)
+        return job
+    def addChildJobFn(self, fn, *args, **kwargs):
+        return self.addChild(RecorderJob(fn, *args, **kwargs))
+    def addFollowOnJobFn(self, fn, *args, **kwargs):
+        job = RecorderJob(fn, *args, **kwargs)
+        job.followOnOf = self
+        return job
+    def rv(self, *path):
+        return FakePromise(self, path)
+    def runsAfter(self, other):
+        """ is other sure to have finished before this job starts? """
+        return any([parent is other or parent.runsAfter(other) for parent in self.parents]) or \
+            (self.followOnOf is not None and (self.followOnOf is other or self.followOnOf.runsAfter(other)))
+
+class FakeToil:
+    def start(self, job):
+        self.rootJob = job
+
+class TestCase(unittest.TestCase):
+
+    @TestStatus.shortLength
+    def testHalMergeRoundsBalanced(self):
+        project = FakeProject('(((a,b)Anc3,(c,d)Anc4)Anc1,((e,f)Anc5,(g,h)Anc6)Anc2)Anc0;')
+        events = ['Anc0', 'Anc1', 'Anc2', 'Anc3', 'Anc4', 'Anc5', 'Anc6']
+        rounds = get_hal_merge_rounds(project, events)
+        # the number of rounds is the height of the tree, not the number of ancestors
+        self.assertEqual(rounds, [[('Anc1', ['Anc3', 'Anc4']), ('Anc2', ['Anc5', 'Anc6'])],
+                                  [('Anc0', ['Anc1', 'Anc2'])]])
+
+    @TestStatus.shortLength
+    def testHalMergeRoundsUnbalanced(self):
+        project = FakeProject('(((a,b)Anc2,c)Anc1,d)Anc0;')
+        rounds = get_hal_merge_rounds(project, ['Anc0', 'Anc1', 'Anc2'])
+        self.assertEqual(rounds, [[('Anc1', ['Anc2'])], [('Anc0', ['Anc1'])]])
+        self.assertEqual(get_hal_merge_rounds(project, ['Anc0']), [])
+
+    @TestStatus.shortLength
+    def testCriticalPath(self):
+        newick = '((a,b)Anc1,(c,d)Anc2)Anc0;'
+        seqFile = FakeSeqFile(newick, dict([(leaf, 'http://{}.fa'.format(leaf)) for leaf in 'abcd']))
+        task_deps = dict([(('preprocess', leaf), []) for leaf in 'abcd'])
+        task_deps[('blast', 'Anc1')] = [('preprocess', 'a'), ('preprocess', 'b'), ('preprocess', 'c')]
+        task_deps[('blast', 'Anc2')] = [('preprocess', 'c'), ('preprocess', 'd')]
+        task_deps[('blast', 'Anc0')] = [('align', 'Anc1'), ('align', 'Anc2')]
+        for event in ['Anc0', 'Anc1', 'Anc2']:
+            task_deps[('align', event)] = [('blast', event)]
+        task_deps[('hal_append', 'Anc0')] = [('align', 'Anc0'), ('align', 'Anc1'), ('align', 'Anc2')]
+        report = get_critical_path_report(None, seqFile, seqFile, task_deps, [['Anc1', 'Anc2'], ['Anc0']])
+        # remote inputs, so each genome costs 1: preprocess (1), Anc1 (3 + 3), Anc0 (2 + 2) then the append (2)
+        self.assertTrue('critical path length : 13' in report)
+        self.assertTrue('length when run in rounds : 13' in report)
+        self.assertTrue('    blast Anc1 : cost=3 finish=4' in report)
+
+    @TestStatus.shortLength
+    def testToilPlan(self):
+        newick = '((a,b)Anc1,(c,d)Anc2)Anc0;'
+        project = FakeProject(newick)
+        seqFile = FakeSeqFile(newick, dict([(name, '{}.fa'.format(name)) for name in ['a', 'b', 'c', 'd', 'Anc0', 'Anc1', 'Anc2']]))
+        # Anc2 uses Anc1 as an outgroup, and the schedule makes it a follow-on of Anc1.  Anc0 reaches its
+        # children through a virtual event
+        schedule = FakeSchedule({'Anc0': ['virtual0'], 'virtual0': ['Anc1', 'Anc2']}, {'Anc1': 'Anc2'}, set(['virtual0']))
+        dep_names = {'Anc1': (['a', 'b', 'c'], []), 'Anc2': (['c', 'd'], ['Anc1']), 'Anc0': ([], ['Anc1', 'Anc2'])}
+        options = Namespace(wdl=False, toil=True, preprocessOnly=False, preprocessBatchSize=1, criticalPath=False,
+                            outDir='out', outHal='out/Anc0.hal', preprocessCores=1, preprocessMemory=None, preprocessDisk=None,
+                            blastCores=1, blastMemory=None, alignCores=2, alignMemory=None, alignDisk=None, halAppendDisk=None)
+        toil = FakeToil()
+        RecorderJob.jobs = []
+        with patch('cactus.progressive.cactus_prepare.RoundedJob', RecorderJob), \
+             patch('cactus.progressive.cactus_prepare.Job', RecorderJob), \
+             patch('cactus.progressive.cactus_prepare.Schedule', lambda: schedule), \
+             patch('cactus.progressive.cactus_prepare.get_dep_names', lambda options, project, event: dep_names[event]):
+            get_plan(options, project, seqFile, seqFile, toil)
+
+        # name each job by its task and event
+        jobs = {}
+        for job in RecorderJob.jobs:
+            if job.fn is None:
+                jobs['start'] = job
+            elif job.fn.__name__ == 'toil_call_hal_append_subtrees':
+                jobs[('hal_append', job.args[2])] = job
+            elif job.fn.__name__ == 'toil_call_export_hal':
+                jobs[('hal_export', job.args[1])] = job
+            else:
+                jobs[(job.fn.__name__[len('toil_call_'):], job.args[3])] = job
+        self.assertTrue(toil.rootJob is jobs['start'])
+        self.assertEqual(len(jobs), 1 + 4 + 3 + 3 + 1 + 1)
+
+        # each job is hooked onto exactly the jobs it depends on
+        expected_parents = {('blast', 'Anc1'): [('preprocess', 'a'), ('preprocess', 'b'), ('preprocess', 'c')],
+                            ('blast', 'Anc2'): [('align', 'Anc1'), ('preprocess', 'c'), ('preprocess', 'd')],
+                            ('blast', 'Anc0'): [('align', 'Anc1'), ('align', 'Anc2')],
+                            ('hal_append', 'Anc0'): [('align', 'Anc0'), ('align', 'Anc1'), ('align', 'Anc2')],
+                            ('hal_export', 'Anc0'): [('hal_append', 'Anc0')]}
+        for leaf in 'abcd':
+            expected_parents[('preprocess', leaf)] = ['start']
+        for task, job in jobs.items():
+            if task == 'start' or task[0] == 'align':
+                self.assertEqual(job.parents, [])
+            else:
+                self.assertEqual(sorted([job_task for job_task, parent in jobs.items() if parent in job.parents], key=str),
+                                 sorted(expected_parents[task], key=str))
+        for event in ['Anc0', 'Anc1', 'Anc2']:
+            self.assertTrue(jobs[('align', event)].followOnOf is jobs[('blast', event)])
+
+        # the fasta promises follow the order of the names passed with them, and every promise a
+        # job is given is fulfilled by a job that finishes before it starts
+        for event in ['Anc0', 'Anc1', 'Anc2']:
+            names = dep_names[event][0] + dep_names[event][1]
+            for task in ['blast', 'align']:
+                job = jobs[(task, event)]
+                self.assertEqual(job.args[job.args.index(names) + 1:],
+                                 tuple([jobs[('preprocess', name)].rv() for name in dep_names[event][0]] +
+                                       [jobs[('align', name)].rv(0) for name in dep_names[event][1]]))
+        for job in jobs.values():
+            for arg in job.args:
+                if isinstance(arg, FakePromise):
+                    self.assertTrue(job.runsAfter(arg.job))
+
+if __name__ == '__main__':
+    unittest.main()
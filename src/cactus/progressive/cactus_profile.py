@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Put together the Python profiles of the jobs of a cactus workflow.
+
+The profiles are kept in the job store of a workflow run with CACTUS_PROFILE
+set in its environment (and with a job store that is kept, eg with --clean
+never). The stacks of all the jobs of each class are summed into a collapsed
+stack file per class, for flamegraph.pl or speedscope, and the frames that
+took the most samples in each class are listed.
+"""
+
+import os
+from argparse import ArgumentParser
+
+from toil.common import Toil
+
+from cactus.shared import callMetrics
+from cactus.shared import jobProfiler
+
+def readProfiles(jobStore):
+    """Get all the job profiles from a job store."""
+    return [stats[jobProfiler.STATS_KEY] for stats in callMetrics.readStats(jobStore)
+            if jobProfiler.STATS_KEY in stats]
+
+def aggregateProfiles(profiles):
+    """Sum the profiles of each job class. Returns a dict from job class to a
+    dict with the number of jobs, the seconds sampled and the stack counts."""
+    byJob = {}
+    for profile in profiles:
+        aggregate = byJob.setdefault(profile["job"], {"jobs": 0, "seconds": 0.0, "stacks": {}})
+        aggregate["jobs"] += 1
+        aggregate["seconds"] += profile["samples"] * profile["interval"]
+        for stack, count in profile["stacks"].items():
+            aggregate["stacks"][stack] = aggregate["stacks"].get(stack, 0) + count
+    return byJob
+
+def getTopFrames(stacks, limit=10):
+    """Get the frames at the top of the most samples, with their counts."""
+    selfCounts = {}
+    for stack, count in stacks.items():
+        frame = stack.split(";")[-1]
+        selfCounts[frame] = selfCounts.get(frame, 0) + count
+    return sorted(selfCounts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+def writeCollapsed(stacks, outFile):
+    for stack, count in sorted(stacks.items()):
+        outFile.write("%s %d\n" % (stack, count))
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("jobStore", help="Job store of a workflow run with CACTUS_PROFILE set")
+    parser.add_argument("outDir", help="Directory to write a <job class>.collapsed stack file per job class to")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of frames to list for each job class")
+    options = parser.parse_args()
+
+    profiles = readProfiles(Toil.resumeJobStore(options.jobStore))
+    if len(profiles) == 0:
+        raise RuntimeError("No profiles found in {}. Was the workflow run with CACTUS_PROFILE set?".format(options.jobStore))
+    if not os.path.isdir(options.outDir):
+        os.makedirs(options.outDir)
+
+    byJob = aggregateProfiles(profiles)
+    for job, aggregate in sorted(byJob.items(), key=lambda item: -item[1]["seconds"]):
+        with open(os.path.join(options.outDir, "%s.collapsed" % job), "w") as collapsedFile:
+            writeCollapsed(aggregate["stacks"], collapsedFile)
+        total = sum(aggregate["stacks"].values())
+        print("%s: %d jobs, %.1f seconds sampled" % (job, aggregate["jobs"], aggregate["seconds"]))
+        for frame, count in getTopFrames(aggregate["stacks"], options.top):
+            print("\t%5.1f%%\t%s" % (100.0 * count / total, frame))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""Tests putting together the profiles of a workflow's jobs
+"""
+import io
+import unittest
+
+from cactus.shared import jobProfiler
+from cactus.shared.test import FakeJobStore
+from cactus.progressive.cactus_profile import readProfiles, aggregateProfiles, getTopFrames, \
+    writeCollapsed
+
+
+def makeProfile(job, stacks):
+    return {"job": job, "interval": 0.01, "samples": sum(stacks.values()), "stacks": stacks}
+
+
+class TestCase(unittest.TestCase):
+    def testAggregate(self):
+        profiles = [makeProfile("CactusCafPhase", {"run;trim": 30, "run;parse": 10}),
+                    makeProfile("CactusCafPhase", {"run;trim": 20}),
+                    makeProfile("RunBlast", {"run;wait": 5})]
+        jobStore = FakeJobStore([{"workers": {}}] + [{jobProfiler.STATS_KEY: p} for p in profiles])
+        self.assertEqual(readProfiles(jobStore), profiles)
+
+        byJob = aggregateProfiles(profiles)
+        self.assertEqual(byJob["CactusCafPhase"]["jobs"], 2)
+        self.assertAlmostEqual(byJob["CactusCafPhase"]["seconds"], 0.6)
+        self.assertEqual(byJob["CactusCafPhase"]["stacks"], {"run;trim": 50, "run;parse": 10})
+        self.assertEqual(getTopFrames(byJob["CactusCafPhase"]["stacks"]), [("trim", 50), ("parse", 10)])
+
+        out = io.StringIO()
+        writeCollapsed(byJob["CactusCafPhase"]["stacks"], out)
+        self.assertEqual(out.getvalue(), "run;parse 10\nrun;trim 50\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,7 @@ from cactus.shared.common import findRequiredNode
 from cactus.shared.common import makeURL
 from cactus.shared.common import catFiles
 from cactus.shared.common import cactus_call
+from cactus.shared.common import cactus_call_async
 from cactus.shared.common import RoundedJob
 from cactus.shared.common import getDockerImage
 from cactus.shared.version import cactus_commit
@@ -204,10 +205,14 @@ class ProgressiveUp(RoundedJob):
 
         return finalExpWrapper
 
-def logAssemblyStats(job, message, name, sequenceID, preemptable=True):
-    sequenceFile = job.fileStore.readGlobalFile(sequenceID)
-    analysisString = cactus_call(parameters=["cactus_analyseAssembly", sequenceFile], check_output=True)
-    job.fileStore.logToMaster("%s, got assembly stats for genome %s: %s" % (message, name, analysisString))
+def logAssemblyStats(job, message, sequenceIDMap, preemptable=True):
+    """Log the assembly stats of each genome, analysing up to one genome per core at once."""
+    names = sorted(sequenceIDMap.keys())
+    futures = [cactus_call_async(job=job, parameters=["cactus_analyseAssembly",
+                                                      job.fileStore.readGlobalFile(sequenceIDMap[name])],
+                                 check_output=True) for name in names]
+    for name, future in zip(names, futures):
+        job.fileStore.logToMaster("%s, got assembly stats for genome %s: %s" % (message, name, future.result()))
 
 class RunCactusPreprocessorThenProgressiveDown(RoundedJob):
     def __init__(self, options, project, memory=None, cores=None):
@@ -223,8 +228,8 @@ class RunCactusPreprocessorThenProgressiveDown(RoundedJob):
         fileStore.logToMaster("Using the following configuration:\n%s" % ET.tostring(self.configNode, encoding='unicode'))
 
         # Log the stats for the un-preprocessed assemblies
-        for name, sequence in list(self.project.inputSequenceIDMap.items()):
-            self.addChildJobFn(logAssemblyStats, "Before preprocessing", name, sequence)
+        self.addChildJobFn(logAssemblyStats, "Before preprocessing", self.project.inputSequenceIDMap,
+                           cores=max(1, min(len(self.project.inputSequenceIDMap), cpu_count())))
 
         # Create jobs to create the output sequences
         logger.info("Reading config file from: %s" % self.project.getConfigID())
@@ -271,8 +276,8 @@ class RunCactusPreprocessorThenProgressiveDown2(RoundedJob):
                 fileStore.exportFile(seqID, self.options.intermediateResultsUrl + '-preprocessed-' + genome)
 
         # Log the stats for the preprocessed assemblies
-        for name, sequence in list(self.project.outputSequenceIDMap.items()):
-            self.addChildJobFn(logAssemblyStats, "After preprocessing", name, sequence)
+        self.addChildJobFn(logAssemblyStats, "After preprocessing", self.project.outputSequenceIDMap,
+                           cores=max(1, min(len(self.project.outputSequenceIDMap), cpu_count())))
 
         project = self.addChild(ProgressiveDown(options=self.options, project=self.project, event=self.event, schedule=self.schedule, memory=self.configWrapper.getDefaultMemory())).rv()
 
@@ -281,7 +286,8 @@ class RunCactusPreprocessorThenProgressiveDown2(RoundedJob):
                                      disk=self.configWrapper.getExportHalDisk(),
                                      preemptable=False).rv()
 
-def exportHal(job, project, event=None, cacheBytes=None, cacheMDC=None, cacheRDC=None, cacheW0=None, chunk=None, deflate=None, inMemory=True):
+def exportHal(job, project, event=None, cacheBytes=None, cacheMDC=None, cacheRDC=None, cacheW0=None, chunk=None, deflate=None, inMemory=True,
+              parallel=None):
 
     HALPath = "tmp_alignment.hal"
 
@@ -294,48 +300,106 @@ def exportHal(job, project, event=None, cacheBytes=None, cacheMDC=None, cacheRDC
         assert event in tree.nameToId and not tree.isLeaf(tree.nameToId[event])
         rootNode = tree.nameToId[event]
 
+    halOptions = { 'cacheBytes' : cacheBytes, 'cacheMDC' : cacheMDC, 'cacheRDC' : cacheRDC, 'cacheW0' : cacheW0,
+                   'chunk' : chunk, 'deflate' : deflate, 'inMemory' : inMemory }
+
+    if parallel is None:
+        configWrapper = ConfigWrapper(ET.parse(job.fileStore.readGlobalFile(project.getConfigID())).getroot())
+        parallel = configWrapper.getExportHalParallel()
+
+    if parallel:
+        # build each subtree in its own job, merging them into their parents on the way back up
+        rootName = [tree.getName(node) for node in tree.breadthFirstTraversal(rootNode) if tree.getName(node) in project.expMap][0]
+        subtreeJob = job.addChildJobFn(exportHalSubtree, project, rootName, halOptions,
+                                       memory=job.memory, disk=job.disk, preemptable=job.preemptable)
+        return subtreeJob.addFollowOnJobFn(exportMergedHal, project, subtreeJob.rv(),
+                                           memory=job.memory, disk=job.disk, preemptable=job.preemptable).rv()
+
     for node in tree.breadthFirstTraversal(rootNode):
         genomeName = tree.getName(node)
         if genomeName in project.expMap:
-            experimentFilePath = job.fileStore.readGlobalFile(project.expIDMap[genomeName])
-            experiment = ExperimentWrapper(ET.parse(experimentFilePath).getroot())
-
-            outgroups = experiment.getOutgroupGenomes()
-            experiment.setConfigPath(job.fileStore.readGlobalFile(experiment.getConfigID()))
-            expTreeString = NXNewick().writeString(experiment.getTree(onlyThisSubtree=True))
-            assert len(expTreeString) > 1
-            assert experiment.getHalID() is not None
-            assert experiment.getHalFastaID() is not None
-            subHALPath = job.fileStore.readGlobalFile(experiment.getHalID())
-            halFastaPath = job.fileStore.readGlobalFile(experiment.getHalFastaID())
-
-            args = [os.path.basename(subHALPath), os.path.basename(halFastaPath), expTreeString, os.path.basename(HALPath)]
-
-            if len(outgroups) > 0:
-                args += ["--outgroups", ",".join(outgroups)]
-            if cacheBytes is not None:
-                args += ["--cacheBytes", cacheBytes]
-            if cacheMDC is not None:
-                args += ["--cacheMDC", cacheMDC]
-            if cacheRDC is not None:
-                args += ["--cacheRDC", cacheRDC]
-            if cacheW0 is not None:
-                args += ["--cacheW0", cacheW0]
-            if chunk is not None:
-                args += ["--chunk", chunk]
-            if deflate is not None:
-                args += ["--deflate", deflate]
-            if inMemory is True:
-                args += ["--inMemory"]
-
-            cactus_call(parameters=["halAppendCactusSubtree"] + args)
+            appendCactusSubtree(job, project, genomeName, HALPath, halOptions)
+
+    return setHalMetadata(job, project, HALPath)
+
+def appendCactusSubtree(job, project, genomeName, HALPath, halOptions):
+    """ add the alignment of one event (as output by cactus2hal) to the given HAL file, creating it if necessary """
+    experimentFilePath = job.fileStore.readGlobalFile(project.expIDMap[genomeName])
+    experiment = ExperimentWrapper(ET.parse(experimentFilePath).getroot())
+
+    outgroups = experiment.getOutgroupGenomes()
+    experiment.setConfigPath(job.fileStore.readGlobalFile(experiment.getConfigID()))
+    expTreeString = NXNewick().writeString(experiment.getTree(onlyThisSubtree=True))
+    assert len(expTreeString) > 1
+    assert experiment.getHalID() is not None
+    assert experiment.getHalFastaID() is not None
+    subHALPath = job.fileStore.readGlobalFile(experiment.getHalID())
+    halFastaPath = job.fileStore.readGlobalFile(experiment.getHalFastaID())
+
+    args = [os.path.basename(subHALPath), os.path.basename(halFastaPath), expTreeString, os.path.basename(HALPath)]
+
+    if len(outgroups) > 0:
+        args += ["--outgroups", ",".join(outgroups)]
+
+    cactus_call(parameters=["halAppendCactusSubtree"] + args + halCommandOptions(halOptions))
+
+def halCommandOptions(halOptions):
+    """ get the command line options shared by all the hal tools we use """
+    args = []
+    for option in ['cacheBytes', 'cacheMDC', 'cacheRDC', 'cacheW0', 'chunk', 'deflate']:
+        if halOptions[option] is not None:
+            args += ["--{}".format(option), halOptions[option]]
+    if halOptions['inMemory'] is True:
+        args += ["--inMemory"]
+    return args
+
+def exportHalSubtree(job, project, event, halOptions):
+    """ make a HAL file for the subtree rooted at event.  the subtrees of each child event are made in parallel child jobs
+    then merged into the HAL of event itself, so the total time depends on the depth of the tree, rather than its size """
+    tree = project.mcTree
+    childEvents = [tree.getName(child) for child in tree.getChildren(tree.nameToId[event]) if tree.getName(child) in project.expMap]
 
+    if len(childEvents) == 0:
+        return exportEventHal(job, project, event, halOptions)
+
+    eventJob = job.addChildJobFn(exportEventHal, project, event, halOptions,
+                                 memory=job.memory, disk=job.disk, preemptable=job.preemptable)
+    childJobs = [job.addChildJobFn(exportHalSubtree, project, childEvent, halOptions,
+                                   memory=job.memory, disk=job.disk, preemptable=job.preemptable) for childEvent in childEvents]
+    return job.addFollowOnJobFn(mergeHalSubtrees, eventJob.rv(), childEvents, halOptions, *[childJob.rv() for childJob in childJobs],
+                                memory=job.memory, disk=job.disk, preemptable=job.preemptable).rv()
+
+def exportEventHal(job, project, event, halOptions):
+    """ make a HAL file containing only the given event and its children """
+    HALPath = "tmp_alignment.hal"
+    appendCactusSubtree(job, project, event, HALPath, halOptions)
+    return job.fileStore.writeGlobalFile(HALPath)
+
+def mergeHalSubtrees(job, halID, childEvents, halOptions, *childHalIDs):
+    """ merge the HAL file of each child event's subtree into the given HAL file, in which the child events are leaves """
+    HALPath = job.fileStore.readGlobalFile(halID, mutable=True)
+    for childEvent, childHalID in zip(childEvents, childHalIDs):
+        childHALPath = job.fileStore.readGlobalFile(childHalID)
+        cactus_call(parameters=["halAppendSubtree", os.path.basename(HALPath), os.path.basename(childHALPath),
+                                childEvent, childEvent, "--merge"] + halCommandOptions(halOptions))
+        job.fileStore.deleteGlobalFile(childHalID)
+    job.fileStore.deleteGlobalFile(halID)
+    return job.fileStore.writeGlobalFile(HALPath)
+
+def exportMergedHal(job, project, halID):
+    """ finish off the HAL made by exportHalSubtree """
+    HALPath = job.fileStore.readGlobalFile(halID, mutable=True)
+    job.fileStore.deleteGlobalFile(halID)
+    return setHalMetadata(job, project, os.path.basename(HALPath))
+
+def setHalMetadata(job, project, HALPath):
+    """ stamp the cactus version and config into the HAL file and write it to the file store """
     cactus_call(parameters=["halSetMetadata", HALPath, "CACTUS_COMMIT", cactus_commit])
     with job.fileStore.readGlobalFileStream(project.configID) as configFile:
         cactus_call(parameters=["halSetMetadata", HALPath, "CACTUS_CONFIG", b64encode(configFile.read()).decode()])
 
     return job.fileStore.writeGlobalFile(HALPath)
-        
+
 def main():
     parser = ArgumentParser()
     Job.Runner.addToilOptions(parser)
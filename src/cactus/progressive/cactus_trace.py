@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Lay out the jobs and tool calls of a cactus workflow on a timeline.
+
+Writes a Chrome trace (JSON) that chrome://tracing and Perfetto open. Each
+worker process gets a track, per host, with a span for each job it ran and,
+nested in it, a span for each program the job called (calls made in the
+background get a track of their own). The phases (setup, caf, bar, ...) of
+the alignment of each ancestor are laid out on tracks of their own, from
+the first of their jobs starting to the last finishing.
+
+The records are kept in the job store of a workflow run with --stats (and
+with a job store that is kept, eg with --clean never).
+"""
+
+import json
+from argparse import ArgumentParser
+
+from toil.common import Toil
+
+from cactus.shared import callMetrics
+
+def readTraceRecords(jobStore):
+    """Get the job records and the call records from a job store."""
+    jobs = []
+    calls = []
+    for stats in callMetrics.readStats(jobStore):
+        if callMetrics.JOB_KEY in stats:
+            jobs.append(stats[callMetrics.JOB_KEY])
+        calls.extend(stats.get(callMetrics.STATS_KEY, []))
+    return jobs, calls
+
+def getPhaseSpans(jobs):
+    """Get a span of each phase of each alignment, from the start of its first
+    job to the end of its last. Returns a list of (alignment, phase, start,
+    end), in order of start."""
+    spans = {}
+    for job in jobs:
+        if job.get("phase") is None:
+            continue
+        key = (job.get("alignment"), job["phase"])
+        start, end = spans.get(key, (job["start"], job["end"]))
+        spans[key] = (min(start, job["start"]), max(end, job["end"]))
+    return sorted([(alignment, phase, start, end) for (alignment, phase), (start, end) in spans.items()],
+                  key=lambda span: span[2])
+
+class TraceBuilder(object):
+    """Assigns the numeric process and thread IDs that the trace format wants,
+    naming them with metadata events."""
+    def __init__(self):
+        self.events = []
+        self.pids = {}
+        self.tids = {}
+
+    def pid(self, name):
+        if name not in self.pids:
+            self.pids[name] = len(self.pids) + 1
+            self.events.append({"ph": "M", "name": "process_name", "pid": self.pids[name], "tid": 0,
+                                "args": {"name": name}})
+        return self.pids[name]
+
+    def tid(self, pid, name):
+        if (pid, name) not in self.tids:
+            self.tids[(pid, name)] = len(self.tids) + 1
+            self.events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": self.tids[(pid, name)],
+                                "args": {"name": name}})
+        return self.tids[(pid, name)]
+
+    def span(self, name, category, start, end, pid, tid, args):
+        self.events.append({"ph": "X", "name": name, "cat": category,
+                            "ts": start * 1000000, "dur": max(0, end - start) * 1000000,
+                            "pid": pid, "tid": tid, "args": args})
+
+def makeTrace(jobs, calls):
+    """Make the Chrome trace of the given job and call records."""
+    builder = TraceBuilder()
+    # Lay out the phases first, so that they're on top
+    phasesPid = builder.pid("phases")
+    for alignment, phase, start, end in getPhaseSpans(jobs):
+        builder.span(phase, "phase", start, end, phasesPid,
+                     builder.tid(phasesPid, alignment or "alignment"), {"alignment": alignment})
+
+    jobsById = {}
+    for job in sorted(jobs, key=lambda job: job["start"]):
+        jobsById[job["job_id"]] = job
+        pid = builder.pid(job["host"])
+        builder.span(job["job"], "job", job["start"], job["end"], pid,
+                     builder.tid(pid, "worker %s" % job["pid"]),
+                     dict([(key, job.get(key)) for key in ["phase", "alignment", "job_id", "failed"]]))
+
+    for call in calls:
+        job = jobsById.get(call.get("job_id"))
+        if job is None:
+            continue
+        pid = builder.pid(job["host"])
+        track = "worker %s" % job["pid"]
+        if call.get("thread") != job.get("thread"):
+            # Made in the background, eg by cactus_call_async, so it may
+            # overlap the job's other calls
+            track += " thread %s" % call.get("thread")
+        builder.span(call["tool"], "call", call["time"] - call["wall_time"], call["time"], pid,
+                     builder.tid(pid, track),
+                     dict([(key, call.get(key)) for key in ["exit_code", "max_rss", "user_time", "sys_time",
+                                                             "read_bytes", "write_bytes"]]))
+    return {"traceEvents": builder.events, "displayTimeUnit": "ms"}
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("jobStore", help="Job store of a workflow run with --stats")
+    parser.add_argument("outputTrace", help="Chrome trace JSON file to write")
+    options = parser.parse_args()
+
+    jobs, calls = readTraceRecords(Toil.resumeJobStore(options.jobStore))
+    if len(jobs) == 0:
+        raise RuntimeError("No job records found in {}. Was the workflow run with --stats?".format(options.jobStore))
+    with open(options.outputTrace, "w") as traceFile:
+        json.dump(makeTrace(jobs, calls), traceFile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Tests laying out a workflow's jobs and calls on a timeline
+"""
+import json
+import unittest
+
+from cactus.shared import callMetrics
+from cactus.shared.test import FakeJobStore
+from cactus.progressive.cactus_trace import readTraceRecords, getPhaseSpans, makeTrace
+
+
+def makeJob(jobId, job, phase, start, end, pid=100):
+    return {"job": job, "job_id": jobId, "phase": phase, "alignment": "Anc0", "host": "node1",
+            "pid": pid, "thread": 1, "start": start, "end": end, "failed": False}
+
+
+def makeCall(jobId, tool, time, wallTime, thread=1):
+    return {"job_id": jobId, "tool": tool, "time": time, "wall_time": wallTime, "thread": thread,
+            "exit_code": 0}
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.jobs = [makeJob("a", "CactusCafPhase", "caf", 10.0, 12.0),
+                     makeJob("b", "CactusCafRecursion", "caf", 12.0, 20.0, pid=101),
+                     makeJob("c", "CactusBarPhase", "bar", 21.0, 22.0),
+                     makeJob("d", "RunBlast", None, 1.0, 5.0)]
+        self.calls = [makeCall("b", "cactus_caf", 19.0, 6.0),
+                      makeCall("b", "cactus_convertAlignmentsToInternalNames", 15.0, 2.0, thread=2)]
+
+    def testReadTraceRecords(self):
+        jobStore = FakeJobStore([{"workers": {}},
+                                 {callMetrics.STATS_KEY: [], callMetrics.JOB_KEY: self.jobs[0]},
+                                 {callMetrics.STATS_KEY: self.calls, callMetrics.JOB_KEY: self.jobs[1]}])
+        self.assertEqual(readTraceRecords(jobStore), (self.jobs[:2], self.calls))
+
+    def testPhaseSpans(self):
+        self.assertEqual(getPhaseSpans(self.jobs), [("Anc0", "caf", 10.0, 20.0), ("Anc0", "bar", 21.0, 22.0)])
+
+    def testMakeTrace(self):
+        trace = makeTrace(self.jobs, self.calls)
+        events = trace["traceEvents"]
+        names = dict([((e["pid"], e["tid"]) if e["name"] == "thread_name" else e["pid"], e["args"]["name"])
+                      for e in events if e["ph"] == "M"])
+        spans = dict([(e["name"], e) for e in events if e["ph"] == "X"])
+        self.assertEqual(spans["caf"]["cat"], "phase")
+        self.assertEqual(spans["caf"]["dur"], 10000000)
+        self.assertEqual(names[spans["caf"]["pid"]], "phases")
+        self.assertEqual(names[(spans["caf"]["pid"], spans["caf"]["tid"])], "Anc0")
+        recursion = spans["CactusCafRecursion"]
+        self.assertEqual(names[recursion["pid"]], "node1")
+        self.assertEqual(names[(recursion["pid"], recursion["tid"])], "worker 101")
+        # A call made by the job's own thread nests in the job's span, and one
+        # made in the background gets a track of its own
+        caf = spans["cactus_caf"]
+        self.assertEqual((caf["pid"], caf["tid"], caf["ts"]), (recursion["pid"], recursion["tid"], 13000000))
+        convert = spans["cactus_convertAlignmentsToInternalNames"]
+        self.assertEqual(names[(convert["pid"], convert["tid"])], "worker 101 thread 2")
+        json.dumps(trace)
+
+
+if __name__ == '__main__':
+    unittest.main()
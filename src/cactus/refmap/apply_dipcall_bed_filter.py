@@ -1,10 +1,8 @@
-#todo: consider making extract_single_mappings clever-er so that it doesn't have to scan every possible "single_mapping_region" when its determining what regions to extract.
-
 import copy
-import operator
 from toil.job import Job
 from cigar import Cigar
 import collections as col
+from cactus.shared.intervals import coverageRuns, IntervalIndex
 
 def parse_large_mappings(job, paf, min_size_mapping, min_mapq):
     mappings = dict()
@@ -27,36 +25,9 @@ def parse_large_mappings(job, paf, min_size_mapping, min_mapq):
 def get_single_mapping_regions(mappings):
     single_mapping_regions = dict()
     for chrom, mapping_list in mappings.items():
-        # get points, in format (ref_position, start_bool). 
-        # Start_bool indicates whether point is a start of mapping, or end of mapping.
-        mapping_points = list()
-        for mapping in mapping_list:
-            mapping_points.append((int(mapping[7]), True))
-            mapping_points.append((int(mapping[8]), False))
-
-        # sort the points by position on the reference.
-        mapping_points.sort(key=operator.itemgetter(0))
-        
-        # get regions without overlap:
-        single_mapping_regions[chrom] = list()
-        cur_start = 0
-        cur_depth = 0
-        debug_i = 0
-        for point in mapping_points:
-            if cur_depth == 1:
-                # then we're about to conclude a region on the reference which had exactly one mapping. Record the region!
-                if (point[0] - cur_start) != 0:
-                    single_mapping_regions[chrom].append((cur_start, point[0]))
-                cur_start = None
-
-            if point[1]:
-                cur_depth += 1
-            else:
-                cur_depth -= 1
-
-            if cur_depth == 1:
-                # then we've begun a region on the ref with exactly one mapping. Save start position.
-                cur_start = point[0]
+        # get regions on the reference which had exactly one mapping.
+        runs = coverageRuns([(int(mapping[7]), int(mapping[8])) for mapping in mapping_list])
+        single_mapping_regions[chrom] = [(start, end) for start, end, depth in runs if depth == 1]
 
     # print("single_mapping_regions", single_mapping_regions)
 
@@ -250,53 +221,18 @@ def extract_single_mappings(parsed_mappings, single_mapping_regions, min_var_len
     Raises:
         ZeroDivisionError: [description]
     """
-    print(single_mapping_regions)
+    # index the single mapping regions so we only look at the ones overlapping each mapping.
+    region_index = IntervalIndex(single_mapping_regions)
     extracted_mappings = dict()
     for chrom, mappings in parsed_mappings.items():
         extracted_mappings[chrom] = list()
         for mapping in mappings:
-            # if mapping[8] == 28596469:
-            #     print("we're at the mapping of interest.", mapping[0:11])
-                
-            # i = 0
-            # print(single_mapping_regions, mapping, single_mapping_regions)
-            # print(single_mapping_regions, mapping[8], single_mapping_regions[chrom][0][0])
-            # print(int(mapping[7]), (i < len(single_mapping_regions)), (single_mapping_regions[chrom][i][0] < int(mapping[8])))
-            # print("looking at mapping:", mapping[7], mapping[8])
-
             if mapping[10] >= min_var_len:
-                # if mapping[8] == 28596469:
-                #     print("len(single_mapping_regions[chrom])", len(single_mapping_regions[chrom]))
-                #     print("list(range(len(single_mapping_regions[chrom])))", list(range(len(single_mapping_regions[chrom]))))
-                for i in range(len(single_mapping_regions[chrom])):
-                    # if mapping[8] == 28596469:
-                    #     print("in the for loop. with mapping of interest at int i", i)
-                        # print("single_mapping_regions", single_mapping_regions)
-
-                # while (i < len(single_mapping_regions[chrom])) and (single_mapping_regions[chrom][i][0] < mapping[8]) and (mapping[10] >= min_var_len):
-                    # while there is still mapping regions to look at, and we're still in mapping regions that potentially overlap the mapping:
-
-                    # overlap_region = (max(single_mapping_regions[chrom][i][0], mapping[7]), min(single_mapping_regions[chrom][i][1], mapping[8])+1)
-                    overlap_region = (max(single_mapping_regions[chrom][i][0], mapping[7]), min(single_mapping_regions[chrom][i][1], mapping[8]))
-
-                    
-                    #debug
-                    # if mapping[8] == 28596469 and single_mapping_regions[chrom][i][1] in [28625484, 28626723]:
-                    #     print("single_mapping_region at", i, "is", single_mapping_regions[chrom][i])                
-                    #     print("overlap_region at", i, "is", overlap_region)
-
-                    # print(overlap_region)
-                    if overlap_region[1] > overlap_region[0]:
-                        #then we have found an overlap.
-                        adj_mapping = adjust_mapping(mapping, overlap_region)
-                        if adj_mapping is not None:
-                            extracted_mappings[chrom].append(adj_mapping)
-                        
-                    # if mapping[8] == 28596469:
-                    #     print("end of for loop. with mapping of interest at int i", i)
-                    #     print("len(single_mapping_regions[chrom])", len(single_mapping_regions[chrom]))
-
-                    # i += 1
+                for overlap_region in region_index.overlapping(chrom, mapping[7], mapping[8]):
+                    #then we have found an overlap.
+                    adj_mapping = adjust_mapping(mapping, overlap_region)
+                    if adj_mapping is not None:
+                        extracted_mappings[chrom].append(adj_mapping)
 
     return extracted_mappings
 
@@ -302,11 +302,14 @@ def run_cactus_align(job, configWrapper, cactusWorkflowArguments, project, doRen
                                         #todo disk=
     )
     no_ingroup_coverage = not cactusWorkflowArguments.ingroupCoverageIDs
+    exp = cactusWorkflowArguments.experimentWrapper
+    num_ingroups = len([g for g in exp.getGenomesWithSequence() if g not in exp.getOutgroupGenomes()])
     cactusWorkflowArguments = cur_job.rv()
     
     if no_ingroup_coverage:
         # if we're not taking cactus_blast input, then we need to recompute the ingroup coverage
-        cur_job = cur_job.addFollowOnJobFn(run_ingroup_coverage, cactusWorkflowArguments, project)
+        cur_job = cur_job.addFollowOnJobFn(run_ingroup_coverage, cactusWorkflowArguments, project,
+                                           cores=max(1, min(num_ingroups, cpu_count())))
         cactusWorkflowArguments = cur_job.rv()
 
     # run cactus setup all the way through cactus2hal generation
@@ -387,10 +390,16 @@ def run_ingroup_coverage(job, cactusWorkflowArguments, project):
     ingroups = map(itemgetter(0), ingroupsAndOriginalIDs)
     cigar = job.fileStore.readGlobalFile(cactusWorkflowArguments.alignmentsID)
     if len(outgroups) > 0:
-        # should we parallelize with child jobs?
+        # compute the coverages side by side, up to one per core
+        coverage_paths = []
+        coverage_futures = []
         for ingroup, sequence in zip(ingroups, sequences):
             coverage_path = os.path.join(work_dir, '{}.coverage'.format(sequence))
-            calculateCoverage(sequence, cigar, coverage_path, fromGenome=outgroups, work_dir=work_dir)
+            coverage_futures.append(calculateCoverage(sequence, cigar, coverage_path, fromGenome=outgroups,
+                                                      work_dir=work_dir, job=job))
+            coverage_paths.append(coverage_path)
+        for coverage_path, coverage_future in zip(coverage_paths, coverage_futures):
+            coverage_future.result()
             cactusWorkflowArguments.ingroupCoverageIDs.append(job.fileStore.writeGlobalFile(coverage_path))
     return cactusWorkflowArguments
 
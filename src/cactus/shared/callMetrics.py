@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Resource usage records for each program cactus_call runs.
+
+Every call adds a record of the tool, the job (and phase) it ran in, the
+input size features that the job's resources are modelled on, its wall,
+user and system time, peak RSS, bytes read and written and exit code. The
+records of a job are written into the job store with its Toil stats, along
+with a record of when and where the job itself ran, so they are only kept
+when the workflow runs with --stats. They can be summarized with
+cactus-metrics, or laid out on a timeline with cactus-trace.
+"""
+
+import json
+import math
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+import uuid
+
+# Key of the call records in the stats written to the job store
+STATS_KEY = "cactus_calls"
+# Key of the record of the job that made them
+JOB_KEY = "cactus_job"
+
+# Linux block size that rusage counts I/O in
+RUSAGE_BLOCK_SIZE = 512
+
+_records = []
+_recordsLock = threading.Lock()
+# What is known about the job that is running calls
+_currentJob = {}
+
+def startJob(job):
+    """Attribute the calls made from now on to the given job."""
+    global _currentJob
+    info = {"job": job.__class__.__name__,
+            # Tells the calls of one run of a job from another's
+            "job_id": uuid.uuid4().hex,
+            "start": time.time(),
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "thread": threading.get_ident()}
+    phaseNode = getattr(job, "phaseNode", None)
+    if phaseNode is not None:
+        info["phase"] = phaseNode.tag
+    try:
+        # The ancestor that the job is part of the alignment of
+        info["alignment"] = job.cactusWorkflowArguments.experimentWrapper.getRootGenome()
+    except Exception:
+        pass
+    try:
+        info["features"] = job.getFeatures()
+        info["feature"] = getattr(job, "feature", "totalSequenceSize")
+    except Exception:
+        # Not a job with resource features, or they need promises
+        # that aren't resolved yet
+        pass
+    _currentJob = info
+
+def finishJob(jobStore=None, failed=False):
+    """Write out the records of the calls made since startJob, and of the job,
+    to the job store, if one is given, and forget them."""
+    global _currentJob
+    with _recordsLock:
+        records = list(_records)
+        del _records[:]
+    jobRecord = dict([(key, _currentJob.get(key)) for key in
+                      ["job", "job_id", "phase", "alignment", "host", "pid", "thread", "start"]])
+    jobRecord.update({"end": time.time(), "failed": failed})
+    _currentJob = {}
+    if jobStore is not None:
+        jobStore.writeStatsAndLogging(json.dumps({STATS_KEY: records, JOB_KEY: jobRecord}))
+    return records
+
+def readStats(jobStore):
+    """Get the stats documents written to a job store by all the jobs (and
+    Toil's own), parsed."""
+    stats = []
+    def callback(fileHandle):
+        stats.append(json.loads(fileHandle.read()))
+    jobStore.readStatsAndLogging(callback, readAll=True)
+    return stats
+
+def getToolName(parameters):
+    """Get the name of the program run by a cactus_call, or the names of the
+    programs joined with | for a pipeline."""
+    if len(parameters) > 0 and not isinstance(parameters[0], str):
+        return "|".join([command.toolName() if hasattr(command, "toolName") else getToolName(command)
+                         for command in parameters])
+    if len(parameters) == 0:
+        return None
+    return os.path.basename(parameters[0])
+
+def recordCall(tool, exitCode, wallTime, mode=None, features=None, userTime=None, sysTime=None,
+               maxRss=None, readBytes=None, writeBytes=None):
+    """Add the record of a finished call."""
+    record = {"time": time.time(),
+              "tool": tool,
+              "mode": mode,
+              "job": _currentJob.get("job"),
+              "job_id": _currentJob.get("job_id"),
+              "phase": _currentJob.get("phase"),
+              "thread": threading.get_ident(),
+              "feature": _currentJob.get("feature"),
+              "features": features if features is not None else _currentJob.get("features"),
+              "exit_code": exitCode,
+              "wall_time": wallTime,
+              "user_time": userTime,
+              "sys_time": sysTime,
+              "max_rss": maxRss,
+              "read_bytes": readBytes,
+              "write_bytes": writeBytes}
+    with _recordsLock:
+        _records.append(record)
+    return record
+
+# Exit codes of a call that was killed with SIGKILL, which is how the
+# kernel ends a process that runs out of memory: -9 from Popen, or 128 + 9
+# through docker or a shell
+OOM_EXIT_CODES = (-signal.SIGKILL, 128 + signal.SIGKILL)
+
+def isOutOfMemory(record):
+    """Was the call of the record killed, presumably for running out of
+    memory?"""
+    return record.get("exit_code") in OOM_EXIT_CODES
+
+def getRetryMemory(records, memory, margin, selfPeak=None):
+    """Get the memory to retry a failed job with, from the records of the calls
+    of the attempt that failed and the memory it had, or None if it didn't
+    run out of memory. selfPeak is the peak RSS of the job's own process if
+    it failed with a MemoryError.
+
+    The retry gets the largest peak seen in the attempt, plus the margin (a
+    fraction of it). A call killed at the job's limit only shows a peak up to
+    the limit, so the attempt's memory counts as a peak too.
+    """
+    if selfPeak is None and not any([isOutOfMemory(r) for r in records]):
+        return None
+    peaks = [r["max_rss"] for r in records if r.get("max_rss") is not None]
+    if selfPeak is not None:
+        peaks.append(selfPeak)
+    return int(max(peaks + [memory]) * (1 + margin))
+
+def rusageStats(rusage):
+    """Get the record fields from the rusage of a waited-for process (which
+    includes the children it waited for)."""
+    if rusage is None:
+        return {}
+    return {"userTime": rusage.ru_utime,
+            "sysTime": rusage.ru_stime,
+            # Linux reports ru_maxrss in kilobytes
+            "maxRss": rusage.ru_maxrss * 1024,
+            "readBytes": rusage.ru_inblock * RUSAGE_BLOCK_SIZE,
+            "writeBytes": rusage.ru_oublock * RUSAGE_BLOCK_SIZE}
+
+class RusagePopen(subprocess.Popen):
+    """Popen that keeps the rusage of the process when it is reaped, in
+    self.rusage."""
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # Same as Popen: someone else reaped it, so we can't know
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+# Format for /usr/bin/time -f, read back by parseTimeOutput
+TIME_FORMAT = "%e %U %S %M %I %O"
+
+def parseTimeOutput(text):
+    """Get the record fields from what /usr/bin/time -f TIME_FORMAT wrote,
+    or None if it can't be read."""
+    try:
+        # A failed command has a "Command exited with non-zero
+        # status" line first
+        fields = text.strip().split('\n')[-1].split()
+        wallTime, userTime, sysTime = [float(f) for f in fields[:3]]
+        maxRss, inputs, outputs = [int(f) for f in fields[3:6]]
+    except ValueError:
+        return None
+    return {"wallTime": wallTime,
+            "userTime": userTime,
+            "sysTime": sysTime,
+            "maxRss": maxRss * 1024,
+            "readBytes": inputs * RUSAGE_BLOCK_SIZE,
+            "writeBytes": outputs * RUSAGE_BLOCK_SIZE}
+
+def getContainerCgroupDirs(containerId):
+    """Get the directories that may hold the cgroup of a docker container,
+    for the cgroup v1 controllers and for cgroup v2, depending on the
+    distribution and the cgroup driver."""
+    scopes = ["docker/%s" % containerId, "system.slice/docker-%s.scope" % containerId]
+    return {"cpuacct": ["/sys/fs/cgroup/cpuacct/%s" % s for s in scopes] +
+                       ["/sys/fs/cgroup/cpu,cpuacct/%s" % s for s in scopes],
+            "blkio": ["/sys/fs/cgroup/blkio/%s" % s for s in scopes],
+            "v2": ["/sys/fs/cgroup/%s" % s for s in scopes]}
+
+def parseCgroupStats(cpuacctStat=None, blkioServiceBytes=None, cpuStat=None, ioStat=None):
+    """Get the record fields from the contents of cgroup v1 cpuacct.stat and
+    blkio.throttle.io_service_bytes, or cgroup v2 cpu.stat and io.stat."""
+    stats = {}
+    if cpuacctStat is not None:
+        ticks = dict([line.split() for line in cpuacctStat.strip().split('\n') if line])
+        ticksPerSecond = os.sysconf('SC_CLK_TCK')
+        stats["userTime"] = int(ticks["user"]) / ticksPerSecond
+        stats["sysTime"] = int(ticks["system"]) / ticksPerSecond
+    if cpuStat is not None:
+        usecs = dict([line.split() for line in cpuStat.strip().split('\n') if line])
+        stats["userTime"] = int(usecs["user_usec"]) / 1000000.0
+        stats["sysTime"] = int(usecs["system_usec"]) / 1000000.0
+    if blkioServiceBytes is not None:
+        stats["readBytes"] = stats["writeBytes"] = 0
+        for line in blkioServiceBytes.strip().split('\n'):
+            fields = line.split()
+            if len(fields) == 3 and fields[1] == "Read":
+                stats["readBytes"] += int(fields[2])
+            elif len(fields) == 3 and fields[1] == "Write":
+                stats["writeBytes"] += int(fields[2])
+    if ioStat is not None:
+        stats["readBytes"] = stats["writeBytes"] = 0
+        for line in ioStat.strip().split('\n'):
+            counters = dict([field.split('=') for field in line.split()[1:]])
+            stats["readBytes"] += int(counters.get("rbytes", 0))
+            stats["writeBytes"] += int(counters.get("wbytes", 0))
+    return stats
+
+def _readFirst(paths):
+    for path in paths:
+        try:
+            with open(path) as f:
+                return f.read()
+        except IOError:
+            continue
+    return None
+
+def containerCgroupStats(containerId):
+    """Get the CPU time and I/O of a running docker container from its
+    cgroup, as record fields. Empty if the cgroup can't be found."""
+    dirs = getContainerCgroupDirs(containerId)
+    cpuStat = _readFirst([os.path.join(d, "cpu.stat") for d in dirs["v2"]])
+    if cpuStat is not None:
+        return parseCgroupStats(cpuStat=cpuStat,
+                                ioStat=_readFirst([os.path.join(d, "io.stat") for d in dirs["v2"]]))
+    cpuacctStat = _readFirst([os.path.join(d, "cpuacct.stat") for d in dirs["cpuacct"]])
+    if cpuacctStat is None:
+        return {}
+    return parseCgroupStats(cpuacctStat=cpuacctStat,
+                            blkioServiceBytes=_readFirst([os.path.join(d, "blkio.throttle.io_service_bytes")
+                                                          for d in dirs["blkio"]]))
+
+def featureBucket(value):
+    """Bucket a feature value by its order of magnitude, as a label like
+    "1e6-1e7"."""
+    if value is None:
+        return None
+    if value < 1:
+        return "0-1e0"
+    exponent = int(math.floor(math.log10(value)))
+    return "1e%d-1e%d" % (exponent, exponent + 1)
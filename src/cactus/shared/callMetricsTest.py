@@ -0,0 +1,107 @@
+"""Tests the records of the resources used by each call
+"""
+import sys
+import unittest
+import xml.etree.ElementTree as ET
+
+from cactus.shared import callMetrics
+from cactus.shared.callMetrics import RusagePopen, getToolName, parseTimeOutput, \
+    parseCgroupStats, featureBucket, getRetryMemory
+from cactus.shared.test import FakeJobStore
+
+
+class FakePhaseJob:
+    phaseNode = ET.Element("caf")
+    feature = "alignmentsSize"
+
+    def getFeatures(self):
+        return {"totalSequenceSize": 100, "alignmentsSize": 2000}
+
+
+class TestCase(unittest.TestCase):
+    def testToolName(self):
+        self.assertEqual(getToolName(["/usr/local/bin/cactus_caf", "--help"]), "cactus_caf")
+        self.assertEqual(getToolName([["cat", "a"], ["sort"], ["uniq"]]), "cat|sort|uniq")
+        self.assertEqual(getToolName([]), None)
+
+    def testRusagePopen(self):
+        """The rusage of a call is that of the process it ran, not the
+        other calls in this process."""
+        process = RusagePopen([sys.executable, "-c", "x = bytearray(200 * 1024 * 1024)"])
+        process.communicate()
+        self.assertEqual(process.returncode, 0)
+        stats = callMetrics.rusageStats(process.rusage)
+        self.assertGreater(stats["maxRss"], 200 * 1024 * 1024)
+        self.assertGreaterEqual(stats["userTime"] + stats["sysTime"], 0)
+
+        process = RusagePopen([sys.executable, "-c", "import sys; sys.exit(3)"])
+        process.communicate()
+        self.assertEqual(process.returncode, 3)
+        self.assertLess(callMetrics.rusageStats(process.rusage)["maxRss"], 200 * 1024 * 1024)
+
+    def testParseTimeOutput(self):
+        stats = parseTimeOutput("Command exited with non-zero status 2\n3.00 2.50 0.50 1024 10 20\n")
+        self.assertEqual(stats, {"wallTime": 3.0, "userTime": 2.5, "sysTime": 0.5,
+                                 "maxRss": 1024 * 1024, "readBytes": 5120, "writeBytes": 10240})
+        self.assertEqual(parseTimeOutput(""), None)
+
+    def testParseCgroupStats(self):
+        stats = parseCgroupStats(cpuStat="usage_usec 3500000\nuser_usec 3000000\nsystem_usec 500000\n",
+                                 ioStat="8:0 rbytes=100 wbytes=200 rios=1 wios=2\n8:16 rbytes=1 wbytes=2\n")
+        self.assertEqual(stats, {"userTime": 3.0, "sysTime": 0.5, "readBytes": 101, "writeBytes": 202})
+        stats = parseCgroupStats(blkioServiceBytes="8:0 Read 100\n8:0 Write 200\n8:0 Total 300\nTotal 300\n")
+        self.assertEqual(stats, {"readBytes": 100, "writeBytes": 200})
+
+    def testFeatureBucket(self):
+        self.assertEqual(featureBucket(5), "1e0-1e1")
+        self.assertEqual(featureBucket(2500000), "1e6-1e7")
+        self.assertEqual(featureBucket(0), "0-1e0")
+        self.assertEqual(featureBucket(None), None)
+
+    def testRetryMemory(self):
+        records = [{"exit_code": 0, "max_rss": 300}, {"exit_code": 1, "max_rss": 100}]
+        # A failure that isn't for lack of memory doesn't change the retry
+        self.assertEqual(getRetryMemory(records, 200, 0.5), None)
+        # A call killed beyond the job's memory gets its peak plus the margin
+        records.append({"exit_code": 137, "max_rss": None})
+        self.assertEqual(getRetryMemory(records, 200, 0.5), 450)
+        # And one killed at its limit gets the job's memory plus the margin
+        records = [{"exit_code": -9, "max_rss": 190}]
+        self.assertEqual(getRetryMemory(records, 200, 0.5), 300)
+        self.assertEqual(getRetryMemory([], 200, 0.5, selfPeak=1000), 1500)
+
+    def testJobRecords(self):
+        """A job's calls are written to the job store with its phase and
+        features when it finishes."""
+        callMetrics.startJob(FakePhaseJob())
+        callMetrics.recordCall("cactus_caf", 0, 1.5, mode="local", maxRss=100)
+        callMetrics.recordCall("cactus_caf", 1, 0.5, mode="local", features={"alignmentsSize": 1})
+        jobStore = FakeJobStore()
+        records = callMetrics.finishJob(jobStore)
+        self.assertEqual(jobStore.stats[0][callMetrics.STATS_KEY], records)
+        self.assertEqual([r["phase"] for r in records], ["caf", "caf"])
+        self.assertEqual(records[0]["job"], "FakePhaseJob")
+        self.assertEqual(records[0]["features"]["alignmentsSize"], 2000)
+        self.assertEqual(records[1]["features"], {"alignmentsSize": 1})
+        self.assertEqual(records[1]["exit_code"], 1)
+        jobRecord = jobStore.stats[0][callMetrics.JOB_KEY]
+        self.assertEqual(jobRecord["job_id"], records[0]["job_id"])
+        self.assertEqual(jobRecord["phase"], "caf")
+        self.assertLessEqual(jobRecord["start"], records[0]["time"])
+        self.assertLessEqual(records[1]["time"], jobRecord["end"])
+        self.assertFalse(jobRecord["failed"])
+
+        # A job without calls still has its own record, and nothing is
+        # carried over to the next job
+        callMetrics.startJob(object())
+        self.assertEqual(callMetrics.finishJob(jobStore, failed=True), [])
+        self.assertEqual(jobStore.stats[1][callMetrics.STATS_KEY], [])
+        self.assertEqual(jobStore.stats[1][callMetrics.JOB_KEY]["job"], "object")
+        self.assertTrue(jobStore.stats[1][callMetrics.JOB_KEY]["failed"])
+        record = callMetrics.recordCall("ls", 0, 0.1)
+        self.assertEqual(record["phase"], None)
+        self.assertEqual(callMetrics.finishJob(), [record])
+
+
+if __name__ == '__main__':
+    unittest.main()
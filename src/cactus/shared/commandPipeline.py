@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Runs the pipelines of commands that cactus_call is given as a list of
+lists, without a shell.
+
+Each stage is its own process, connected to the next by an OS pipe, with its
+own stderr, timing and resource usage. A Tee stage copies its input into
+several pipelines. As soon as any stage fails, the others are killed, and
+the first stage to fail is reported.
+"""
+
+import os
+import queue
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from cactus.shared import callMetrics
+
+class Tee(object):
+    """The last stage of a pipeline, which copies its input into each of the
+    given pipelines (lists of commands). The output of each pipeline is
+    written to the matching path in outfiles, or discarded if it is None.
+    """
+    def __init__(self, pipelines, outfiles=None):
+        self.pipelines = pipelines
+        self.outfiles = outfiles if outfiles is not None else [None] * len(pipelines)
+        assert len(self.outfiles) == len(self.pipelines)
+
+    def toolName(self):
+        return "tee(%s)" % ",".join([callMetrics.getToolName(pipeline) for pipeline in self.pipelines])
+
+def isPipeline(parameters):
+    """Are the parameters of a cactus_call a pipeline of commands?"""
+    return len(parameters) > 0 and isinstance(parameters[0], (list, Tee))
+
+def getPipelineCommands(stages):
+    """Get all the commands in a pipeline, including those in tees."""
+    commands = []
+    for stage in stages:
+        if isinstance(stage, Tee):
+            for pipeline in stage.pipelines:
+                commands += getPipelineCommands(pipeline)
+        else:
+            commands.append(stage)
+    return commands
+
+def mapPipeline(stages, fn):
+    """Get the pipeline with fn(command) in place of each command."""
+    mapped = []
+    for stage in stages:
+        if isinstance(stage, Tee):
+            mapped.append(Tee([mapPipeline(pipeline, fn) for pipeline in stage.pipelines], stage.outfiles))
+        else:
+            mapped.append(fn(stage))
+    return mapped
+
+class Stage(object):
+    """A command of a pipeline, and the call that runs it (eg in a container).
+    Once it has run, process, wallTime and stderr are set."""
+    def __init__(self, parameters, call, timeFile=None, containerInfo=None):
+        self.parameters = parameters
+        self.call = call
+        self.timeFile = timeFile
+        self.containerInfo = containerInfo
+        self.process = None
+        self.startTime = None
+        self.wallTime = None
+        self.stderr = None
+        self.stderrFile = None
+
+def _copyToAll(inFile, outFiles):
+    """Copy inFile to each of outFiles until the end of it, dropping any that
+    stop reading (their stage's exit code tells why), then close them all."""
+    try:
+        while True:
+            data = inFile.read1(1 << 20)
+            if not data:
+                break
+            for outFile in list(outFiles):
+                try:
+                    outFile.write(data)
+                except (BrokenPipeError, ValueError):
+                    outFiles.remove(outFile)
+                    _close(outFile)
+    finally:
+        inFile.close()
+        for outFile in outFiles:
+            _close(outFile)
+
+def _close(fileHandle):
+    try:
+        fileHandle.close()
+    except BrokenPipeError:
+        pass
+
+class CommandPipeline(object):
+    """Runs a pipeline of Stages (and a Tee of pipelines of Stages last)."""
+    def __init__(self, stages, cwd=None):
+        self.stages = stages
+        self.cwd = cwd
+        self.running = []
+        self.threads = []
+        self.output = None
+        self.outputFile = None
+        self.failedStage = None
+
+    def allStages(self):
+        return getPipelineCommands(self.stages)
+
+    def start(self, stdin=subprocess.DEVNULL, stdout=None, stdinString=None):
+        """Start every stage. stdin and stdout are those of the whole pipeline;
+        if stdout is subprocess.PIPE, the output is kept in self.output."""
+        if stdinString is not None:
+            readEnd, writeEnd = os.pipe()
+            stdin = os.fdopen(readEnd, 'rb')
+            self._startThread(self._writeString, os.fdopen(writeEnd, 'wb'), stdinString.encode())
+        if stdout == subprocess.PIPE:
+            self.outputFile = tempfile.TemporaryFile()
+            stdout = self.outputFile
+        try:
+            self._startPipeline(self.stages, stdin, stdout)
+        except:
+            self.kill()
+            raise
+        finally:
+            if stdinString is not None and not isinstance(self.stages[0], Tee):
+                # The first stage has its own copy
+                stdin.close()
+
+    def _startThread(self, fn, *args):
+        thread = threading.Thread(target=fn, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _writeString(self, fileHandle, data):
+        try:
+            fileHandle.write(data)
+        except BrokenPipeError:
+            pass
+        finally:
+            _close(fileHandle)
+
+    def _startPipeline(self, stages, stdin, stdout):
+        previous = stdin
+        for i, stage in enumerate(stages):
+            last = i == len(stages) - 1
+            if isinstance(stage, Tee):
+                if not last:
+                    raise RuntimeError("A Tee must be the last stage of a pipeline")
+                if previous is subprocess.DEVNULL:
+                    previous = open(os.devnull, 'rb')
+                branchInputs = []
+                for pipeline, outfile in zip(stage.pipelines, stage.outfiles):
+                    readEnd, writeEnd = os.pipe()
+                    branchInput = os.fdopen(readEnd, 'rb')
+                    branchInputs.append(os.fdopen(writeEnd, 'wb'))
+                    branchOutput = open(outfile, 'wb') if outfile is not None else subprocess.DEVNULL
+                    try:
+                        self._startPipeline(pipeline, branchInput, branchOutput)
+                    finally:
+                        branchInput.close()
+                        if outfile is not None:
+                            branchOutput.close()
+                self._startThread(_copyToAll, previous, branchInputs)
+                return
+            stage.stderrFile = tempfile.TemporaryFile()
+            stage.startTime = time.time()
+            stage.process = callMetrics.RusagePopen(stage.call, stdin=previous,
+                                                    stdout=stdout if last else subprocess.PIPE,
+                                                    stderr=stage.stderrFile, cwd=self.cwd)
+            self.running.append(stage)
+            if i > 0:
+                # Only the stage reading it should have it open, so that the
+                # stage writing it gets SIGPIPE if the reader dies
+                previous.close()
+            previous = stage.process.stdout
+
+    def kill(self):
+        for stage in self.running:
+            # Not Popen.kill(), which polls and so could reap the process
+            # before its rusage is read
+            if stage.process.returncode is None:
+                try:
+                    os.kill(stage.process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def wait(self, tick=None, tickInterval=10):
+        """Wait for every stage to finish, killing the rest when one fails.
+        tick() is called every tickInterval seconds while they run. Returns
+        the exit code of the first stage to fail, or 0."""
+        finished = queue.Queue()
+        for stage in self.running:
+            self._startThread(lambda stage: (stage.process.wait(), finished.put(stage)), stage)
+        remaining = len(self.running)
+        while remaining > 0:
+            try:
+                stage = finished.get(timeout=tickInterval)
+            except queue.Empty:
+                if tick is not None:
+                    tick()
+                continue
+            remaining -= 1
+            stage.wallTime = time.time() - stage.startTime
+            if stage.process.returncode != 0 and self.failedStage is None:
+                self.failedStage = stage
+                self.kill()
+        for thread in self.threads:
+            thread.join()
+        for stage in self.running:
+            stage.stderrFile.seek(0)
+            stage.stderr = stage.stderrFile.read().decode("utf-8", "replace")
+            stage.stderrFile.close()
+        if self.outputFile is not None:
+            self.outputFile.seek(0)
+            self.output = self.outputFile.read().decode("ascii")
+            self.outputFile.close()
+        return self.failedStage.process.returncode if self.failedStage is not None else 0
+
+    def writeStderr(self, outFile=None):
+        """Pass on the stderr of each stage."""
+        outFile = outFile if outFile is not None else sys.stderr
+        for stage in self.running:
+            outFile.write(stage.stderr)
+        outFile.flush()
@@ -0,0 +1,69 @@
+"""Tests running pipelines of commands without a shell
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from cactus.shared.commandPipeline import CommandPipeline, Stage, Tee, isPipeline, \
+    getPipelineCommands, mapPipeline
+
+
+def localPipeline(commands):
+    return CommandPipeline(mapPipeline(commands, lambda command: Stage(command, command)))
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def testStructure(self):
+        commands = [["cat", "a"], Tee([[["sort"], ["uniq"]], [["wc"]]])]
+        self.assertTrue(isPipeline(commands))
+        self.assertFalse(isPipeline(["cat", "a"]))
+        self.assertEqual(getPipelineCommands(commands), [["cat", "a"], ["sort"], ["uniq"], ["wc"]])
+        self.assertEqual(commands[1].toolName(), "tee(sort|uniq,wc)")
+
+    def testPipeline(self):
+        pipeline = localPipeline([["sort"], ["uniq", "-c"]])
+        pipeline.start(stdout=subprocess.PIPE, stdinString="b\na\nb\n")
+        self.assertEqual(pipeline.wait(), 0)
+        self.assertEqual(pipeline.output.split(), ["1", "a", "2", "b"])
+        for stage in pipeline.allStages():
+            self.assertEqual(stage.process.returncode, 0)
+            self.assertGreaterEqual(stage.wallTime, 0)
+            self.assertIsNotNone(stage.process.rusage)
+
+    def testTee(self):
+        """Each branch of a tee gets all of the input, even if another stops
+        reading early."""
+        outfiles = [os.path.join(self.tempDir, name) for name in ["head", "count"]]
+        pipeline = localPipeline([["seq", "1", "1000000"],
+                                  Tee([[["head", "-n", "2"]], [["wc", "-l"]]], outfiles=outfiles)])
+        pipeline.start()
+        self.assertEqual(pipeline.wait(), 0)
+        with open(outfiles[0]) as f:
+            self.assertEqual(f.read(), "1\n2\n")
+        with open(outfiles[1]) as f:
+            self.assertEqual(f.read().strip(), "1000000")
+
+    def testFailFast(self):
+        """The first stage to fail is reported, with its stderr, and the rest
+        are killed rather than waited for."""
+        pipeline = localPipeline([["sleep", "60"], ["sh", "-c", "echo broken >&2; exit 3"]])
+        startTime = time.time()
+        pipeline.start()
+        self.assertEqual(pipeline.wait(), 3)
+        self.assertLess(time.time() - startTime, 30)
+        self.assertEqual(pipeline.failedStage.parameters[0], "sh")
+        self.assertEqual(pipeline.failedStage.stderr, "broken\n")
+        self.assertEqual(pipeline.allStages()[0].process.returncode, -9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,9 +22,13 @@ import math
 import threading
 import traceback
 import errno
+import gzip
+import io
+import resource
 import shlex
 
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from toil.lib.bioio import logger
@@ -32,12 +36,17 @@ from toil.lib.bioio import system
 from toil.lib.bioio import getLogLevelString
 from toil.common import Toil
 from toil.job import Job
+from toil.fileStores import FileID
 from toil.realtimeLogger import RealtimeLogger
 from toil.lib.humanize import bytes2human
 
 from sonLib.bioio import popenCatch
 
 from cactus.shared.version import cactus_commit
+from cactus.shared import callMetrics
+from cactus.shared import jobProfiler
+from cactus.shared.commandPipeline import CommandPipeline, Stage, Tee, isPipeline, \
+    getPipelineCommands, mapPipeline
 
 _log = logging.getLogger(__name__)
 
@@ -69,19 +78,107 @@ def makeURL(path_or_url):
     else:
         return path_or_url
 
+def copyFileObj(inFile, outFile, length=1 << 24):
+    """Like shutil.copyfileobj, but returns the number of bytes copied."""
+    copied = 0
+    while True:
+        data = inFile.read(length)
+        if not data:
+            return copied
+        outFile.write(data)
+        copied += len(data)
+
+def copyFileData(inFile, outFile):
+    """Append the rest of the open file inFile to the open file outFile,
+    copying in the kernel (with copy_file_range, or sendfile) where the
+    files allow it rather than through a buffer. Returns the number of
+    bytes copied.
+    """
+    outFile.flush()
+    try:
+        inFd = inFile.fileno()
+        outFd = outFile.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return copyFileObj(inFile, outFile)
+    copyFns = []
+    if hasattr(os, "copy_file_range"):
+        copyFns.append(lambda: os.copy_file_range(inFd, outFd, 1 << 30))
+    if hasattr(os, "sendfile"):
+        copyFns.append(lambda: os.sendfile(outFd, inFd, None, 1 << 30))
+    for copyFn in copyFns:
+        copied = 0
+        try:
+            while True:
+                count = copyFn()
+                if count == 0:
+                    return copied
+                copied += count
+        except OSError as e:
+            # Not supported between these files (eg across file systems on
+            # older kernels), so try the next way
+            if copied > 0 or e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                             errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    return copyFileObj(inFile, outFile)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+def isGzipped(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+# Size of the blocks that compressStream compresses independently.
+COMPRESSION_BLOCK_SIZE = 16 * 1024 * 1024
+
+# zlib level 1 is several times faster than the default, and what's
+# compressed (DB snapshots, blast chunks and results) compresses well enough
+# at it.
+COMPRESSION_LEVEL = 1
+
+def compressStream(inFile, outFile, threads=None):
+    """Gzip inFile to outFile, compressing blocks in parallel. The result is a
+    multi-member gzip file that any gzip reader can decompress."""
+    if threads is None:
+        threads = min(os.cpu_count() or 1, 8)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = []
+        while True:
+            block = inFile.read(COMPRESSION_BLOCK_SIZE)
+            if block:
+                pending.append(pool.submit(gzip.compress, block, COMPRESSION_LEVEL))
+            # Write out in order, keeping at most a couple of blocks per
+            # thread in memory.
+            while pending and (not block or len(pending) >= 2 * threads):
+                outFile.write(pending.pop(0).result())
+            if not block:
+                break
+
+def decompressStream(inFile, outFile):
+    with gzip.GzipFile(fileobj=inFile, mode='rb') as f:
+        shutil.copyfileobj(f, outFile, COMPRESSION_BLOCK_SIZE)
+
+def copyFileDataDecompressed(inFile, outFile):
+    """Like copyFileData, but gunzips the rest of inFile if it is gzipped.
+    Returns the number of bytes written."""
+    try:
+        # Peek without moving the file's position, which copyFileData
+        # copies from
+        magic = os.pread(inFile.fileno(), len(GZIP_MAGIC), inFile.tell())
+    except (AttributeError, io.UnsupportedOperation):
+        magic = inFile.read(len(GZIP_MAGIC))
+        inFile.seek(-len(magic), io.SEEK_CUR)
+    if magic == GZIP_MAGIC:
+        with gzip.GzipFile(fileobj=inFile, mode='rb') as f:
+            return copyFileObj(f, outFile)
+    return copyFileData(inFile, outFile)
+
 def catFiles(filesToCat, catFile):
-    """Cats a bunch of files into one file. Ensures a no more than maxCat files
-    are concatenated at each step.
+    """Cats a bunch of files into one file.
     """
-    if len(filesToCat) == 0: #We must handle this case or the cat call will hang waiting for input
-        open(catFile, 'w').close()
-        return
-    maxCat = 25
-    system("cat %s > %s" % (" ".join(filesToCat[:maxCat]), catFile))
-    filesToCat = filesToCat[maxCat:]
-    while len(filesToCat) > 0:
-        system("cat %s >> %s" % (" ".join(filesToCat[:maxCat]), catFile))
-        filesToCat = filesToCat[maxCat:]
+    with open(catFile, 'wb') as outFile:
+        for fileToCat in filesToCat:
+            with open(fileToCat, 'rb') as inFile:
+                copyFileData(inFile, outFile)
 
 def cactusRootPath():
     """
@@ -262,13 +359,18 @@ def runCactusSetup(cactusDiskDatabaseString, seqMap,
     logger.info("Ran cactus setup okay")
     return [ i for i in masterMessages.split("\n") if i != '' ]
 
-def runConvertAlignmentsToInternalNames(cactusDiskString, alignmentsFile, outputFile, flowerName, isBedFile=False):
+def runConvertAlignmentsToInternalNames(cactusDiskString, alignmentsFile, outputFile, flowerName, isBedFile=False, job=None):
+    """If job is given, the conversion is started with cactus_call_async
+    and a Future for it is returned."""
     args = [alignmentsFile, outputFile,
             "--cactusDisk", cactusDiskString]
     if isBedFile:
         args += ["--bed"]
-    cactus_call(stdin_string=encodeFlowerNames((flowerName,)),
-                parameters=["cactus_convertAlignmentsToInternalNames"] + args)
+    callArgs = dict(stdin_string=encodeFlowerNames((flowerName,)),
+                    parameters=["cactus_convertAlignmentsToInternalNames"] + args)
+    if job is not None:
+        return cactus_call_async(job=job, **callArgs)
+    cactus_call(**callArgs)
 
 def runStripUniqueIDs(cactusDiskString):
     cactus_call(parameters=["cactus_stripUniqueIDs", "--cactusDisk", cactusDiskString])
@@ -844,6 +946,23 @@ def runGetChunks(sequenceFiles, chunksDir, chunkSize, overlapSize, work_dir=None
                                      chunksDir] + sequenceFiles)
     return [chunk for chunk in chunks.split("\n") if chunk != ""]
 
+# Name of the manifest that cactus_blast_chunkSequences writes in the chunks dir
+CHUNK_MANIFEST = "manifest.tsv"
+
+def readChunkManifest(chunksDir):
+    """Get the stats of the chunks made by runGetChunks in chunksDir, as a
+    dict from chunk file name to a dict of its length, unmasked bases (upper
+    case other than N), Ns and Gs or Cs. Empty if there is no manifest."""
+    manifestPath = os.path.join(chunksDir, CHUNK_MANIFEST)
+    if not os.path.isfile(manifestPath):
+        return {}
+    stats = {}
+    with open(manifestPath) as manifestFile:
+        for line in manifestFile:
+            name, length, unmasked, ns, gcs = line.split()
+            stats[name] = {"length": int(length), "unmasked": int(unmasked), "n": int(ns), "gc": int(gcs)}
+    return stats
+
 def pullCactusImage():
     """Ensure that the cactus Docker image is pulled."""
     if os.environ.get('CACTUS_DOCKER_MODE') == "0":
@@ -898,7 +1017,10 @@ def maxMemUsageOfContainer(containerInfo):
     # container, in a few different possible locations depending on
     # the distribution
     possibleLocations = ["/sys/fs/cgroup/memory/docker/%s/memory.max_usage_in_bytes",
-                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.max_usage_in_bytes"]
+                         "/sys/fs/cgroup/memory/system.slice.docker-%s.scope/memory.max_usage_in_bytes",
+                         # cgroup v2
+                         "/sys/fs/cgroup/docker/%s/memory.peak",
+                         "/sys/fs/cgroup/system.slice/docker-%s.scope/memory.peak"]
     possibleLocations = [s % containerInfo['id'] for s in possibleLocations]
     for location in possibleLocations:
         try:
@@ -1018,6 +1140,78 @@ def importSingularityImage(options):
         else:
             logger.info("Using pre-built singularity image: '{}'".format(imgPath))
 
+def getSingularitySandbox(tool, work_dir, file_store=None):
+    """Get the path of a sandbox directory of the given image, building it in
+    our cache if it isn't there yet."""
+    # Problem: Multiple Singularity downloads sharing the same cache directory will
+    # not work correctly. See https://github.com/sylabs/singularity/issues/3634
+    # and https://github.com/sylabs/singularity/issues/4555.
+
+    # As a workaround, we have out own cache which we manage ourselves.
+    home_dir = str(pathlib.Path.home())
+    default_singularity_dir = os.path.join(home_dir, '.singularity')
+    cache_dir = os.path.join(os.environ.get('SINGULARITY_CACHEDIR',  default_singularity_dir), 'toil')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # hack to transform back to docker image
+    if tool == 'cactus':
+        tool = getDockerImage()
+    # not a url or local file? try it as a Docker specifier
+    if not tool.startswith('/') and '://' not in tool:
+        tool = 'docker://' + tool
+
+    # What name in the cache dir do we want?
+    # We cache everything as sandbox directories and not .sif files because, as
+    # laid out in https://github.com/sylabs/singularity/issues/4617, there
+    # isn't a way to run from a .sif file and have write permissions on system
+    # directories in the container, because the .sif build process makes
+    # everything owned by root inside the image. Since some toil-vg containers
+    # (like the R one) want to touch system files (to install R packages at
+    # runtime), we do it this way to act more like Docker.
+    #
+    # Also, only sandbox directories work with user namespaces, and only user
+    # namespaces work inside unprivileged Docker containers like the Toil
+    # appliance.
+    sandbox_dirname = os.path.join(cache_dir, '{}.sandbox'.format(hashlib.sha256(tool.encode('utf-8')).hexdigest()))
+
+    if not os.path.exists(sandbox_dirname):
+        # We atomically drop the sandbox at that name when we get it
+
+        # Make a temp directory to be the sandbox
+        temp_sandbox_dirname = tempfile.mkdtemp(dir=cache_dir)
+
+        # Download with a fresh cache to a sandbox
+        download_env = os.environ.copy()
+        download_env['SINGULARITY_CACHEDIR'] = file_store.getLocalTempDir() if file_store else tempfile.mkdtemp(dir=work_dir)
+        build_cmd = ['singularity', 'build', '-s', '-F', temp_sandbox_dirname, tool]
+
+        cactus_realtime_log("Running the command: \"{}\"".format(' '.join(build_cmd)))
+        start_time = time.time()
+        subprocess.check_call(build_cmd, env=download_env)
+        run_time = time.time() - start_time
+        cactus_realtime_log("Successfully ran the command: \"{}\" in {} seconds".format(' '.join(build_cmd), run_time))
+
+        # Clean up the Singularity cache since it is single use
+        shutil.rmtree(download_env['SINGULARITY_CACHEDIR'])
+
+        try:
+            # This may happen repeatedly but it is atomic
+            os.rename(temp_sandbox_dirname, sandbox_dirname)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                # Can't rename a directory over another
+                # Make sure someone else has made the directory
+                assert os.path.exists(sandbox_dirname)
+                # Remove our redundant copy
+                shutil.rmtree(temp_sandbox_dirname)
+            else:
+                raise
+
+        # TODO: we could save some downloading by having one process download
+        # and the others wait, but then we would need a real fnctl locking
+        # system here.
+    return sandbox_dirname
+
 def singularityCommand(tool=None,
                        work_dir=None,
                        parameters=None,
@@ -1049,75 +1243,16 @@ def singularityCommand(tool=None,
         # Note that we target Singularity 3+.
         baseSingularityCall += ['-u', '-B', '{}:{}'.format(os.path.abspath(work_dir), '/mnt'), '--pwd', '/mnt']
 
-        # Problem: Multiple Singularity downloads sharing the same cache directory will
-        # not work correctly. See https://github.com/sylabs/singularity/issues/3634
-        # and https://github.com/sylabs/singularity/issues/4555.
-
-        # As a workaround, we have out own cache which we manage ourselves.
-        home_dir = str(pathlib.Path.home())
-        default_singularity_dir = os.path.join(home_dir, '.singularity')
-        cache_dir = os.path.join(os.environ.get('SINGULARITY_CACHEDIR',  default_singularity_dir), 'toil')
-        os.makedirs(cache_dir, exist_ok=True)
-
-        # hack to transform back to docker image
-        if tool == 'cactus':
-            tool = getDockerImage()
-        # not a url or local file? try it as a Docker specifier
-        if not tool.startswith('/') and '://' not in tool:
-            tool = 'docker://' + tool
-
-        # What name in the cache dir do we want?
-        # We cache everything as sandbox directories and not .sif files because, as
-        # laid out in https://github.com/sylabs/singularity/issues/4617, there
-        # isn't a way to run from a .sif file and have write permissions on system
-        # directories in the container, because the .sif build process makes
-        # everything owned by root inside the image. Since some toil-vg containers
-        # (like the R one) want to touch system files (to install R packages at
-        # runtime), we do it this way to act more like Docker.
-        #
-        # Also, only sandbox directories work with user namespaces, and only user
-        # namespaces work inside unprivileged Docker containers like the Toil
-        # appliance.
-        sandbox_dirname = os.path.join(cache_dir, '{}.sandbox'.format(hashlib.sha256(tool.encode('utf-8')).hexdigest()))
-
-        if not os.path.exists(sandbox_dirname):
-            # We atomically drop the sandbox at that name when we get it
-
-            # Make a temp directory to be the sandbox
-            temp_sandbox_dirname = tempfile.mkdtemp(dir=cache_dir)
-
-            # Download with a fresh cache to a sandbox
-            download_env = os.environ.copy()
-            download_env['SINGULARITY_CACHEDIR'] = file_store.getLocalTempDir() if file_store else tempfile.mkdtemp(dir=work_dir)
-            build_cmd = ['singularity', 'build', '-s', '-F', temp_sandbox_dirname, tool]
-
-            cactus_realtime_log("Running the command: \"{}\"".format(' '.join(build_cmd)))
-            start_time = time.time()
-            subprocess.check_call(build_cmd, env=download_env)
-            run_time = time.time() - start_time
-            cactus_realtime_log("Successfully ran the command: \"{}\" in {} seconds".format(' '.join(build_cmd), run_time))
-
-            # Clean up the Singularity cache since it is single use
-            shutil.rmtree(download_env['SINGULARITY_CACHEDIR'])
-
-            try:
-                # This may happen repeatedly but it is atomic
-                os.rename(temp_sandbox_dirname, sandbox_dirname)
-            except OSError as e:
-                if e.errno == errno.EEXIST:
-                    # Can't rename a directory over another
-                    # Make sure someone else has made the directory
-                    assert os.path.exists(sandbox_dirname)
-                    # Remove our redundant copy
-                    shutil.rmtree(temp_sandbox_dirname)
-                else:
-                    raise
+        return baseSingularityCall + [getSingularitySandbox(tool, work_dir, file_store)] + parameters
 
-            # TODO: we could save some downloading by having one process download
-            # and the others wait, but then we would need a real fnctl locking
-            # system here.
-        return baseSingularityCall + [sandbox_dirname] + parameters
 
+def waitForResolvConf():
+    # This is really dumb, but we have to work around an intersection
+    # between two bugs: one in CoreOS where /etc/resolv.conf is
+    # sometimes missing temporarily, and one in Docker where it
+    # refuses to start without /etc/resolv.conf.
+    while not os.path.exists('/etc/resolv.conf'):
+        time.sleep(0.1)
 
 def dockerCommand(tool=None,
                   work_dir=None,
@@ -1126,12 +1261,7 @@ def dockerCommand(tool=None,
                   port=None,
                   dockstore=None,
                   entrypoint=None):
-    # This is really dumb, but we have to work around an intersection
-    # between two bugs: one in CoreOS where /etc/resolv.conf is
-    # sometimes missing temporarily, and one in Docker where it
-    # refuses to start without /etc/resolv.conf.
-    while not os.path.exists('/etc/resolv.conf'):
-        pass
+    waitForResolvConf()
 
     base_docker_call = ['docker', 'run',
                         '--interactive',
@@ -1158,6 +1288,148 @@ def dockerCommand(tool=None,
     call = base_docker_call + [tool] + parameters
     return call, containerInfo
 
+# The container sessions that cactus_call can run commands in, innermost last
+_containerSessions = []
+
+class ContainerSession(object):
+    """A long-lived container (or singularity instance) with a job's work
+    directory mounted, in which cactus_call runs commands with `docker exec`
+    (or `singularity exec instance://`) rather than starting a container for
+    every call.
+
+    Use it around the calls a job makes:
+
+        with ContainerSession(fileStore.getLocalTempDir()):
+            cactus_call(...)
+
+    Calls whose work dir is outside the session's directory, calls for other
+    tools, servers and calls with a soft timeout run in their own container as
+    before. Nothing changes in local mode, or if CACTUS_CONTAINER_SESSIONS is
+    set to 0. Each call is measured with /usr/bin/time in the container, so
+    its peak memory and CPU time are still reported per call. A session
+    within one that already has its directory mounted uses that one.
+    """
+    def __init__(self, work_dir, tool="cactus", dockstore=None, fileStore=None):
+        self.mode = os.environ.get("CACTUS_BINARIES_MODE", "docker")
+        self.work_dir = os.path.abspath(work_dir)
+        self.tool = tool
+        self.dockstore = dockstore if dockstore is not None else getDockerOrg()
+        self.fileStore = fileStore
+        self.containerRoot = "/data" if self.mode == "docker" else "/mnt"
+        # Only the cactus image is known to have GNU time installed
+        self.measureUsage = tool == "cactus"
+        self.name = None
+
+    def isEnabled(self):
+        return self.mode in ("docker", "singularity") and os.environ.get("CACTUS_CONTAINER_SESSIONS") != "0"
+
+    def start(self):
+        name = "cactus-session-%s" % uuid.uuid4().hex
+        if self.mode == "docker":
+            waitForResolvConf()
+            image = "%s/%s:%s" % (self.dockstore, self.tool, getDockerTag())
+            call = ['docker', 'run', '--detach', '--rm', '--init',
+                    '--net=host',
+                    '--log-driver=none',
+                    '-u', '%s:%s' % (os.getuid(), os.getgid()),
+                    '-v', '{}:{}'.format(self.work_dir, self.containerRoot),
+                    '--name', name,
+                    '--entrypoint', 'sleep',
+                    image, 'infinity']
+        else:
+            assert self.mode == "singularity"
+            if "CACTUS_SINGULARITY_IMG" in os.environ:
+                image = os.environ["CACTUS_SINGULARITY_IMG"]
+                options = []
+            else:
+                image = getSingularitySandbox(self.tool, self.work_dir, self.fileStore)
+                options = ['-u']
+            call = ['singularity', '-q', 'instance', 'start'] + options + \
+                   ['-B', '{}:{}'.format(self.work_dir, self.containerRoot), image, name]
+        start_time = time.time()
+        subprocess.check_call(call, stdout=subprocess.DEVNULL)
+        self.name = name
+        cactus_realtime_log("Started container session {} in {} seconds".format(
+            name, round(time.time() - start_time, 4)))
+
+    def stop(self):
+        if self.name is None:
+            return
+        if self.mode == "docker":
+            call = ['docker', 'rm', '--force', self.name]
+        else:
+            call = ['singularity', '-q', 'instance', 'stop', self.name]
+        self.name = None
+        if subprocess.call(call, stdout=subprocess.DEVNULL) != 0:
+            logger.warning("Failed to stop container session: %s" % call)
+
+    def __enter__(self):
+        # Eg the jobs run in a local pool (see localTurbo) use the session of
+        # the job running them
+        if self.isEnabled() and getContainerSession(self.mode, self.tool, self.dockstore, self.work_dir) is None:
+            try:
+                self.start()
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning("Unable to start a container session, running each call "
+                               "in its own container: %s" % e)
+        _containerSessions.append(self)
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        _containerSessions.remove(self)
+        self.stop()
+
+    def containerPath(self, work_dir):
+        """Get where work_dir is mounted in the session, or None if it isn't."""
+        work_dir = os.path.abspath(work_dir)
+        if not os.path.isdir(work_dir) or os.path.commonpath([work_dir, self.work_dir]) != self.work_dir:
+            return None
+        relPath = os.path.relpath(work_dir, self.work_dir)
+        return self.containerRoot if relPath == '.' else os.path.join(self.containerRoot, relPath)
+
+    def command(self, work_dir, parameters, entrypoint=None):
+        """Get the call to run parameters in the session, from work_dir, and
+        the file that /usr/bin/time will write the call's resource usage to
+        (or None if it isn't measured)."""
+        containerDir = self.containerPath(work_dir)
+        assert self.name is not None and containerDir is not None
+        timeFile = None
+        prefix = []
+        if self.measureUsage:
+            timeFileName = ".%s.time" % uuid.uuid4().hex
+            timeFile = os.path.join(self.work_dir, timeFileName)
+            prefix = ['/usr/bin/time', '-f', callMetrics.TIME_FORMAT, '-o',
+                      os.path.join(self.containerRoot, timeFileName)]
+        if self.mode == "docker":
+            call = ['docker', 'exec', '--interactive',
+                    '-u', '%s:%s' % (os.getuid(), os.getgid()),
+                    '-w', containerDir, self.name]
+            call += prefix + [entrypoint if entrypoint is not None else '/opt/cactus/wrapper.sh']
+        else:
+            call = ['singularity', '-q', 'exec', '--pwd', containerDir, 'instance://' + self.name] + prefix
+        return call + parameters, timeFile
+
+def getContainerSession(mode, tool, dockstore, work_dir):
+    """Get the running container session that can run a call for the given
+    tool from work_dir, if there is one."""
+    for session in reversed(_containerSessions):
+        if session.name is not None and session.mode == mode and session.tool == tool and \
+           session.dockstore == dockstore and session.containerPath(work_dir) is not None:
+            return session
+    return None
+
+def readTimeFile(timeFile):
+    """Read the resource usage written by /usr/bin/time in a container
+    session, as call record fields, or None if it isn't there. The file is
+    removed."""
+    try:
+        with open(timeFile) as f:
+            text = f.read()
+        os.remove(timeFile)
+    except IOError:
+        return None
+    return callMetrics.parseTimeOutput(text)
+
 def prepareWorkDir(work_dir, parameters):
     if not work_dir:
         # Make sure all the paths we're accessing are in the same directory
@@ -1195,6 +1467,130 @@ def prepareWorkDir(work_dir, parameters):
         parameters = [adjustPath(par, work_dir) for par in parameters]
     return work_dir, parameters
 
+def runPipelineCall(mode, tool, dockstore, work_dir, parameters, rm=True, check_output=False,
+                    infile=None, outfile=None, outappend=False, stdin_string=None,
+                    check_result=False, features=None, fileStore=None, swallowStdErr=False):
+    """Run a cactus_call pipeline (a list of commands, whose last stage may
+    be a Tee) with CommandPipeline, rather than through a shell. Each command
+    runs in the container session if there is one. Otherwise a session is
+    started for the pipeline alone, so that its commands share a container
+    as they did when a shell ran the pipeline, and each command only runs in
+    its own container if that session can't be started. Each command is
+    recorded as a call of its own."""
+    session = None
+    pipelineSession = None
+    if mode in ("docker", "singularity"):
+        commands = getPipelineCommands(parameters)
+        work_dir, _ = prepareWorkDir(work_dir, [p for command in commands for p in command])
+        session = getContainerSession(mode, tool, dockstore, work_dir)
+        if session is None and len(commands) > 1:
+            pipelineSession = ContainerSession(work_dir, tool=tool, dockstore=dockstore, fileStore=fileStore)
+            pipelineSession.__enter__()
+            session = getContainerSession(mode, tool, dockstore, work_dir)
+    try:
+        return _runPipeline(mode, tool, dockstore, work_dir, parameters, session, rm=rm,
+                            check_output=check_output, infile=infile, outfile=outfile,
+                            outappend=outappend, stdin_string=stdin_string,
+                            check_result=check_result, features=features, fileStore=fileStore,
+                            swallowStdErr=swallowStdErr)
+    finally:
+        if pipelineSession is not None:
+            pipelineSession.__exit__(None, None, None)
+
+def _runPipeline(mode, tool, dockstore, work_dir, parameters, session, rm=True, check_output=False,
+                 infile=None, outfile=None, outappend=False, stdin_string=None,
+                 check_result=False, features=None, fileStore=None, swallowStdErr=False):
+    def makeStage(command):
+        if mode in ("docker", "singularity"):
+            _, command = prepareWorkDir(work_dir, command)
+        if session is not None:
+            call, timeFile = session.command(work_dir, command)
+            return Stage(command, call, timeFile=timeFile)
+        elif mode == "docker":
+            call, containerInfo = dockerCommand(tool=tool, work_dir=work_dir, parameters=command,
+                                                rm=rm, dockstore=dockstore)
+            return Stage(command, call, containerInfo=containerInfo)
+        elif mode == "singularity":
+            return Stage(command, singularityCommand(tool=tool, work_dir=work_dir, parameters=command,
+                                                     file_store=fileStore))
+        else:
+            assert mode == "local"
+            return Stage(command, command)
+    pipeline = CommandPipeline(mapPipeline(parameters, makeStage), cwd=work_dir or None)
+
+    pipelineString = " | ".join([" ".join(stage.call) for stage in pipeline.allStages()])
+    _log.info("Running the pipeline %s" % pipelineString)
+    rt_message = 'Running the command: \"{}\"'.format(pipelineString)
+    if features:
+        rt_message += ' (features={})'.format(features)
+    cactus_realtime_log(rt_message)
+
+    containerStats = {}
+    def sampleContainers():
+        # Every so often, check the usage of the containers of the stages
+        for stage in pipeline.allStages():
+            if stage.containerInfo is not None:
+                memUsage = maxMemUsageOfContainer(stage.containerInfo)
+                stats = containerStats.setdefault(stage, {})
+                if memUsage is not None:
+                    stats["maxRss"] = memUsage
+                if stage.containerInfo['id'] is not None:
+                    stats.update(callMetrics.containerCgroupStats(stage.containerInfo['id']))
+
+    stdin = open(infile, 'rb') if infile else subprocess.DEVNULL
+    stdout = None
+    if outfile:
+        stdout = open(outfile, 'ab' if outappend else 'wb')
+    if check_output:
+        stdout = subprocess.PIPE
+    start_time = time.time()
+    try:
+        pipeline.start(stdin=stdin, stdout=stdout, stdinString=stdin_string)
+        returncode = pipeline.wait(tick=sampleContainers)
+    finally:
+        if infile:
+            stdin.close()
+        if outfile:
+            stdout.close()
+    run_time = time.time() - start_time
+
+    for stage in pipeline.allStages():
+        if stage.process is None:
+            continue
+        if stage.timeFile is not None:
+            usage = readTimeFile(stage.timeFile) or {}
+            usage.pop("wallTime", None)
+        elif stage.containerInfo is not None:
+            usage = containerStats.get(stage, {})
+        else:
+            usage = callMetrics.rusageStats(stage.process.rusage)
+        callMetrics.recordCall(callMetrics.getToolName(stage.parameters), stage.process.returncode,
+                               stage.wallTime, mode=mode, features=features, **usage)
+    if not swallowStdErr:
+        pipeline.writeStderr()
+
+    if returncode == 0:
+        rt_message = "Successfully ran: \"{}\"".format(pipelineString)
+        if features:
+            rt_message += ' (features={})'.format(features)
+        rt_message += " in {} seconds".format(round(run_time, 4))
+        cactus_realtime_log(rt_message)
+
+    if check_result:
+        return returncode
+
+    if returncode != 0:
+        failed = pipeline.failedStage
+        out = "stderr={}".format(failed.stderr[-10000:])
+        if returncode > 0:
+            raise RuntimeError("Command {} exited {} in pipeline {}: {}".format(failed.call, returncode, pipelineString, out))
+        else:
+            raise RuntimeError("Command {} signaled {} in pipeline {}: {}".format(failed.call, signal.Signals(-returncode).name,
+                                                                              pipelineString, out))
+
+    if check_output:
+        return pipeline.output
+
 def cactus_call(tool=None,
                 work_dir=None,
                 parameters=None,
@@ -1221,10 +1617,20 @@ def cactus_call(tool=None,
         parameters = []
     if tool is None:
         tool = "cactus"
+    toolName = callMetrics.getToolName(parameters)
+
+    if isPipeline(parameters) and not server and port is None and soft_timeout is None:
+        return runPipelineCall(mode, tool, dockstore, work_dir, parameters, rm=rm, check_output=check_output,
+                               infile=infile, outfile=outfile, outappend=outappend, stdin_string=stdin_string,
+                               check_result=check_result, features=features, fileStore=fileStore,
+                               swallowStdErr=swallowStdErr)
     
     entrypoint = None
     if (len(parameters) > 0) and isinstance(parameters[0], list):
         # We have a list of lists, which is the convention for commands piped into one another.
+        # Servers and calls with a timeout still run them through bash.
+        if any([isinstance(stage, Tee) for stage in parameters]):
+            raise RuntimeError("Pipelines with a Tee can't be run as servers or with a timeout")
         flattened = [i for sublist in parameters for i in sublist]
         chain_params = [' '.join(p) for p in [list(map(pipes.quote, q)) for q in parameters]]
         parameters = ['bash', '-c', 'set -eo pipefail && ' + ' | '.join(chain_params)]
@@ -1238,7 +1644,14 @@ def cactus_call(tool=None,
     if mode in ("docker", "singularity"):
         work_dir, parameters = prepareWorkDir(work_dir, parameters)
 
-    if mode == "docker":
+    session = None
+    timeFile = None
+    if mode in ("docker", "singularity") and not server and port is None and soft_timeout is None:
+        session = getContainerSession(mode, tool, dockstore, work_dir)
+
+    if session is not None:
+        call, timeFile = session.command(work_dir, parameters, entrypoint=entrypoint)
+    elif mode == "docker":
         call, containerInfo = dockerCommand(tool=tool,
                                             work_dir=work_dir,
                                             parameters=parameters,
@@ -1272,7 +1685,9 @@ def cactus_call(tool=None,
     cactus_realtime_log(rt_message, log_debug = 'ktremotemgr' in call)
 
     # hack to keep track of memory usage for single machine
-    time_v = os.environ.get("CACTUS_LOG_MEMORY") is not None and 'ktserver' not in call and 'redis-server' not in call
+    # (in a container session, the call is timed inside the container instead)
+    time_v = os.environ.get("CACTUS_LOG_MEMORY") is not None and 'ktserver' not in call and 'redis-server' not in call \
+             and session is None
 
     # use /usr/bin/time -v to get peak memory usage
     if time_v:
@@ -1282,15 +1697,16 @@ def cactus_call(tool=None,
         swallowStdErr = True
         call = '/usr/bin/time -v {}'.format(call)
         
-    process = subprocess.Popen(call, shell=shell, encoding="ascii",
-                               stdin=stdinFileHandle, stdout=stdoutFileHandle,
-                               stderr=subprocess.PIPE if swallowStdErr else sys.stderr,
-                               bufsize=-1, cwd=work_dir)
+    process = callMetrics.RusagePopen(call, shell=shell, encoding="ascii",
+                                      stdin=stdinFileHandle, stdout=stdoutFileHandle,
+                                      stderr=subprocess.PIPE if swallowStdErr else sys.stderr,
+                                      bufsize=-1, cwd=work_dir)
 
     if server:
         return process
 
     memUsage = 0
+    containerStats = {}
     first_run = True
     start_time = time.time()
     output = stderr = None  # used later to report errors
@@ -1299,12 +1715,14 @@ def cactus_call(tool=None,
             # Wait a bit to see if the process is done
             output, stderr = process.communicate(stdin_string if first_run else None, timeout=10)
         except subprocess.TimeoutExpired:
-            if mode == "docker":
+            if mode == "docker" and session is None:
                 # Every so often, check the memory usage of the container
                 updatedMemUsage = maxMemUsageOfContainer(containerInfo)
                 if updatedMemUsage is not None:
                     assert memUsage <= updatedMemUsage, "memory.max_usage_in_bytes should never decrease"
                     memUsage = updatedMemUsage
+                if containerInfo['id'] is not None:
+                    containerStats = callMetrics.containerCgroupStats(containerInfo['id']) or containerStats
             first_run = False
             if soft_timeout is not None and time.time() - start_time > soft_timeout:
                 # Soft timeout has been triggered. Just return early.
@@ -1312,14 +1730,25 @@ def cactus_call(tool=None,
                 return None
         else:
             break
-    if mode == "docker" and job_name is not None and features is not None and fileStore is not None:
+    run_time = time.time() - start_time
+    if timeFile is not None:
+        # The call was timed in the container session
+        usage = readTimeFile(timeFile) or {}
+        usage.pop("wallTime", None)
+        memUsage = usage.get("maxRss")
+    elif mode == "docker":
+        # Sampled from the container's cgroup while it ran
+        usage = dict(containerStats, maxRss=memUsage or None)
+    else:
+        usage = callMetrics.rusageStats(process.rusage)
+    callMetrics.recordCall(toolName, process.returncode, run_time, mode=mode, features=features, **usage)
+    if (mode == "docker" or session is not None) and job_name is not None and features is not None and fileStore is not None:
         # Log a datapoint for the memory usage for these features.
         fileStore.logToMaster("Max memory used for job %s (tool %s) "
                               "on JSON features %s: %s" % (job_name, parameters[0],
                                                            json.dumps(features), memUsage))
 
     if process.returncode == 0:
-        run_time = time.time() - start_time
         if time_v:
             call = call[len("/usr/bin/time -v "):]
         rt_message = "Successfully ran: \"{}\"".format(' '.join(call) if not shell else call)
@@ -1331,6 +1760,8 @@ def cactus_call(tool=None,
                 if 'Maximum resident set size (kbytes):' in line:
                     rt_message += ' and {} memory'.format(bytes2human(int(line.split()[-1]) * 1024))
                     break
+        elif timeFile is not None and memUsage:
+            rt_message += ' and {} memory'.format(bytes2human(memUsage))
         cactus_realtime_log(rt_message, log_debug = 'ktremotemgr' in call)
 
     if check_result:
@@ -1348,6 +1779,35 @@ def cactus_call(tool=None,
     if check_output:
         return output
 
+# Thread pools for cactus_call_async, keyed by the number of calls they run at once
+_callExecutors = {}
+_callExecutorsLock = threading.Lock()
+
+def getCallConcurrency(job):
+    """Get how many calls a job can run at once: one per core it asked for."""
+    try:
+        return max(1, int(math.ceil(job.cores)))
+    except AttributeError:
+        # No requirement and no config to default to
+        return 1
+
+def cactus_call_async(job=None, concurrency=None, **kwargs):
+    """Start cactus_call(**kwargs) in a background thread, returning a
+    concurrent.futures.Future for what cactus_call returns (or raises).
+
+    At most concurrency calls run at once, by default one per core the given
+    job has; the rest wait their turn. Each call is a separate cactus_call,
+    so it captures its own output, has its own timeout and reports its own
+    memory usage.
+    """
+    if concurrency is None:
+        concurrency = getCallConcurrency(job) if job is not None else 1
+    with _callExecutorsLock:
+        if concurrency not in _callExecutors:
+            _callExecutors[concurrency] = ThreadPoolExecutor(max_workers=concurrency)
+        executor = _callExecutors[concurrency]
+    return executor.submit(cactus_call, **kwargs)
+
 class RunAsFollowOn(Job):
     def __init__(self, job, *args, **kwargs):
         Job.__init__(self, cores=0.1, memory=100000000, preemptable=True)
@@ -1369,6 +1829,9 @@ class RoundedJob(Job):
     """
     # Default rounding amount: 100 MiB
     roundingAmount = 100*1024*1024
+    # Fraction of the peak memory of an attempt that ran out of memory
+    # to add on for the retry
+    oomRetryMargin = 0.25
     def __init__(self, memory=None, cores=None, disk=None, preemptable=None,
                  unitName=None, checkpoint=False):
         if memory is not None:
@@ -1402,12 +1865,54 @@ class RoundedJob(Job):
     def _runner(self, jobGraph, jobStore, fileStore, defer=None):
         if jobStore.config.workDir is not None:
             os.environ['TMPDIR'] = fileStore.getLocalTempDir()
-        if defer:
-            # Toil v 3.21 or later
-            super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore, defer=defer)
-        else:
-            # Older versions of toil
-            super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore)
+        callMetrics.startJob(self)
+        sampler = jobProfiler.startJob()
+        records = None
+        try:
+            if defer:
+                # Toil v 3.21 or later
+                super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore, defer=defer)
+            else:
+                # Older versions of toil
+                super(RoundedJob, self)._runner(jobGraph=jobGraph, jobStore=jobStore, fileStore=fileStore)
+        except Exception as e:
+            records = callMetrics.finishJob(jobStore if jobStore.config.stats else None, failed=True)
+            selfPeak = None
+            if isinstance(e, MemoryError):
+                selfPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            self.escalateMemoryAfterFailure(jobGraph, jobStore, records, selfPeak)
+            raise
+        finally:
+            if records is None:
+                # Keep the records of the job's calls with its stats, if there are any
+                callMetrics.finishJob(jobStore if jobStore.config.stats else None)
+            jobProfiler.finishJob(sampler, self, jobStore)
+
+    def escalateMemoryAfterFailure(self, jobGraph, jobStore, records, selfPeak=None):
+        """If the failed attempt ran out of memory, set the memory of the job's
+        retry from the peak the attempt reached, rather than leaving Toil to
+        retry it with the memory it just ran out of."""
+        retryMemory = callMetrics.getRetryMemory(records, jobGraph.memory, self.oomRetryMargin, selfPeak)
+        if retryMemory is None:
+            return
+        retryMemory = min(self.roundUp(retryMemory), jobStore.config.maxMemory)
+        if retryMemory <= jobGraph.memory:
+            _log.warning("Job %s ran out of memory with %s, and can't be retried with more than "
+                         "--maxMemory %s" % (self, bytes2human(jobGraph.memory), bytes2human(jobStore.config.maxMemory)))
+            return
+        try:
+            # The worker reloads the job from the job store when it fails, and
+            # the leader retries what is there
+            failedJobGraph = jobStore.load(jobGraph.jobStoreID)
+            failedJobGraph._memory = retryMemory
+            jobStore.update(failedJobGraph)
+        except Exception as e:
+            _log.warning("Couldn't raise the memory of job %s for its retry: %s" % (self, e))
+            return
+        message = "Job {} ran out of memory with {}, retrying it with {}".format(
+            self, bytes2human(jobGraph.memory), bytes2human(retryMemory))
+        _log.warning(message)
+        cactus_realtime_log(message)
 
 def readGlobalFileWithoutCache(fileStore, jobStoreID):
     """Reads a jobStoreID into a file and returns it, without touching
@@ -1419,6 +1924,60 @@ def readGlobalFileWithoutCache(fileStore, jobStoreID):
     fileStore.jobStore.readFile(jobStoreID, f)
     return f
 
+def concatenateGlobalFiles(fileStore, fileIDs, localFiles=(), prefetch=4, decompress=False):
+    """Concatenate files in the job store, followed by any local files, into a
+    new file in the job store, returning its ID. If decompress is set, the
+    files that are gzipped are gunzipped as they are copied.
+
+    The output is streamed straight into the job store. Up to prefetch of
+    the inputs are fetched at once, in parallel, ahead of the one being
+    copied, and each is removed as soon as it has been copied, so the job
+    never holds a local copy of all of them (and a file job store only
+    links them). The job store's own stream is written to, rather than the
+    file store's wrapper of it, which has no file descriptor, so that with
+    a file job store the inputs are copied in the kernel. The output is
+    associated with the job, as writeGlobalFile's is, and deleted if the
+    copy fails, so a failed attempt doesn't leave it behind.
+    """
+    def fetch(fileID):
+        path = fileStore.getLocalTempFileName()
+        fileStore.jobStore.readFile(fileID, path, symlink=True)
+        return path
+
+    copyFn = copyFileDataDecompressed if decompress else copyFileData
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+        fetches = [executor.submit(fetch, fileID) for fileID in fileIDs[:prefetch]]
+        size = 0
+        outID = None
+        try:
+            with fileStore.jobStore.writeFileStream(fileStore.jobGraph.jobStoreID) as (outFile, outID):
+                for i in range(len(fileIDs)):
+                    if i + prefetch < len(fileIDs):
+                        fetches.append(executor.submit(fetch, fileIDs[i + prefetch]))
+                    path = fetches[i].result()
+                    with open(path, 'rb') as inFile:
+                        size += copyFn(inFile, outFile)
+                    os.remove(path)
+                for path in localFiles:
+                    with open(path, 'rb') as inFile:
+                        size += copyFn(inFile, outFile)
+        except:
+            if outID is not None:
+                fileStore.jobStore.deleteFile(outID)
+            raise
+    # The size is what the jobs that read the file are sized by
+    return FileID(outID, size)
+
+def groupForFanIn(items, fanIn):
+    """Split items into the groups to give the children of a job in a tree of
+    jobs that each take at most fanIn inputs: at most fanIn groups, each of
+    at most fanIn items if possible (and otherwise split again by a tree of
+    their own)."""
+    assert fanIn > 1
+    numGroups = min(fanIn, int(math.ceil(len(items) / float(fanIn))))
+    groupSize = int(math.ceil(len(items) / float(numGroups)))
+    return [items[i:i + groupSize] for i in range(0, len(items), groupSize)]
+
 class ChildTreeJob(RoundedJob):
     """Spreads the child-job initialization work among multiple jobs.
 
@@ -1,7 +1,11 @@
+import gzip
+import io
 import os
 import shutil
+import time
 import unittest
 from base64 import b64encode
+from unittest.mock import patch
 
 from sonLib.bioio import TestStatus
 from sonLib.bioio import getTempFile
@@ -11,7 +15,11 @@ from toil.job import Job
 from toil.common import Toil
 from cactus.shared.common import encodeFlowerNames, decodeFirstFlowerName, \
                                  runCactusSplitFlowersBySecondaryGrouping, \
-                                 cactus_call, ChildTreeJob
+                                 cactus_call, ChildTreeJob, ContainerSession, \
+                                 readTimeFile, cactus_call_async, getCallConcurrency, \
+                                 catFiles, copyFileDataDecompressed, \
+                                 compressStream, decompressStream, groupForFanIn
+from cactus.shared.commandPipeline import Tee
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -88,6 +96,91 @@ class TestCase(unittest.TestCase):
                              check_output=True)
         self.assertEqual(output, 'quuxbazbar\n')
 
+        # A producer teed into two pipelines
+        outputFiles = [getTempFile(rootDir=self.tempDir) for i in range(2)]
+        cactus_call(parameters=[['cat', inputFile],
+                                Tee([[['sed', 's/foo/baz/g']], [['wc', '-c']]], outfiles=outputFiles)])
+        with open(outputFiles[0]) as f:
+            self.assertEqual(f.read(), 'bazbar\n')
+        with open(outputFiles[1]) as f:
+            self.assertEqual(f.read().strip(), '7')
+
+        with self.assertRaises(RuntimeError):
+            cactus_call(parameters=[['cat', inputFile], ['false'], ['cat']])
+
+    @TestStatus.shortLength
+    def testContainerSessionCommand(self):
+        """Calls in a session are run with docker exec from where their work
+        dir is mounted, with their resource usage written to a file."""
+        subDir = os.path.join(self.tempDir, "sub")
+        os.makedirs(subDir)
+        with patch.dict(os.environ, {"CACTUS_BINARIES_MODE": "docker"}):
+            session = ContainerSession(self.tempDir)
+        session.name = "session"
+        self.assertEqual(session.containerPath(self.tempDir), "/data")
+        self.assertEqual(session.containerPath(subDir), "/data/sub")
+        self.assertEqual(session.containerPath(os.path.dirname(self.tempDir)), None)
+
+        call, timeFile = session.command(subDir, ["cactus_caf", "--help"])
+        self.assertEqual(call[:2], ["docker", "exec"])
+        self.assertEqual(call[call.index("-w") + 1], "/data/sub")
+        self.assertEqual(call[-3:], ["/opt/cactus/wrapper.sh", "cactus_caf", "--help"])
+        self.assertEqual(os.path.dirname(timeFile), self.tempDir)
+        self.assertTrue(os.path.join("/data", os.path.basename(timeFile)) in call)
+
+        with open(timeFile, "w") as f:
+            f.write("Command exited with non-zero status 1\n1.50 1.00 0.25 2048 8 16\n")
+        usage = readTimeFile(timeFile)
+        self.assertEqual(usage["maxRss"], 2048 * 1024)
+        self.assertEqual(usage["userTime"], 1.0)
+        self.assertEqual(usage["writeBytes"], 16 * 512)
+        self.assertFalse(os.path.exists(timeFile))
+        self.assertEqual(readTimeFile(timeFile), None)
+
+    @TestStatus.shortLength
+    def testPipelineSession(self):
+        """Outside a session, the commands of a pipeline share a container
+        started for the pipeline, rather than getting one each."""
+        inputFile = getTempFile(rootDir=self.tempDir)
+        with open(inputFile, 'w') as f:
+            f.write('foobar\n')
+        sessions = []
+        def start(session):
+            session.name = "pipeline"
+            sessions.append(session)
+        def stop(session):
+            session.name = None
+        def command(session, work_dir, parameters, entrypoint=None):
+            # Run the command here, as it would be in the container
+            return parameters, None
+        def dockerCommand(**kwargs):
+            raise RuntimeError("Started a container for a command")
+        with patch.dict(os.environ, {"CACTUS_BINARIES_MODE": "docker"}), \
+             patch.object(ContainerSession, "start", start), patch.object(ContainerSession, "stop", stop), \
+             patch.object(ContainerSession, "command", command), \
+             patch("cactus.shared.common.dockerCommand", dockerCommand):
+            output = cactus_call(work_dir=self.tempDir,
+                                 parameters=[['cat', inputFile], ['sed', 's/foo/baz/g']],
+                                 check_output=True)
+        self.assertEqual(output, 'bazbar\n')
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions[0].name, None)
+
+    @TestStatus.shortLength
+    def testCactusCallAsync(self):
+        """Calls overlap up to the concurrency limit, and each keeps its own
+        output and errors."""
+        with patch.dict(os.environ, {"CACTUS_BINARIES_MODE": "local"}):
+            start = time.time()
+            futures = [cactus_call_async(concurrency=4, check_output=True,
+                                         parameters=["bash", "-c", "sleep 1; echo %d" % i]) for i in range(4)]
+            self.assertEqual([future.result() for future in futures], ["%d\n" % i for i in range(4)])
+            self.assertLess(time.time() - start, 3)
+            self.assertRaises(RuntimeError, cactus_call_async(concurrency=4, parameters=["false"]).result)
+
+        self.assertEqual(getCallConcurrency(Job(cores=2.5)), 3)
+        self.assertEqual(getCallConcurrency(Job(cores=0.1)), 1)
+
     @TestStatus.mediumLength
     def testChildTreeJob(self):
         """Check that the ChildTreeJob class runs all children."""
@@ -105,6 +198,65 @@ class TestCase(unittest.TestCase):
             self.assertTrue(os.path.exists(os.path.join(flagDir, str(i))))
         shutil.rmtree(flagDir)
 
+    @TestStatus.shortLength
+    def testCatFiles(self):
+        paths = []
+        for i in range(30):
+            paths.append(os.path.join(self.tempDir, "in%d" % i))
+            with open(paths[-1], "w") as f:
+                f.write("line %d\n" % i * (i + 1))
+        catFile = os.path.join(self.tempDir, "out")
+        catFiles(paths, catFile)
+        with open(catFile) as f:
+            self.assertEqual(f.read(), "".join(["line %d\n" % i * (i + 1) for i in range(30)]))
+        catFiles([], catFile)
+        self.assertEqual(os.path.getsize(catFile), 0)
+
+    @TestStatus.shortLength
+    def testCompressRoundTrip(self):
+        data = os.urandom(5000) + b'A' * 20000 + os.urandom(123)
+        # Small blocks, so that the test covers many of them
+        with patch("cactus.shared.common.COMPRESSION_BLOCK_SIZE", 1000):
+            for threads in [1, 3]:
+                compressed = io.BytesIO()
+                compressStream(io.BytesIO(data), compressed, threads=threads)
+                # Any gzip reader can read the parallel output
+                self.assertEqual(gzip.decompress(compressed.getvalue()), data)
+                decompressed = io.BytesIO()
+                compressed.seek(0)
+                decompressStream(compressed, decompressed)
+                self.assertEqual(decompressed.getvalue(), data)
+        compressed = io.BytesIO()
+        compressStream(io.BytesIO(b''), compressed)
+        self.assertEqual(compressed.getvalue(), b'')
+
+    @TestStatus.shortLength
+    def testCopyFileDataDecompressed(self):
+        # Gzip files concatenated together are one gzip file
+        gzipPath = os.path.join(self.tempDir, "in.gz")
+        with open(gzipPath, "wb") as f:
+            f.write(gzip.compress(b"first\n") + gzip.compress(b"second\n"))
+        plainPath = os.path.join(self.tempDir, "in")
+        with open(plainPath, "w") as f:
+            f.write("third\n")
+        outPath = os.path.join(self.tempDir, "out")
+        sizes = []
+        with open(outPath, "wb") as outFile:
+            for path in [gzipPath, plainPath]:
+                with open(path, "rb") as inFile:
+                    sizes.append(copyFileDataDecompressed(inFile, outFile))
+        with open(outPath) as f:
+            self.assertEqual(f.read(), "first\nsecond\nthird\n")
+        self.assertEqual(sizes, [13, 6])
+
+    def testGroupForFanIn(self):
+        self.assertEqual(groupForFanIn(list(range(6)), 3), [[0, 1, 2], [3, 4, 5]])
+        # Groups bigger than the fan-in, rather than too many groups
+        self.assertEqual(groupForFanIn(list(range(5)), 2), [[0, 1, 2], [3, 4]])
+        self.assertEqual([len(group) for group in groupForFanIn(list(range(10)), 3)], [4, 4, 2])
+        # Each group is smaller than the items, so the tree gets to its leaves
+        self.assertRaises(AssertionError, groupForFanIn, list(range(5)), 1)
+
 class CTTestParent(ChildTreeJob):
     def __init__(self, flagDir, numChildren):
         self.flagDir = flagDir
@@ -39,6 +39,20 @@ class ConfigWrapper:
         xmlFile.write(xmlString)
         xmlFile.close()
 
+    def applyOverlay(self, overlayRoot):
+        """Merge a partial config, such as the memoryPoly overlay written by
+        cactus-fit-memory, into this one. Elements of the overlay are matched
+        to the first element with the same tag, and added if there is none,
+        and their attributes are set."""
+        def merge(node, overlayNode):
+            node.attrib.update(overlayNode.attrib)
+            for overlayChild in overlayNode:
+                child = node.find(overlayChild.tag)
+                if child is None:
+                    child = ET.SubElement(node, overlayChild.tag)
+                merge(child, overlayChild)
+        merge(self.xmlRoot, overlayRoot)
+
     def getMCElem(self):
         return self.xmlRoot.find("multi_cactus")
 
@@ -165,6 +179,16 @@ class ConfigWrapper:
             return int(ktServerElem.attrib["cpu"])
         return default
 
+    def getKtserverCompressSnapshots(self):
+        """Gzip database snapshots on their way into the job store"""
+        ktServerElem = self.xmlRoot.find("ktserver")
+        return getOptionalAttrib(ktServerElem, "compressSnapshots", typeFn=bool, default=False)
+
+    def getKtserverRedisShards(self):
+        """Number of redis-servers to spread the primary database over (Python clients only)"""
+        ktServerElem = self.xmlRoot.find("ktserver")
+        return getOptionalAttrib(ktServerElem, "redisShards", typeFn=int, default=1)
+
     def getDefaultMemory(self):
         constantsElem = self.xmlRoot.find("constants")
         return int(constantsElem.attrib["defaultMemory"])
@@ -173,6 +197,11 @@ class ConfigWrapper:
         exportHalElem = self.xmlRoot.find("exportHal")
         return int(exportHalElem.attrib["disk"])
 
+    def getExportHalParallel(self):
+        """Build the HAL for independent subtrees in parallel, then merge them up the tree"""
+        exportHalElem = self.xmlRoot.find("exportHal")
+        return getOptionalAttrib(exportHalElem, "parallel", typeFn=bool, default=False)
+
     def substituteAllPredefinedConstantsWithLiterals(self):
         constants = findRequiredNode(self.xmlRoot, "constants")
         defines = constants.find("defines")
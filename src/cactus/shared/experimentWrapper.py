@@ -83,6 +83,46 @@ class DbElemWrapper(object):
         assert self.getDbType() in ["kyoto_tycoon", "redis"]
         self.dbElem.attrib["host"] = host
 
+    def getDbUnixSocket(self):
+        assert self.getDbType() == "redis"
+        if "unix_socket" in self.dbElem.attrib:
+            return self.dbElem.attrib["unix_socket"]
+        return None
+
+    def setDbUnixSocket(self, path):
+        assert self.getDbType() == "redis"
+        self.dbElem.attrib["unix_socket"] = path
+
+    def getDbNumShards(self):
+        """The number of servers the keys are spread over (only redis can
+        be sharded)."""
+        if self.getDbType() == "redis" and "num_shards" in self.dbElem.attrib:
+            return int(self.dbElem.attrib["num_shards"])
+        return 1
+
+    def setDbNumShards(self, numShards):
+        assert self.getDbType() == "redis"
+        self.dbElem.attrib["num_shards"] = str(numShards)
+
+    def getDbShards(self):
+        """Get a DbElemWrapper for each running shard, in the order used by
+        dbClients.getShardIndex to place keys. Empty if not sharded."""
+        shards = []
+        for shardElem in self.dbElem.findall("shard"):
+            confElem = ET.Element("st_kv_database_conf", type=self.getDbType())
+            ET.SubElement(confElem, self.getDbType(), attrib=dict(shardElem.attrib))
+            shards.append(DbElemWrapper(confElem))
+        return shards
+
+    def setDbShards(self, shards):
+        assert self.getDbType() == "redis"
+        for shardElem in self.dbElem.findall("shard"):
+            self.dbElem.remove(shardElem)
+        for shard in shards:
+            attrib = dict(shard.getDbElem().attrib)
+            attrib.pop("database_dir", None)
+            ET.SubElement(self.dbElem, "shard", attrib=attrib)
+
     def getDbServerOptions(self):
         assert self.getDbType() in ["kyoto_tycoon", "redis"]
         if "server_options" in self.dbElem.attrib:
@@ -10,7 +10,7 @@ import unittest
 import os
 import xml.etree.ElementTree as ET
 from sonLib.bioio import TestStatus
-from cactus.shared.experimentWrapper import ExperimentWrapper
+from cactus.shared.experimentWrapper import ExperimentWrapper, DbElemWrapper
 from sonLib.nxnewick import NXNewick
 
 class TestCase(unittest.TestCase):
@@ -75,6 +75,26 @@ class TestCase(unittest.TestCase):
         self.exp.setTree(tree2)
         self.assertEqual(set(self.exp.getGenomesWithSequence()), set(['HUMAN', 'CHIMP', 'BABOON']))
 
+    @TestStatus.shortLength
+    def testDbShards(self):
+        dbElem = DbElemWrapper(ET.fromstring('<st_kv_database_conf type="redis"><redis port="1"/></st_kv_database_conf>'))
+        self.assertEqual(dbElem.getDbNumShards(), 1)
+        self.assertEqual(dbElem.getDbShards(), [])
+        dbElem.setDbNumShards(2)
+        shards = []
+        for port in [1, 2]:
+            shard = DbElemWrapper(ET.fromstring('<st_kv_database_conf type="redis"><redis/></st_kv_database_conf>'))
+            shard.setDbHost('host')
+            shard.setDbPort(port)
+            shards.append(shard)
+        dbElem.setDbShards(shards)
+        # The shards survive being passed around as a conf string
+        dbElem = DbElemWrapper(ET.fromstring(dbElem.getConfString()))
+        self.assertEqual(dbElem.getDbNumShards(), 2)
+        self.assertEqual([(s.getDbHost(), s.getDbPort()) for s in dbElem.getDbShards()],
+                         [('host', 1), ('host', 2)])
+        self.assertEqual(self.exp.getDbNumShards(), 1)
+
     def __makeXmlDummy(self):
 
         rootElem =  ET.Element("dummy")
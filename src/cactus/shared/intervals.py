@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""In-process interval algebra on half-open (start, end) intervals.
+
+The list functions expect intervals sorted by start; mergeIntervals can be
+used to put any list into that form. All of them are single passes over
+their inputs. IntervalIndex keeps merged intervals for many contigs in
+arrays so that overlap queries are a binary search rather than a scan, and
+readBed/writeBed stream BED records so that whole files never need to be
+held in memory.
+"""
+
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+
+def mergeIntervals(intervals, mergeDistance=0):
+    """Sort intervals and merge those that overlap, touch, or are at most
+    mergeDistance apart. Returns a list of (start, end) tuples."""
+    ret = []
+    for interval in sorted(intervals, key=lambda x: (x[0], x[1])):
+        start, end = interval[0], interval[1]
+        if ret and start - ret[-1][1] <= mergeDistance:
+            if end > ret[-1][1]:
+                ret[-1] = (ret[-1][0], end)
+        else:
+            ret.append((start, end))
+    return ret
+
+def complementIntervals(intervals, length):
+    """Get the non-empty gaps in [0, length) that are not covered by the
+    given sorted intervals."""
+    ret = []
+    pos = 0
+    for interval in intervals:
+        if interval[0] > pos:
+            ret.append((pos, min(interval[0], length)))
+        pos = max(pos, interval[1])
+        if pos >= length:
+            break
+    if pos < length:
+        ret.append((pos, length))
+    return ret
+
+def intersectIntervals(intervals1, intervals2):
+    """Get the regions covered by both of two sorted, merged interval lists."""
+    ret = []
+    i = j = 0
+    while i < len(intervals1) and j < len(intervals2):
+        start = max(intervals1[i][0], intervals2[j][0])
+        end = min(intervals1[i][1], intervals2[j][1])
+        if start < end:
+            ret.append((start, end))
+        if intervals1[i][1] < intervals2[j][1]:
+            i += 1
+        else:
+            j += 1
+    return ret
+
+def subtractIntervals(intervals, toRemove):
+    """Remove the regions covered by the sorted, merged list toRemove from
+    each interval in the sorted list intervals.
+
+    Any fields after the start and end of an interval are kept on each of the
+    pieces it is split into. Intervals may overlap each other."""
+    ret = []
+    first = 0
+    for interval in intervals:
+        start, end, rest = interval[0], interval[1], tuple(interval[2:])
+        # Skip removed regions that end before this interval starts. They
+        # can be skipped for good as the intervals are sorted by start.
+        while first < len(toRemove) and toRemove[first][1] <= start:
+            first += 1
+        k = first
+        while k < len(toRemove) and toRemove[k][0] < end:
+            if toRemove[k][0] > start:
+                ret.append((start, toRemove[k][0]) + rest)
+            start = max(start, toRemove[k][1])
+            k += 1
+        if start < end:
+            ret.append((start, end) + rest)
+    return ret
+
+def coverageRuns(intervals):
+    """Get the depth of coverage of the given intervals, in any order, as a
+    sorted list of (start, end, depth) runs.
+
+    There is one run between each pair of consecutive distinct interval
+    endpoints, including runs of depth 0 between intervals."""
+    deltas = defaultdict(int)
+    for interval in intervals:
+        deltas[interval[0]] += 1
+        deltas[interval[1]] -= 1
+    ret = []
+    depth = 0
+    prevPos = None
+    for pos in sorted(deltas):
+        if prevPos is not None:
+            ret.append((prevPos, pos, depth))
+        depth += deltas[pos]
+        prevPos = pos
+    return ret
+
+def coveredLength(intervals):
+    """Get the number of positions covered by at least one interval."""
+    return sum(end - start for start, end in mergeIntervals(intervals))
+
+class IntervalIndex:
+    """Merged intervals on many contigs, indexed for overlap queries."""
+    def __init__(self, intervalsByContig=None):
+        self.starts = {}
+        self.ends = {}
+        if intervalsByContig is not None:
+            for contig, intervals in intervalsByContig.items():
+                self.addContig(contig, intervals)
+
+    @staticmethod
+    def fromBed(bedFile):
+        """Build an index from all the records of an open BED file."""
+        intervalsByContig = defaultdict(list)
+        for contig, start, end, fields in readBed(bedFile):
+            intervalsByContig[contig].append((start, end))
+        return IntervalIndex(intervalsByContig)
+
+    def addContig(self, contig, intervals):
+        """Set the intervals for a contig, replacing any it already had."""
+        merged = mergeIntervals(intervals)
+        self.starts[contig] = array('q', [x[0] for x in merged])
+        self.ends[contig] = array('q', [x[1] for x in merged])
+
+    def contigs(self):
+        return list(self.starts.keys())
+
+    def intervals(self, contig):
+        """Get the sorted, merged intervals of a contig."""
+        if contig not in self.starts:
+            return []
+        return list(zip(self.starts[contig], self.ends[contig]))
+
+    def overlapping(self, contig, start, end):
+        """Get the parts of the indexed intervals that fall within
+        [start, end) on the given contig, in order."""
+        ret = []
+        if contig not in self.starts:
+            return ret
+        starts, ends = self.starts[contig], self.ends[contig]
+        k = bisect_right(ends, start)
+        while k < len(starts) and starts[k] < end:
+            ret.append((max(starts[k], start), min(ends[k], end)))
+            k += 1
+        return ret
+
+    def subtract(self, contig, start, end):
+        """Get the parts of [start, end) on the given contig that are not
+        covered by the indexed intervals."""
+        ret = []
+        for overlapStart, overlapEnd in self.overlapping(contig, start, end):
+            if overlapStart > start:
+                ret.append((start, overlapStart))
+            start = overlapEnd
+        if start < end:
+            ret.append((start, end))
+        return ret
+
+    def covers(self, contig, pos):
+        """Is the given position covered by an indexed interval?"""
+        return len(self.overlapping(contig, pos, pos + 1)) > 0
+
+def readBed(bedFile):
+    """Stream (contig, start, end, fields) records from an open BED file,
+    skipping blank, comment and header lines. fields holds all of the
+    tab-separated columns of the line."""
+    for line in bedFile:
+        line = line.rstrip('\n')
+        if line.strip() == '' or line[0] == '#' or line.startswith('track') or \
+           line.startswith('browser'):
+            continue
+        fields = line.split('\t')
+        yield fields[0], int(fields[1]), int(fields[2]), fields
+
+def writeBed(outFile, records):
+    """Write (contig, start, end, fields) records to an open file. Any
+    columns after the first three are taken from fields, if given."""
+    for contig, start, end, fields in records:
+        outFile.write('\t'.join([contig, str(start), str(end)] +
+                                (list(fields[3:]) if fields else [])) + '\n')
+
+def subtractBedFiles(bedFile1, bedFile2, outFile):
+    """Write the records of bedFile1 with the regions covered by bedFile2
+    removed to outFile, like bedtools subtract. Records that are partly
+    covered are split, keeping their other columns."""
+    index = IntervalIndex.fromBed(bedFile2)
+    def subtracted():
+        for contig, start, end, fields in readBed(bedFile1):
+            for pieceStart, pieceEnd in index.subtract(contig, start, end):
+                yield contig, pieceStart, pieceEnd, fields
+    writeBed(outFile, subtracted())
@@ -0,0 +1,108 @@
+import random
+import unittest
+from io import StringIO
+from textwrap import dedent
+
+from sonLib.bioio import TestStatus
+from cactus.shared.intervals import mergeIntervals, complementIntervals, \
+                                    intersectIntervals, subtractIntervals, \
+                                    coverageRuns, coveredLength, IntervalIndex, \
+                                    readBed, writeBed, subtractBedFiles
+
+def positions(intervals):
+    """The set of positions covered by a list of intervals."""
+    return set(i for start, end in intervals for i in range(start, end))
+
+def randomIntervals(length, number, maxSize=20):
+    intervals = []
+    for i in range(number):
+        start = random.randint(0, length - 1)
+        intervals.append((start, min(start + random.randint(1, maxSize), length)))
+    return intervals
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        unittest.TestCase.setUp(self)
+
+    @TestStatus.shortLength
+    def testMerge(self):
+        self.assertEqual(mergeIntervals([(5, 10), (0, 2), (8, 12), (12, 13)]),
+                         [(0, 2), (5, 13)])
+        self.assertEqual(mergeIntervals([(0, 2), (4, 6)], mergeDistance=2), [(0, 6)])
+        self.assertEqual(mergeIntervals([(0, 10, 5), (2, 3, 1)]), [(0, 10)])
+        self.assertEqual(mergeIntervals([]), [])
+
+    @TestStatus.shortLength
+    def testRandomAgainstSets(self):
+        for i in range(200):
+            length = random.randint(1, 200)
+            a = mergeIntervals(randomIntervals(length, random.randint(0, 10)))
+            b = mergeIntervals(randomIntervals(length, random.randint(0, 10)))
+            everything = set(range(length))
+            self.assertEqual(positions(complementIntervals(a, length)), everything - positions(a))
+            self.assertEqual(positions(intersectIntervals(a, b)), positions(a) & positions(b))
+            self.assertEqual(positions(subtractIntervals(a, b)), positions(a) - positions(b))
+            self.assertEqual(coveredLength(a), len(positions(a)))
+            index = IntervalIndex({'chr': b})
+            for start, end in a:
+                self.assertEqual(positions(index.subtract('chr', start, end)),
+                                 positions([(start, end)]) - positions(b))
+                self.assertEqual(positions(index.overlapping('chr', start, end)),
+                                 positions([(start, end)]) & positions(b))
+
+    @TestStatus.shortLength
+    def testCoverageRuns(self):
+        runs = coverageRuns([(0, 10), (5, 15), (20, 25)])
+        self.assertEqual(runs, [(0, 5, 1), (5, 10, 2), (10, 15, 1), (15, 20, 0), (20, 25, 1)])
+        for i in range(50):
+            intervals = randomIntervals(100, random.randint(1, 10))
+            for start, end, depth in coverageRuns(intervals):
+                for pos in range(start, end):
+                    self.assertEqual(depth, len([x for x in intervals if x[0] <= pos < x[1]]))
+
+    @TestStatus.shortLength
+    def testSubtractKeepsFields(self):
+        self.assertEqual(subtractIntervals([(0, 10, 'a'), (5, 20, 'b')], [(3, 7)]),
+                         [(0, 3, 'a'), (7, 10, 'a'), (7, 20, 'b')])
+
+    @TestStatus.shortLength
+    def testIndex(self):
+        index = IntervalIndex({'chr1': [(10, 20), (15, 30)], 'chr2': [(0, 5)]})
+        self.assertEqual(sorted(index.contigs()), ['chr1', 'chr2'])
+        self.assertEqual(index.intervals('chr1'), [(10, 30)])
+        self.assertEqual(index.overlapping('chr1', 0, 12), [(10, 12)])
+        self.assertEqual(index.subtract('chr2', 0, 10), [(5, 10)])
+        self.assertEqual(index.subtract('chr3', 0, 10), [(0, 10)])
+        self.assertTrue(index.covers('chr1', 29))
+        self.assertFalse(index.covers('chr1', 30))
+
+    @TestStatus.shortLength
+    def testBed(self):
+        bed1 = StringIO(dedent('''\
+        # comment
+        seq1\t0\t10\t\t1
+
+        seq1\t20\t30\t\t2
+        seq2\t0\t100\t\t1
+        '''))
+        bed2 = StringIO(dedent('''\
+        seq1\t5\t25
+        seq3\t0\t10
+        '''))
+        records = list(readBed(bed1))
+        self.assertEqual([x[:3] for x in records], [('seq1', 0, 10), ('seq1', 20, 30), ('seq2', 0, 100)])
+        output = StringIO()
+        writeBed(output, records[:1])
+        self.assertEqual(output.getvalue(), 'seq1\t0\t10\t\t1\n')
+        bed1.seek(0)
+        output = StringIO()
+        subtractBedFiles(bed1, bed2, output)
+        self.assertEqual(output.getvalue(), dedent('''\
+        seq1\t0\t5\t\t1
+        seq1\t25\t30\t\t2
+        seq2\t0\t100\t\t1
+        '''))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Opt-in statistical profiler for the Python side of jobs.
+
+If CACTUS_PROFILE is set (to anything but 0) when a workflow starts, a
+thread samples the stacks of every other thread of each job's process every
+CACTUS_PROFILE_INTERVAL seconds (0.01 by default). When the job is done, the
+stacks are written into the job store with the job's stats and logs, in
+collapsed form ("outer;inner count", as taken by flamegraph.pl or
+speedscope), and can be put together by job class with cactus-profile.
+"""
+
+import json
+import os
+import sys
+import threading
+
+# Key of the profile in the stats written to the job store
+STATS_KEY = "cactus_profile"
+
+DEFAULT_INTERVAL = 0.01
+
+def isEnabled():
+    return os.environ.get("CACTUS_PROFILE", "0") not in ("", "0")
+
+def getInterval():
+    return float(os.environ.get("CACTUS_PROFILE_INTERVAL", DEFAULT_INTERVAL))
+
+class StackSampler(object):
+    """Counts the collapsed stacks of the threads of this process, sampled
+    every interval seconds from a thread of its own."""
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self._frameNames = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def frameName(self, code):
+        if code not in self._frameNames:
+            self._frameNames[code] = "%s (%s)" % (code.co_name, os.path.basename(code.co_filename))
+        return self._frameNames[code]
+
+    def collapse(self, frame):
+        names = []
+        while frame is not None:
+            names.append(self.frameName(frame.f_code))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def sample(self):
+        for threadId, frame in sys._current_frames().items():
+            if self._thread is not None and threadId == self._thread.ident:
+                continue
+            stack = self.collapse(frame)
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="cactus-profiler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+def startJob():
+    """Start profiling a job if profiling is enabled, returning the sampler
+    (or None)."""
+    if not isEnabled():
+        return None
+    return StackSampler(getInterval()).start()
+
+def finishJob(sampler, job, jobStore=None):
+    """Stop profiling a job, writing its profile to the job store if one is
+    given, and return it."""
+    if sampler is None:
+        return None
+    sampler.stop()
+    profile = {"job": job.__class__.__name__,
+               "interval": sampler.interval,
+               "samples": sampler.samples,
+               "stacks": sampler.counts}
+    if jobStore is not None and sampler.samples > 0:
+        jobStore.writeStatsAndLogging(json.dumps({STATS_KEY: profile}))
+    return profile
@@ -0,0 +1,50 @@
+"""Tests the sampling profiler of jobs
+"""
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+from cactus.shared import jobProfiler
+from cactus.shared.jobProfiler import StackSampler
+from cactus.shared.test import FakeJobStore
+
+
+class FakeJob:
+    pass
+
+
+def busyLoop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(1000))
+
+
+class TestCase(unittest.TestCase):
+    def testSampler(self):
+        sampler = StackSampler(interval=0.005).start()
+        busyLoop(0.3)
+        counts = sampler.stop()
+        self.assertGreater(sampler.samples, 10)
+        busyStacks = [stack for stack in counts if stack.endswith("busyLoop (jobProfilerTest.py)")]
+        self.assertGreater(len(busyStacks), 0)
+        self.assertIn("testSampler (jobProfilerTest.py);busyLoop", busyStacks[0])
+        # The sampler doesn't sample itself
+        self.assertFalse(any(["_run (jobProfiler.py)" in stack for stack in counts]))
+
+    def testJobProfile(self):
+        with patch.dict(os.environ, {"CACTUS_PROFILE": "0"}):
+            self.assertEqual(jobProfiler.startJob(), None)
+        with patch.dict(os.environ, {"CACTUS_PROFILE": "1", "CACTUS_PROFILE_INTERVAL": "0.005"}):
+            sampler = jobProfiler.startJob()
+        busyLoop(0.1)
+        jobStore = FakeJobStore()
+        profile = jobProfiler.finishJob(sampler, FakeJob(), jobStore)
+        self.assertEqual(profile["job"], "FakeJob")
+        self.assertEqual(profile["interval"], 0.005)
+        self.assertEqual(jobStore.stats, [{jobProfiler.STATS_KEY: profile}])
+        self.assertEqual(jobProfiler.finishJob(None, FakeJob(), jobStore), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+#Released under the MIT license, see LICENSE.txt
+
+"""Local turbo mode, for small alignments on a single machine.
+
+If CACTUS_LOCAL_TURBO is set (to anything but 0) when a workflow starts, the
+jobs that fan out into many small jobs (the blasts of pairs of chunks, the
+wrappers of the recursions over flowers and the preprocessing of chunks) run
+those jobs themselves, in a pool, rather than having Toil schedule each of
+them. The pool is sized by the cores and memory Toil gave the job running
+it: jobs that ask for more than one core get that many of the pool's cores
+each, and no more run at once than fit in its memory. The blast and
+preprocessing jobs that know from their input that they will run a pool ask
+Toil for CACTUS_LOCAL_TURBO_CORES cores (by default, every core of the
+machine) for it.
+The jobs are the same classes, run with a LocalFileStore, so that their
+inputs and outputs are local files rather than job store files, and they
+give the same results.
+
+Only inputs of up to CACTUS_LOCAL_TURBO_MAX_SIZE bytes (100MB by default)
+are run this way, as the jobs in the pool aren't given resources by Toil;
+bigger ones are left to Toil as usual.
+
+The pool is of threads rather than processes: the jobs spend their time
+waiting for the programs they call, which are processes of their own, and
+this keeps the Toil file store (which isn't thread-safe) on the thread of
+the job running the pool, and the records of the calls with that job.
+"""
+
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cactus.shared.common import ContainerSession
+
+DEFAULT_MAX_SIZE = 100000000
+
+def isEnabled():
+    return os.environ.get("CACTUS_LOCAL_TURBO", "0") not in ("", "0")
+
+def getMaxSize():
+    return int(os.environ.get("CACTUS_LOCAL_TURBO_MAX_SIZE", DEFAULT_MAX_SIZE))
+
+def getCores():
+    return int(os.environ.get("CACTUS_LOCAL_TURBO_CORES", 0)) or os.cpu_count()
+
+def useLocalTurbo(size):
+    """Should jobs on an input of the given size run in the local pool?"""
+    return isEnabled() and size <= getMaxSize()
+
+def getPoolCores(size, cores):
+    """The cores for a job to ask for that runs the jobs on an input of the
+    given size: the pool's, if they run in the local pool, and otherwise
+    the given cores."""
+    return getCores() if useLocalTurbo(size) else cores
+
+class LocalFileID(str):
+    """Stands in for the FileID of a file written by, or for, a job in the
+    local pool: its path, with its size."""
+    def __new__(cls, path):
+        fileID = super(LocalFileID, cls).__new__(cls, os.path.abspath(path))
+        fileID.size = os.path.getsize(path)
+        return fileID
+
+class LocalFileStore(object):
+    """The part of the Toil file store that jobs use, for the jobs run in the
+    local pool. Their files are kept in a directory of the job running the
+    pool, and the files they read must be LocalFileIDs."""
+    def __init__(self, workDir):
+        self.localTempDir = workDir
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def getLocalTempDir(self):
+        return tempfile.mkdtemp(dir=self.localTempDir)
+
+    def getLocalTempFile(self):
+        handle, path = tempfile.mkstemp(dir=self.localTempDir)
+        os.close(handle)
+        return path
+
+    def getLocalTempFileName(self):
+        path = self.getLocalTempFile()
+        os.remove(path)
+        return path
+
+    def readGlobalFile(self, fileID, userPath=None, cache=True, mutable=False, symlink=False):
+        if not isinstance(fileID, LocalFileID):
+            raise RuntimeError("File %s isn't a local file, so a job in the local pool can't read it" % fileID)
+        # Like Toil, give the job a path of its own in the work dir (eg
+        # runLastz wants the chunks it aligns in the same directory)
+        path = userPath if userPath is not None else self.getLocalTempFileName()
+        if mutable:
+            shutil.copyfile(fileID, path)
+        else:
+            try:
+                os.link(fileID, path)
+            except OSError:
+                shutil.copyfile(fileID, path)
+        return path
+
+    def writeGlobalFile(self, localFileName, cleanup=False):
+        return LocalFileID(localFileName)
+
+    def deleteGlobalFile(self, fileID):
+        if not isinstance(fileID, LocalFileID):
+            raise RuntimeError("File %s isn't a local file, so a job in the local pool can't delete it" % fileID)
+        os.remove(fileID)
+
+    def logToMaster(self, text, level=logging.INFO):
+        with self._lock:
+            self.messages.append((text, level))
+
+def getJobCores(job):
+    """The cores a job asks for, or 1 if it doesn't say."""
+    try:
+        cores = job.cores
+    except AttributeError:
+        # Not given, and the job has no config to get the default from
+        return 1
+    return max(1, int(math.ceil(cores))) if cores is not None else 1
+
+def getJobMemory(job):
+    """The memory a job asks for, or None if it doesn't say."""
+    try:
+        return job.memory
+    except AttributeError:
+        return None
+
+def runJob(job, fileStore):
+    """Run a job in the local pool, returning what it returns."""
+    result = job.run(fileStore)
+    if len(job._children) > 0 or len(job._followOns) > 0 or len(job._services) > 0:
+        raise RuntimeError("Job %s added jobs of its own, so it can't run in the local pool" % job)
+    return result
+
+def runJobs(jobs, fileStore, cores, memory=None):
+    """Run the given jobs in a local pool, from the job whose Toil file store
+    is given, returning what each of them returned, in order. None of the
+    jobs can add jobs of its own.
+
+    The jobs share a container session, in which their calls run. The pool
+    has the cores and memory of the job running it. As many of the jobs run
+    at once as fit in them, given the cores and memory the jobs ask for (eg
+    a dna-brnn job that uses every core of the machine runs alone), but at
+    least one.
+    """
+    jobCores = max([getJobCores(job) for job in jobs] + [1])
+    numWorkers = cores // jobCores
+    jobMemories = [getJobMemory(job) for job in jobs]
+    if memory is not None and len(jobMemories) > 0 and None not in jobMemories and max(jobMemories) > 0:
+        numWorkers = min(numWorkers, memory // max(jobMemories))
+    localFileStore = LocalFileStore(fileStore.getLocalTempDir())
+    with ContainerSession(fileStore.localTempDir, fileStore=fileStore):
+        with ThreadPoolExecutor(max_workers=max(1, int(numWorkers))) as executor:
+            futures = [executor.submit(runJob, job, localFileStore) for job in jobs]
+            try:
+                results = [future.result() for future in futures]
+            except:
+                # Don't start any more, once one has failed
+                for future in futures:
+                    future.cancel()
+                raise
+    for text, level in localFileStore.messages:
+        fileStore.logToMaster(text, level)
+    return results
@@ -0,0 +1,154 @@
+"""Tests running small jobs in the local pool
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from cactus.shared import localTurbo
+from cactus.shared.localTurbo import LocalFileID, LocalFileStore, runJobs
+
+
+class FakeFileStore:
+    """The parts of a Toil file store that the local pool uses."""
+    def __init__(self, localTempDir):
+        self.localTempDir = localTempDir
+        self.messages = []
+
+    def getLocalTempDir(self):
+        return tempfile.mkdtemp(dir=self.localTempDir)
+
+    def logToMaster(self, text, level=None):
+        self.messages.append(text)
+
+
+class FakeJob:
+    def __init__(self):
+        self._children = []
+        self._followOns = []
+        self._services = []
+
+
+class UppercaseJob(FakeJob):
+    """Writes an uppercased copy of its input, like a preprocessing job."""
+    def __init__(self, inID, running, cores=None, memory=None):
+        super().__init__()
+        self.inID = inID
+        self.running = running
+        if cores is not None:
+            self.cores = cores
+        if memory is not None:
+            self.memory = memory
+
+    def run(self, fileStore):
+        with self.running["lock"]:
+            self.running["now"] += 1
+            self.running["max"] = max(self.running["max"], self.running["now"])
+        time.sleep(0.05)
+        outPath = fileStore.getLocalTempFile()
+        with open(fileStore.readGlobalFile(self.inID)) as inFile, open(outPath, 'w') as outFile:
+            outFile.write(inFile.read().upper())
+        fileStore.logToMaster("Uppercased %s" % os.path.basename(self.inID))
+        with self.running["lock"]:
+            self.running["now"] -= 1
+        return fileStore.writeGlobalFile(outPath)
+
+
+class FailingJob(FakeJob):
+    def run(self, fileStore):
+        raise RuntimeError("failed")
+
+
+class JobAddingJob(FakeJob):
+    def run(self, fileStore):
+        self._children.append(FakeJob())
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tempDir)
+
+    def makeFile(self, name, contents):
+        path = os.path.join(self.tempDir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def testUseLocalTurbo(self):
+        with patch.dict(os.environ, {"CACTUS_LOCAL_TURBO": "0"}):
+            self.assertFalse(localTurbo.useLocalTurbo(1))
+        with patch.dict(os.environ, {"CACTUS_LOCAL_TURBO": "1", "CACTUS_LOCAL_TURBO_MAX_SIZE": "1000"}):
+            self.assertTrue(localTurbo.useLocalTurbo(1000))
+            self.assertFalse(localTurbo.useLocalTurbo(1001))
+        with patch.dict(os.environ, {"CACTUS_LOCAL_TURBO_CORES": "3"}):
+            self.assertEqual(localTurbo.getCores(), 3)
+        # A job running the pool asks for the pool's cores
+        with patch.dict(os.environ, {"CACTUS_LOCAL_TURBO": "1", "CACTUS_LOCAL_TURBO_MAX_SIZE": "1000",
+                                     "CACTUS_LOCAL_TURBO_CORES": "3"}):
+            self.assertEqual(localTurbo.getPoolCores(1000, 1), 3)
+            self.assertEqual(localTurbo.getPoolCores(1001, 1), 1)
+
+    def testLocalFileStore(self):
+        fileStore = LocalFileStore(self.tempDir)
+        fileID = LocalFileID(self.makeFile("in.fa", ">a\nacgt\n"))
+        self.assertEqual(fileID.size, 8)
+        # The file is read into the work dir, whichever directory it's in
+        for mutable in [False, True]:
+            path = fileStore.readGlobalFile(fileID, mutable=mutable)
+            self.assertNotEqual(path, fileID)
+            self.assertEqual(os.path.dirname(path), self.tempDir)
+            with open(path) as f:
+                self.assertEqual(f.read(), ">a\nacgt\n")
+        # Only local files can be read
+        self.assertRaises(RuntimeError, fileStore.readGlobalFile, "files/for-job/kind-RunBlast/instance-1/file-x")
+        self.assertTrue(fileStore.getLocalTempFile().startswith(self.tempDir))
+        fileStore.deleteGlobalFile(fileID)
+        self.assertFalse(os.path.exists(fileID))
+
+    def testRunJobs(self):
+        running = {"lock": threading.Lock(), "now": 0, "max": 0}
+        inIDs = [LocalFileID(self.makeFile("chunk%d.fa" % i, ">%d\nacgt\n" % i)) for i in range(6)]
+        fileStore = FakeFileStore(self.tempDir)
+        outIDs = runJobs([UppercaseJob(inID, running) for inID in inIDs], fileStore, cores=3)
+        # The results are in the order of the jobs
+        for i, outID in enumerate(outIDs):
+            with open(outID) as f:
+                self.assertEqual(f.read(), ">%d\nACGT\n" % i)
+        self.assertEqual(running["max"], 3)
+        # The jobs' messages are passed on to the job running them
+        self.assertEqual(sorted(fileStore.messages), ["Uppercased chunk%d.fa" % i for i in range(6)])
+
+    def testRunJobsMultiCore(self):
+        """Jobs asking for more than one core get as many of the pool's."""
+        fileStore = FakeFileStore(self.tempDir)
+        for jobCores, maxRunning in [(2, 2), (4, 1), (8, 1)]:
+            running = {"lock": threading.Lock(), "now": 0, "max": 0}
+            inIDs = [LocalFileID(self.makeFile("chunk%d.fa" % i, ">%d\nacgt\n" % i)) for i in range(4)]
+            runJobs([UppercaseJob(inID, running, cores=jobCores) for inID in inIDs], fileStore, cores=4)
+            self.assertEqual(running["max"], maxRunning)
+
+    def testRunJobsMemory(self):
+        """No more jobs run at once than fit in the memory of the pool."""
+        fileStore = FakeFileStore(self.tempDir)
+        for memory, maxRunning in [(None, 4), (5, 2), (1, 1)]:
+            running = {"lock": threading.Lock(), "now": 0, "max": 0}
+            inIDs = [LocalFileID(self.makeFile("chunk%d.fa" % i, ">%d\nacgt\n" % i)) for i in range(4)]
+            runJobs([UppercaseJob(inID, running, memory=2) for inID in inIDs], fileStore, cores=4, memory=memory)
+            self.assertEqual(running["max"], maxRunning)
+
+    def testRunJobsFailure(self):
+        fileStore = FakeFileStore(self.tempDir)
+        self.assertRaises(RuntimeError, runJobs, [FailingJob()], fileStore, cores=1)
+        # Jobs that add jobs can't run in the pool
+        self.assertRaises(RuntimeError, runJobs, [JobAddingJob()], fileStore, cores=1)
+
+if __name__ == '__main__':
+    unittest.main()
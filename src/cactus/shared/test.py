@@ -7,6 +7,8 @@
 cactus workflow and the various utilities.
 """
 
+import io
+import json
 import os
 import pytest
 import random
@@ -423,6 +425,20 @@ def runWorkflow_multipleExamples(testId, inputGenFunction,
         system("rm -rf %s" % tempDir)
         logger.info("Finished random test %i" % test)
 
+class FakeJobStore:
+    """Stands in for a job store in tests of the stats that jobs write to it
+    (and that are read back from it)."""
+    def __init__(self, stats=None):
+        self.stats = stats if stats is not None else []
+
+    def writeStatsAndLogging(self, statsString):
+        self.stats.append(json.loads(statsString))
+
+    def readStatsAndLogging(self, callback, readAll=False):
+        for stats in self.stats:
+            callback(io.BytesIO(json.dumps(stats).encode()))
+        return len(self.stats)
+
 def checkCigar(filename):
     lines = 0
     with open(filename, 'r') as fh: